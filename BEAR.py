@@ -1,21 +1,33 @@
-import pybgpstream
-from itertools import groupby
-from collections import defaultdict
 import os
-import re
-import numpy as np
-import copy
 import time
 # if run script in jupyter notebook
-from tqdm.notebook import trange, tqdm
+from tqdm.auto import tqdm
 #if run script in python script
-#from tqdm import trange, tqdm
+#from tqdm import tqdm
 import pandas as pd
 import json
+import logging
+import threading
+from contextlib import nullcontext
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 from LLM_Module import LLM_Module
+from BGP_Module import collector_history_rib, collector_event_ribs, fetch_collectors, iter_collectors, Shared_RIB_Dumps
+from RIB_Snapshot import RIB_Snapshot
+from Cache_Module import BGP_Cache
+from RIB_Compactor import RIB_Compactor, RIB_FORMAT
+from Path_Diff import diff_ribs, merge_diffs, render_diff, DIFF_FORMAT
+from Event_Classifier import UNKNOWN, classify_event, describe_decision, describe_diff, majority_vote, parse_event_type
+from RIB_Store import RIB_Store, save_event, store_path
+from Path_Table import as_dict
+from Event_Metrics import Event_Metrics, current_metrics, bind, summarize
+from Collector_Planner import Collector_Planner
+from Prefix_Trie import Prefix_Trie
+from Prompt_Builder import Prompt_Builder
+
+logger = logging.getLogger(__name__)
 
 
 class BEAR(LLM_Module):
@@ -24,52 +36,212 @@ class BEAR(LLM_Module):
     given detected time, IP/Target AS, extract AS paths from history routing table data, BGP messages before event, BGP messages after event
     feed them to llm
     '''
-    def __init__(self, collector_list, model = "gpt-4o", project = "rcc", save_path = "e/", read_path = None):
+    def __init__(self, collector_list, model = "gpt-4o", project = "rcc", save_path = "e/", read_path = None, n_workers = 1,
+                 executor = "thread", cache_path = None, cache_size = 2*1024**3, n_sample = 5, llm_concurrency = 5,
+                 batch_sample = False, llm_kwargs = None, rib_token_budget = 60000, hierarchical = "auto", fan_in = 5,
+                 shard_by = "collector", use_path_diff = True, rule_threshold = 0.9, rule_min_peers = 3, rib_format = "json",
+                 stream_collectors = False, collector_coverage = None, max_collectors = None, rib_monitor = None,
+                 adaptive_vote = True, max_sample = None):
         '''
         initialize llm, collector_list, collector project, saving path and read path
         Args:
-            collector_list: list of collector names where we collect BGP data to write report
+            collector_list: list of collector names where we collect BGP data to write report, repeated collectors are
+                            only retrieved once
             model: backbone llm, default is gpt-4o
             project: which project that the collector we use is coming from. (for bgpstream)
             save_path: directory to save results/reports
             read_path: if provided, we read BGP data from this directory instead of using bgpstream to retrieve BGP data (if we already
                         retrieved relevant BGP data before and saved here)
+            n_workers: number of collectors retrieved from bgpstream in parallel, default 1 retrieves collectors one by one
+            executor: "thread" or "process", type of worker pool used when n_workers > 1
+            cache_path: if provided, BGP data retrieved from bgpstream is cached in this directory per (collector, filter,
+                        time window) and reused by later events
+            cache_size: maximum size in bytes of the BGP cache, least recently used data is removed beyond it
+            n_sample: number of self-consistency samples (AS path change description + event type decision) per report,
+                      with adaptive_vote the number of samples of a full vote
+            llm_concurrency: maximum number of self-consistency samples generated at the same time
+            batch_sample: if True, sample all n_sample AS path change descriptions in one llm request (the AS path data is
+                          sent once instead of n_sample times)
+            llm_kwargs: optional dict of keyword arguments for LLM_Module (max_retries, timeout, requests_per_minute,
+                        tokens_per_minute, backoff_base, backoff_max, cache_path, cache_size, replay)
+            rib_token_budget: maximum number of tokens of the routing tables in a prompt, larger routing tables are compacted
+                              (RIB_Compactor) to fit it
+            hierarchical: True, False or "auto", whether to write the report by map-reduce over shards of the routing
+                          tables (generate_report_hierarchical), "auto" uses it only when they do not fit in rib_token_budget
+            fan_in: number of sub-reports merged into one at each level of the hierarchical report
+            shard_by: "collector" or "prefix", how routing tables are split into shards for the hierarchical report
+            use_path_diff: if True, AS path change descriptions are generated from the precomputed AS path difference
+                           (Path_Diff) instead of the routing tables
+            rule_threshold: float, confidence of the rule-based event type decision (Event_Classifier) above which the llm
+                            descriptions and votes are skipped, None to always use the llm
+            rule_min_peers: int, number of peers that must show a change for a fully confident rule-based decision
+            rib_format: "json" or "columnar", format of the BGP data saved to save_path (columnar stores are read from
+                        read_path in either case)
+            stream_collectors: if True (with hierarchical = True), sub-reports of each collector start as soon as its BGP
+                               data is retrieved instead of after all collectors, and only the collectors in progress are
+                               held in memory. BGP data retrieved this way is not saved to save_path (only to cache_path)
+            collector_coverage: optional float, if provided only the collectors planned by Collector_Planner are retrieved:
+                                the fewest collectors whose peers and AS paths toward the target prefix in the historical
+                                routing tables (BGP cache and read_path) cover this fraction of those of all collectors.
+                                The plan of each event is saved to save_path + file_save_prefix + "collector_plan.json"
+            max_collectors: optional, maximum number of collectors retrieved per event with collector_coverage
+            rib_monitor: optional RIB_Monitor, BGP data of events on its watched prefixes is taken from its rolling routing
+                         tables instead of BGPStream once it holds the history window of the event
+            adaptive_vote: if True, samples are drawn in rounds and stop once an event type has a majority of n_sample
+                           (e.g. 3 of 3 agree), the vote is tallied from the event types parsed from the samples instead of
+                           by llm requests. If False, n_sample samples are drawn and the llm votes on them
+            max_sample: maximum number of samples drawn by adaptive_vote when votes split, default n_sample
         '''
-        super().__init__(model=model) #initialize LLM module
+        super().__init__(model=model, **(llm_kwargs or {})) #initialize LLM module
         
-        self.collector_list = collector_list
+        self.collector_list = list(dict.fromkeys(collector_list))
         self.model = model
         self.project = project
         self.save_path = save_path #directory to save files
         if not read_path:
             read_path = save_path
         self.read_path = read_path
+        self.n_workers = n_workers
+        self.executor = executor
+        self.n_sample = n_sample
+        self.llm_concurrency = llm_concurrency
+        self.batch_sample = batch_sample
+        self.adaptive_vote = adaptive_vote
+        self.max_sample = max_sample
+        self.compactor = RIB_Compactor(token_budget=rib_token_budget, model=model)
+        self.hierarchical = hierarchical
+        self.fan_in = max(2, fan_in)
+        self.shard_by = shard_by
+        self.use_path_diff = use_path_diff
+        self.rule_threshold = rule_threshold
+        self.rule_min_peers = rule_min_peers
+        self.rib_format = rib_format
+        self.stream_collectors = stream_collectors
+        self.bgp_cache = BGP_Cache(cache_path, max_bytes=cache_size) if cache_path else None
+        self.collector_coverage = collector_coverage
+        self.max_collectors = max_collectors
+        self.rib_monitor = rib_monitor
+        self.planner = Collector_Planner(self.collector_list, bgp_cache=self.bgp_cache, read_paths=[self.read_path]) \
+                       if collector_coverage is not None else None
+        self.fetch_semaphore = nullcontext() #limited by generate_multi_event
+        self.shared_dumps = None #set by generate_multi_event
+        self.status_lock = threading.Lock()
+        self.batch_status = {}
+        self.batch_metrics = {}
         os.makedirs(save_path, exist_ok=True)
 
-    def generate_multi_event(self, data_path):
+    def generate_multi_event(self, data_path, n_event_workers = 1, fetch_concurrency = None, llm_request_concurrency = None,
+                             resume = True, share_rib_dumps = False):
         '''
         generate report for each event recorded in data_path
+        events are processed concurrently, BGP data retrieval of one event overlaps with llm calls of another
         Args:
             data_path: path to a csv file that records the information for each detected BGP anomaly event
+            n_event_workers: number of events processed at the same time
+            fetch_concurrency: optional, maximum number of events retrieving BGP data at the same time (in this batch)
+            llm_request_concurrency: optional, maximum number of llm requests in flight at the same time (over all events
+                                     of this batch)
+            resume: if True, skip events whose report already exists in save_path
+            share_rib_dumps: if True, events whose history routing tables come from the same rib dumps are grouped and
+                             each dump is read once per collector for all of them (Shared_RIB_Dumps)
+        Return:
+            batch_status: {event index: status record}, also saved to save_path + "batch_status.json". The metrics of
+            every event (Event_Metrics) and their summary are saved to save_path + "batch_metrics.json"
         '''
         data = pd.read_csv(data_path, na_filter=False)
         N = len(data)
-        for i in trange(N):
-            #note that currently, event 9 and event 20 are the two events that exceeds token limit
-            if i == 9 or i == 20:
+        self.batch_status = {}
+        self.batch_metrics = {}
+        events = []
+        for i in range(N):
+            if resume and os.path.exists(self.save_path + str(i) + "_report.txt"):
+                self._set_status(i, "skipped", reason="report exists")
                 continue
-            event = data.iloc[i]
-            start_time = event['Start'].split(';')[0] if event['Start'] else None
-            IP = event['IP'].split(';')[0] if event['IP'] else None
-            AS = event['AS'].split(';')[0] if event['AS'] else None
-            end_time = event['End'].split(';')[0] if event['End'] else None
-            event_type = event['Event Type'].split(';')[0] if event['Event Type'] else None
-            self.generate_single_event(start_time=start_time, file_save_prefix=str(i)+"_", IP=IP, AS=AS, end_time=end_time, Event_Type=event_type)
+            self._set_status(i, "pending")
+            events.append(i)
+
+        if share_rib_dumps:
+            self.shared_dumps = Shared_RIB_Dumps(self.collector_list, n_workers=self.n_workers, executor=self.executor)
+            for i in events:
+                event = data.iloc[i]
+                if event['IP'] and event['Start'] and not self._has_event_ribs(str(i)+"_"):
+                    IP = event['IP'].split(';')[0]
+                    #only the collectors planned for the event are read from the dumps
+                    collectors = None
+                    if self.planner is not None:
+                        collectors = self.planner.plan(IP, coverage=self.collector_coverage,
+                                                       max_collectors=self.max_collectors)["collectors"]
+                    self.shared_dumps.register(datetime.strptime(event['Start'].split(';')[0], '%Y-%m-%d %H:%M:%S'), IP,
+                                               collectors=collectors)
+        #the limits only apply to this batch, the previous ones are restored after it
+        previous_limits = self.fetch_semaphore, self.request_semaphore
+        if fetch_concurrency:
+            self.fetch_semaphore = threading.BoundedSemaphore(fetch_concurrency)
+        if llm_request_concurrency:
+            self.limit_concurrent_requests(llm_request_concurrency)
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, n_event_workers)) as pool:
+                futures = [pool.submit(self._run_batch_event, i, data.iloc[i]) for i in events]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    future.result()
+        finally:
+            self.shared_dumps = None
+            self.fetch_semaphore, self.request_semaphore = previous_limits
+            with open(self.save_path + "batch_metrics.json", "w") as f:
+                json.dump({"summary": summarize(self.batch_metrics), "events": self.batch_metrics}, f)
+        return self.batch_status
+
+    def _has_event_ribs(self, file_save_prefix):
+        '''
+        Return:
+            True if BGP data of the event is in read_path
+        '''
+        return RIB_Store.exists(store_path(self.read_path, file_save_prefix)) or \
+               os.path.exists(self.read_path + file_save_prefix + "history_rib.json")
+
+    def _run_batch_event(self, i, event):
+        '''
+        generate report for event i of a batch and track its status
+        '''
+        start_time = event['Start'].split(';')[0] if event['Start'] else None
+        IP = event['IP'].split(';')[0] if event['IP'] else None
+        AS = event['AS'].split(';')[0] if event['AS'] else None
+        end_time = event['End'].split(';')[0] if event['End'] else None
+        event_type = event['Event Type'].split(';')[0] if event['Event Type'] else None
+        self._set_status(i, "running")
+        begin = time.time()
+        metrics = Event_Metrics(str(i))
+        try:
+            with metrics.activate():
+                report = self.generate_single_event(start_time=start_time, file_save_prefix=str(i)+"_", IP=IP, AS=AS, end_time=end_time, Event_Type=event_type)
+        except Exception as e: #e.g. BGP data retrieval failed
+            logger.exception("failed to process event %d", i)
+            self._set_status(i, "failed", error=repr(e), seconds=time.time()-begin)
+            return None
+        finally:
+            with self.status_lock:
+                self.batch_metrics[i] = metrics.to_dict()
+        if report is None:
+            self._set_status(i, "failed", error="no report generated", seconds=time.time()-begin)
+        else:
+            self._set_status(i, "done", seconds=time.time()-begin)
+        return None
+
+    def _set_status(self, i, status, **info):
+        '''
+        update the status record of event i in the current batch and save all status records
+        '''
+        with self.status_lock:
+            self.batch_status[i] = {"status": status, **info}
+            with open(self.save_path + "batch_status.json", "w") as f:
+                json.dump(self.batch_status, f)
         return None
             
     def generate_single_event(self, start_time, file_save_prefix="", IP=None, AS=None, end_time=None, Event_Type=None):
         '''
         generate report for a single event
+        the time of each stage, the BGP data read per collector and every llm request are recorded (Event_Metrics) and
+        saved to save_path + file_save_prefix + "metrics.json"
         Args:
             start_time: time when the anomaly event starts
             file_save_prefix: prefix to add to file name of all the result file for this event
@@ -77,147 +249,249 @@ class BEAR(LLM_Module):
             AS: victim AS
             end_time: time when the anomaly event ends
             Event_Type: type of the event (unused in the current code)
+        Return:
+            report: final report, None if the report could not be generated
+        '''
+        metrics = current_metrics.get() or Event_Metrics(file_save_prefix) #set by generate_multi_event for a batch
+        try:
+            with metrics.activate():
+                return self._generate_single_event(start_time, file_save_prefix=file_save_prefix, IP=IP, AS=AS,
+                                                   end_time=end_time, Event_Type=Event_Type)
+        finally:
+            metrics.save(self.save_path + file_save_prefix + "metrics.json")
+
+    def _generate_single_event(self, start_time, file_save_prefix="", IP=None, AS=None, end_time=None, Event_Type=None):
+        '''
+        generate_single_event, run with the metrics of the event recorded
         '''
         if IP: #all of our experiment assume victim IP available
             '''if IP is provided'''
-            try: #read BGP data from read_path
-                with open(self.read_path + file_save_prefix + "history_rib.json", "r") as f:
-                    history_rib = json.load(f)
-                with open(self.read_path + file_save_prefix + "before_event_rib.json", "r") as f:
-                    rib_before_incident = json.load(f)
-                with open(self.read_path + file_save_prefix + "after_event_rib.json", "r") as f:
-                    rib_after_incident = json.load(f)
-            except: #if BGP data not provided, retrieve them from BGPStream
-                history_rib, rib_before_incident, rib_after_incident = self.AS_Path_IP(start_time=start_time, IP_prefix=IP, end_time = end_time)
-
-            
+            #with stream_collectors, hierarchical sub-reports start on early collectors while the others are still
+            #retrieved (BGP data is not saved then)
+            streaming = self.stream_collectors and self.hierarchical is True
+            if streaming:
+                with self._stage("read_ribs"):
+                    ribs = self.read_event_ribs(file_save_prefix)
+                if ribs is None:
+                    ribs = self.monitor_ribs(start_time, IP, end_time=end_time, file_save_prefix=file_save_prefix)
+            else:
+                ribs = self.load_event_ribs(start_time=start_time, file_save_prefix=file_save_prefix, IP=IP, end_time=end_time)
             
             try: #to automatically skip event with data exceeds llm token limit
-                report, report_dict = self.generate_report(history_rib=history_rib,
-                                              rib_before_incident=rib_before_incident,
-                                              rib_after_incident=rib_after_incident,
-                                              time=start_time,
-                                              IP=IP,
-                                             Event_Type=Event_Type)
+                if ribs is None:
+                    with self.fetch_semaphore, self._stage("fetch_and_report"): #BGP data retrieval and llm overlap
+                        collectors = self.plan_collectors(file_save_prefix, IP)
+                        collector_stream = self.iter_event_ribs(start_time=start_time, IP_prefix=IP, end_time=end_time,
+                                                                collectors=collectors)
+                        report, report_dict = self.generate_report_streaming(collector_stream, time=start_time, IP=IP,
+                                                                             collectors=collectors)
+                else:
+                    history_rib, rib_before_incident, rib_after_incident = ribs
+                    with self._stage("report"):
+                        report, report_dict = self.generate_report(history_rib=history_rib,
+                                                      rib_before_incident=rib_before_incident,
+                                                      rib_after_incident=rib_after_incident,
+                                                      time=start_time,
+                                                      IP=IP,
+                                                     Event_Type=Event_Type)
                 with open(self.save_path + file_save_prefix + "report.txt", "w") as f:
                     json.dump(report, f) #final report
                 with open(self.save_path + file_save_prefix + "reprot_dict.json", "w") as f:
                     json.dump(report_dict, f) #includes intermediate results
-            except:
+                if "sub_report_levels" in report_dict: #hierarchical report, save sub-reports of each level
+                    levels = report_dict["sub_report_levels"]
+                    with open(self.save_path + file_save_prefix + "all_sub_report.json", "w") as f:
+                        json.dump(levels[0], f)
+                    for level, sub_reports in enumerate(levels[1:], start=1):
+                        with open(self.save_path + file_save_prefix + f"{self.fan_in}sum_{level}level_subreport_list.json", "w") as f:
+                            json.dump(sub_reports, f)
+            except Exception: #llm errors left after retries (e.g. data exceeds llm token limit) skip this event
+                logger.exception("failed to generate report for event %s", file_save_prefix)
                 return None
             
         elif AS: #not using
             '''IP not available but target AS available'''
-            history_rib, rib_before_incident, rib_after_incident = self.AS_Path_AS(start_time=start_time, target_AS=AS, end_time = end_time)
-            report = self.generate_report(history_rib=history_rib,
-                                          rib_before_incident=rib_before_incident,
-                                          rib_after_incident=rib_after_incident,
-                                          time=start_time,
-                                          AS=AS)
+            with self.fetch_semaphore, self._stage("fetch_ribs"):
+                history_rib, rib_before_incident, rib_after_incident = self.AS_Path_AS(start_time=start_time, target_AS=AS, end_time = end_time,
+                                                                                       collectors=self.plan_collectors(file_save_prefix))
+            with self._stage("save_ribs"):
+                self.save_ribs(file_save_prefix, history_rib, rib_before_incident, rib_after_incident)
+            with self._stage("report"):
+                report = self.generate_report(history_rib=history_rib,
+                                              rib_before_incident=rib_before_incident,
+                                              rib_after_incident=rib_after_incident,
+                                              time=start_time,
+                                              AS=AS)
         else:
             raise("Must provide IP or AS")
-        ###save routing table and report
-        # with open(self.save_path + file_save_prefix + "history_rib.json", "w") as f:
-        #     json.dump(history_rib, f)
-        # with open(self.save_path + file_save_prefix + "before_event_rib.json", "w") as f:
-        #     json.dump(rib_before_incident, f)
-        # with open(self.save_path + file_save_prefix + "after_event_rib.json", "w") as f:
-        #     json.dump(rib_after_incident, f)
-        
             
+        return report
+
+    def _stage(self, name):
+        '''
+        Return:
+            context that adds the wall time of the block to stage name in the metrics of the current event, if recorded
+        '''
+        metrics = current_metrics.get()
+        return metrics.stage(name) if metrics is not None else nullcontext()
+
+    def load_event_ribs(self, start_time, file_save_prefix, IP, end_time = None):
+        '''
+        read BGP data of an event from read_path, or take it from rib_monitor or retrieve it from BGPStream (or the BGP
+        cache) and save it to save_path
+        Return:
+            history_rib, rib_before_incident, rib_after_incident
+        '''
+        with self._stage("read_ribs"):
+            ribs = self.read_event_ribs(file_save_prefix)
+        if ribs is not None:
+            return ribs
+        #if BGP data not provided, take them from the rib monitor or retrieve them from BGPStream (or the BGP cache)
+        ribs = self.monitor_ribs(start_time, IP, end_time=end_time, file_save_prefix=file_save_prefix)
+        if ribs is not None:
+            if self.shared_dumps is not None: #the dumps of the slot are not needed for this event
+                self.shared_dumps.release(datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S'), IP)
+            history_rib, rib_before_incident, rib_after_incident = ribs
+        else:
+            with self.fetch_semaphore, self._stage("fetch_ribs"): #limit events retrieving BGP data at the same time
+                history_rib, rib_before_incident, rib_after_incident = self.AS_Path_IP(start_time=start_time, IP_prefix=IP, end_time = end_time,
+                                                                                       collectors=self.plan_collectors(file_save_prefix, IP))
+        with self._stage("save_ribs"):
+            self.save_ribs(file_save_prefix, history_rib, rib_before_incident, rib_after_incident)
+        return history_rib, rib_before_incident, rib_after_incident
+
+    def monitor_ribs(self, start_time, IP, end_time = None, file_save_prefix = ""):
+        '''
+        Args:
+            file_save_prefix: prefix of the files of the event, the collectors are planned like the retrieved ones
+                              (plan_collectors)
+        Return:
+            history_rib, rib_before_incident, rib_after_incident of the planned collectors of the event from
+            rib_monitor, or None if there is no monitor or it does not cover the event
+        '''
+        if self.rib_monitor is None or not self.rib_monitor.covers(IP, start_time):
+            return None
+        collectors = self.plan_collectors(file_save_prefix, IP)
+        with self._stage("monitor_ribs"):
+            collector_ribs = self.rib_monitor.event_ribs(start_time, IP, end_time=end_time, collectors=collectors)
+        metrics = current_metrics.get()
+        if metrics is not None:
+            for collector in collector_ribs:
+                metrics.add_collector(collector, cached=True)
+        return self._merge_collector_ribs(collector_ribs)
+
+    def read_event_ribs(self, file_save_prefix):
+        '''
+        read BGP data of an event from read_path, from the columnar store {file_save_prefix}ribs/ (RIB_Store) if it
+        exists, otherwise from the json files
+        Return:
+            history_rib, rib_before_incident, rib_after_incident, or None if the event is not in read_path. From a
+            columnar store they are memory-mapped Path_Tables sharing one Vocabulary, decoded only for the prompts
+        '''
+        if RIB_Store.exists(store_path(self.read_path, file_save_prefix)): #columnar store of the event
+            return RIB_Store(store_path(self.read_path, file_save_prefix)).path_tables()
+        try: #read BGP data from read_path
+            with open(self.read_path + file_save_prefix + "history_rib.json", "r") as f:
+                history_rib = json.load(f)
+            with open(self.read_path + file_save_prefix + "before_event_rib.json", "r") as f:
+                rib_before_incident = json.load(f)
+            with open(self.read_path + file_save_prefix + "after_event_rib.json", "r") as f:
+                rib_after_incident = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return history_rib, rib_before_incident, rib_after_incident
+
+    def save_ribs(self, file_save_prefix, history_rib, rib_before_incident, rib_after_incident):
+        '''
+        save routing tables retrieved for an event to save_path, so that the event can be read from there next time.
+        Saved as json files, or as a columnar store if rib_format is "columnar"
+        '''
+        if self.rib_format == "columnar":
+            save_event(store_path(self.save_path, file_save_prefix), history_rib.to_dict(), rib_before_incident.to_dict(),
+                       rib_after_incident.to_dict())
+            return None
+        with open(self.save_path + file_save_prefix + "history_rib.json", "w") as f:
+            json.dump(history_rib.to_dict(), f)
+        with open(self.save_path + file_save_prefix + "before_event_rib.json", "w") as f:
+            json.dump(rib_before_incident.to_dict(), f)
+        with open(self.save_path + file_save_prefix + "after_event_rib.json", "w") as f:
+            json.dump(rib_after_incident.to_dict(), f)
         return None
 
-    def AS_Path_IP(self, start_time, IP_prefix, end_time = None):
+    def plan_collectors(self, file_save_prefix, IP = None):
+        '''
+        Return:
+            collectors to retrieve for the event, collector_list if collector_coverage is not set. The plan is saved to
+            save_path + file_save_prefix + "collector_plan.json"
+        '''
+        if self.planner is None:
+            return self.collector_list
+        with self._stage("plan_collectors"):
+            plan = self.planner.plan(IP, coverage=self.collector_coverage, max_collectors=self.max_collectors)
+        with open(self.save_path + file_save_prefix + "collector_plan.json", "w") as f:
+            json.dump(plan, f)
+        return plan["collectors"]
+
+    def AS_Path_IP(self, start_time, IP_prefix, end_time = None, collectors = None):
         '''
         provide target IP and time extract BGP data, end time is optional
+        Args:
+            collectors: optional list of collectors to retrieve (e.g. planned by Collector_Planner), collector_list if None
+        '''
+        collectors = list(dict.fromkeys(collectors or self.collector_list))
+        collector_ribs = dict(tqdm(self.iter_event_ribs(start_time, IP_prefix, end_time=end_time, collectors=collectors),
+                                   total=len(collectors)))
+        return self._merge_collector_ribs(collector_ribs)
+
+    def iter_event_ribs(self, start_time, IP_prefix, end_time = None, collectors = None):
+        '''
+        retrieve BGP data of the event collector by collector, collectors in the BGP cache first and then the others as
+        soon as their retrieval from bgpstream finishes (at most n_workers at a time)
+        Args:
+            collectors: optional list of collectors to retrieve, collector_list if None
+        Return:
+            generator of (collector, (history, delta before event, delta after event)) of this collector
         '''
-        # convert start time to datetime object
         start = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
-        #convert end time to datetime object
         if end_time: #if end time is provided
             end = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S')
         else: #default 1 day after start
             end = start + timedelta(days=1)
+        window = [str(start), str(end)]
 
+        #collect as path to ip prefix that are less or more specific to the target IP prefix
+        bgp_filter = f"prefix any {IP_prefix}"
+        collectors = list(dict.fromkeys(collectors or self.collector_list))
+        collector_ribs = self._cached_ribs(bgp_filter, window, collectors)
+        metrics = current_metrics.get()
+        for collector, ribs in collector_ribs.items():
+            if metrics is not None:
+                metrics.add_collector(collector, cached=True)
+            yield collector, ribs
+        missing = [c for c in collectors if c not in collector_ribs]
+        history_ribs = None
+        if self.shared_dumps is not None:
+            if missing: #history routing tables read once for all events of the rib dump slot
+                history_ribs = self.shared_dumps.history_ribs(start, IP_prefix)
+            else: #all from the BGP cache, the dumps of the slot are not needed for this event
+                self.shared_dumps.release(start, IP_prefix)
+        #collectors that are not in the dumps (not planned when the event was registered) read their own history
+        per_collector_kwargs = {c: {"history_rib": history_ribs[c]} for c in missing if c in history_ribs} \
+                               if history_ribs is not None else None
+        stats = {} #BGPStream records, elements, bytes and time of each collector
+        for collector, ribs in iter_collectors(collector_event_ribs, missing, n_workers=self.n_workers,
+                                               executor=self.executor, per_collector_kwargs=per_collector_kwargs,
+                                               stats=stats, start=start, end=end, bgp_filter=bgp_filter):
+            if metrics is not None:
+                metrics.add_collector(collector, stats[collector])
+            self._cache_ribs(bgp_filter, window, {collector: ribs})
+            yield collector, ribs
 
-        ###extract history routing table
-        history_rib = defaultdict(dict)
-        for collector in tqdm(self.collector_list):
-            #rcc collects rib every 8 hours, we pick the 2nd last checkpoint
-            stream = pybgpstream.BGPStream(
-                from_time=str(start-timedelta(hours=16)), until_time=str(start-timedelta(hours=8)),
-                collectors=[collector],
-                record_type="ribs",
-                filter = f"prefix any {IP_prefix}"  #collect as path to ip prefix that are less or more specific to the target IP prefix
-            )
-            as_path = defaultdict(dict)
-
-            for rec in tqdm(stream.records()):
-                for ele in rec:
-                    # Get the peer ASn
-                    peer = str(ele.peer_asn)
-                    hops = [k for k, g in groupby(ele.fields['as-path'].split(" "))]
-                    #print(ele)
-                    if str(ele.type) == "R":
-                        if 'as-path' and "prefix" in ele.fields:
-                            IP = ele.fields["prefix"]
-                            as_path[IP][peer] = hops
-            history_rib[collector] = as_path
-
-        ###extract AS-paths before event
-        rib_before_incident = copy.deepcopy(history_rib)
-        types = {"A", "W"}
-        for collector in tqdm(self.collector_list):
-            stream1 = pybgpstream.BGPStream(
-                from_time=str(start-timedelta(hours=8)), until_time=str(start-timedelta(minutes=10)),
-                collectors=[collector],
-                record_type="updates",
-                filter = f"prefix any {IP_prefix}"
-            )
-            
-            for rec in tqdm(stream1.records()):
-                for elem in rec:
-                    if (str(elem.type) in types) and "prefix" in elem.fields:
-                        IP = str(elem.fields["prefix"])
-                        if str(elem.type) == "A" and "as-path" in elem.fields:
-                            peer = str(elem.peer_asn)
-                            hops = [k for k, g in groupby(elem.fields['as-path'].split(" "))]
-                            rib_before_incident[collector][IP][peer] = hops
-                            
-                        if str(elem.type) == "W":
-                            peer = str(elem.peer_asn)
-                            rib_before_incident[collector][IP][peer] = []
-
-        ###extract AS-paths after event
-        rib_after_incident = copy.deepcopy(rib_before_incident)
-        #collect information until 1min before event end or 10min after event start
-        until = min(end-timedelta(minutes=1), start+timedelta(minutes=10))
-        for collector in tqdm(self.collector_list):
-            stream1 = pybgpstream.BGPStream(
-                from_time=str(start-timedelta(minutes=10)), until_time=str(until),
-                collectors=[collector],
-                record_type="updates",
-                filter = f"prefix any {IP_prefix}"
-            )
-            
-            for rec in tqdm(stream1.records()):
-                for elem in rec:
-                    if (str(elem.type) in types) and "prefix" in elem.fields:
-                        IP = str(elem.fields["prefix"])
-                        if str(elem.type) == "A" and "as-path" in elem.fields:
-                            peer = str(elem.peer_asn)
-                            hops = [k for k, g in groupby(elem.fields['as-path'].split(" "))]
-                            rib_after_incident[collector][IP][peer] = hops
-                            
-                        if str(elem.type) == "W":
-                            peer = str(elem.peer_asn)
-                            rib_after_incident[collector][IP][peer] = []
-
-        return history_rib, rib_before_incident, rib_after_incident
-
-    def AS_Path_AS(self, start_time, target_AS, end_time = None):
+    def AS_Path_AS(self, start_time, target_AS, end_time = None, collectors = None):
         '''
         Missing IP but provide target AS number and time to extract AS paths, end time is optional
+        Args:
+            collectors: optional list of collectors to retrieve (e.g. planned by Collector_Planner), collector_list if None
         '''
         # convert start time to datetime object
         start = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
@@ -226,147 +500,485 @@ class BEAR(LLM_Module):
             end = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S')
         else: #default 1 day after start
             end = start + timedelta(days=1)
+        window = [str(start), str(end)]
 
+        as_filter = f'aspath "{target_AS}$"' #collect all as path to target_AS
+        collectors = list(dict.fromkeys(collectors or self.collector_list))
+        collector_ribs = self._cached_ribs(as_filter, window, collectors)
+        missing = [c for c in collectors if c not in collector_ribs]
+        metrics = current_metrics.get()
+        if metrics is not None:
+            for collector in collector_ribs:
+                metrics.add_collector(collector, cached=True)
+        if missing:
+            ###extract history routing table
+            history_stats = {}
+            collector_history = fetch_collectors(collector_history_rib, missing, n_workers=self.n_workers,
+                                                 executor=self.executor, progress=tqdm, stats=history_stats,
+                                                 start=start, bgp_filter=as_filter)
+            target_IP_prefix = set([])
+            for as_path in collector_history.values():
+                target_IP_prefix.update(as_path.keys())
+            for ribs in collector_ribs.values():
+                target_IP_prefix.update(ribs[0].keys())
 
-        ###extract history routing table
-        history_rib = defaultdict(dict)
-        target_IP_prefix = set([])
-        for collector in tqdm(self.collector_list):
-            #rcc collects rib every 8 hours, we pick the 2nd last checkpoint
-            stream = pybgpstream.BGPStream(
-                from_time=str(start-timedelta(hours=16)), until_time=str(start-timedelta(hours=8)),
-                collectors=[collector],
-                record_type="ribs",
-                filter = f'aspath "{target_AS}$"' #collect all as path to target_AS
-            )
-            as_path = defaultdict(dict)
-
-            for rec in tqdm(stream.records()):
-                for ele in rec:
-                    # Get the peer ASn
-                    peer = str(ele.peer_asn)
-                    hops = [k for k, g in groupby(ele.fields['as-path'].split(" "))]
-                    #print(ele)
-                    if str(ele.type) == "R":
-                        if 'as-path' and "prefix" in ele.fields:
-                            IP = ele.fields["prefix"]
-                            target_IP_prefix.add(IP)
-                            as_path[IP][peer] = hops
-            history_rib[collector] = as_path
-
-        ###extract AS-paths before event
-        rib_before_incident = copy.deepcopy(history_rib)
-        types = {"A", "W"}
-        #construct filter by target IP prefix
-        filter_string = f"prefix any"
-        for ip_p in target_IP_prefix:
-            filter_string += f" {ip_p}" 
-        for collector in tqdm(self.collector_list):
-            stream1 = pybgpstream.BGPStream(
-                from_time=str(start-timedelta(hours=8)), until_time=str(start-timedelta(minutes=10)),
-                collectors=[collector],
-                record_type="updates",
-                filter = filter_string
-            )
-            
-            for rec in tqdm(stream1.records()):
-                for elem in rec:
-                    if (str(elem.type) in types) and "prefix" in elem.fields:
-                        IP = str(elem.fields["prefix"])
-                        if str(elem.type) == "A" and "as-path" in elem.fields:
-                            peer = str(elem.peer_asn)
-                            hops = [k for k, g in groupby(elem.fields['as-path'].split(" "))]
-                            rib_before_incident[collector][IP][peer] = hops
-                            
-                        if str(elem.type) == "W":
-                            peer = str(elem.peer_asn)
-                            rib_before_incident[collector][IP][peer] = []
-
-        ###extract AS-paths after event
-        rib_after_incident = copy.deepcopy(rib_before_incident)
-        #collect information until 1min before event end or 10min after event start
-        until = min(end-timedelta(minutes=1), start+timedelta(minutes=10))
-        for collector in tqdm(self.collector_list):
-            stream1 = pybgpstream.BGPStream(
-                from_time=str(start-timedelta(minutes=10)), until_time=str(until),
-                collectors=[collector],
-                record_type="updates",
-                filter = filter_string
-            )
-            
-            for rec in tqdm(stream1.records()):
-                for elem in rec:
-                    if (str(elem.type) in types) and "prefix" in elem.fields:
-                        IP = str(elem.fields["prefix"])
-                        if str(elem.type) == "A" and "as-path" in elem.fields:
-                            peer = str(elem.peer_asn)
-                            hops = [k for k, g in groupby(elem.fields['as-path'].split(" "))]
-                            rib_after_incident[collector][IP][peer] = hops
-                            
-                        if str(elem.type) == "W":
-                            peer = str(elem.peer_asn)
-                            rib_after_incident[collector][IP][peer] = []
+            ###extract AS-paths before and after event
+            #construct filter by target IP prefix
+            filter_string = "prefix any"
+            for ip_p in target_IP_prefix:
+                filter_string += f" {ip_p}" 
+            update_stats = {}
+            fetched = fetch_collectors(collector_event_ribs, missing, n_workers=self.n_workers,
+                                       executor=self.executor, progress=tqdm, stats=update_stats,
+                                       per_collector_kwargs={c: {"history_rib": h} for c, h in collector_history.items()},
+                                       start=start, end=end, bgp_filter=filter_string)
+            if metrics is not None:
+                for collector in missing:
+                    metrics.add_collector(collector, history_stats.get(collector))
+                    metrics.add_collector(collector, update_stats.get(collector))
+            self._cache_ribs(as_filter, window, fetched)
+            collector_ribs.update(fetched)
+        return self._merge_collector_ribs(collector_ribs)
+
+    def _cached_ribs(self, bgp_filter, window, collectors):
+        '''
+        look up BGP data of each collector of collectors in the BGP cache
+        Return:
+            {collector: (history, delta before event, delta after event)} of the collectors found in the cache
+        '''
+        collector_ribs = {}
+        if self.bgp_cache is None:
+            return collector_ribs
+        for collector in collectors:
+            ribs = self.bgp_cache.get_ribs(collector, bgp_filter, window)
+            if ribs is not None:
+                collector_ribs[collector] = ribs
+        return collector_ribs
+
+    def _cache_ribs(self, bgp_filter, window, collector_ribs):
+        '''
+        save BGP data of each collector retrieved from bgpstream to the BGP cache
+        '''
+        if self.bgp_cache is None:
+            return None
+        for collector, ribs in collector_ribs.items():
+            self.bgp_cache.put_ribs(collector, bgp_filter, window, ribs)
+        return None
 
+    def _merge_collector_ribs(self, collector_ribs):
+        '''
+        merge {collector: (history, delta before event, delta after event)} of each collector into history_rib,
+        rib_before_incident and rib_after_incident. The later two are RIB_Snapshot that only store the updates on top of
+        the previous table
+        '''
+        collector_ribs = {collector: collector_ribs[collector] for collector in dict.fromkeys(self.collector_list)
+                          if collector in collector_ribs}
+        history_rib = RIB_Snapshot({collector: ribs[0] for collector, ribs in collector_ribs.items()})
+        rib_before_incident = history_rib.snapshot({collector: ribs[1] for collector, ribs in collector_ribs.items()})
+        rib_after_incident = rib_before_incident.snapshot({collector: ribs[2] for collector, ribs in collector_ribs.items()})
         return history_rib, rib_before_incident, rib_after_incident
 
+    def generate_report_hierarchical(self, history_rib, rib_before_incident, rib_after_incident, time, IP, path_diff = None):
+        '''
+        map-reduce report for events whose routing tables are too large for one prompt
+        First split the routing tables into shards (per collector or per group of prefixes, see shard_by) that fit in the token budget
+        Second generate a sub-report for each shard concurrently
+        Then merge every fan_in reports into one report, level by level, until one report remains
+        Args:
+            path_diff: optional, diff_ribs of the routing tables if it is already computed
+        Return:
+            output_report: final report
+            output_dict: includes the sub-reports of every level
+        '''
+        if path_diff is None:
+            path_diff = diff_ribs(history_rib, rib_before_incident, rib_after_incident, target_prefix=IP)
+        shards = self.shard_ribs(history_rib, rib_before_incident, rib_after_incident)
+        with ThreadPoolExecutor(max_workers=max(1, self.llm_concurrency)) as pool:
+            sub_reports = list(tqdm(pool.map(bind(lambda shard: self.generate_sub_report(shard[1], time, IP)), shards),
+                                    total=len(shards)))
+            levels = self._merge_levels(pool, sub_reports, time, IP)
+        output_report = levels[-1][0]
+        output_dict = {"shards": [name for name, shard_text in shards],
+                       "fan_in": self.fan_in,
+                       "sub_report_levels": levels,
+                       "report": output_report,
+                       "path_diff_counts": path_diff["counts"],
+                       "rule_decision": classify_event(path_diff, min_peers=self.rule_min_peers)}
+        return output_report, output_dict
+
+    def generate_report_streaming(self, collector_stream, time, IP, collectors = None):
+        '''
+        map-reduce report like generate_report_hierarchical, started while BGP data is still being retrieved: as soon as
+        the data of a collector arrives, its path difference is computed and the sub-reports of its shards are submitted,
+        then its routing tables are dropped, so only the collectors being retrieved or processed are held in memory.
+        The path difference is computed per collector, so a prefix that is new to one collector counts as a new
+        more-specific prefix even if other collectors had it before the event
+        Args:
+            collector_stream: iterable of (collector, (history, delta before event, delta after event)), e.g. iter_event_ribs
+            collectors: optional, collectors in collector_stream (e.g. planned by plan_collectors), collector_list if None
+        Return:
+            output_report: final report
+            output_dict: includes the sub-reports of every level
+        '''
+        shards = {} #collector -> [(shard name, future of the sub-report)]
+        path_diffs = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.llm_concurrency)) as pool:
+            for collector, ribs in tqdm(collector_stream, total=len(dict.fromkeys(collectors or self.collector_list))):
+                history_rib, rib_before_incident, rib_after_incident = self._merge_collector_ribs({collector: ribs})
+                path_diffs[collector] = diff_ribs(history_rib, rib_before_incident, rib_after_incident, target_prefix=IP)
+                shards[collector] = [(name, pool.submit(bind(self.generate_sub_report), shard_text, time, IP)) for name, shard_text
+                                     in self.shard_ribs(history_rib, rib_before_incident, rib_after_incident)]
+            collectors = [collector for collector in dict.fromkeys(collectors or self.collector_list) if collector in shards]
+            sub_reports = [future.result() for collector in collectors for name, future in shards[collector]]
+            levels = self._merge_levels(pool, sub_reports, time, IP)
+        path_diff = merge_diffs([path_diffs[collector] for collector in collectors], target_prefix=IP)
+        output_report = levels[-1][0]
+        output_dict = {"shards": [name for collector in collectors for name, future in shards[collector]],
+                       "fan_in": self.fan_in,
+                       "sub_report_levels": levels,
+                       "report": output_report,
+                       "path_diff_counts": path_diff["counts"],
+                       "rule_decision": classify_event(path_diff, min_peers=self.rule_min_peers)}
+        return output_report, output_dict
+
+    def _merge_levels(self, pool, sub_reports, time, IP):
+        '''
+        merge every fan_in reports into one report, level by level, until one report remains
+        Return:
+            levels: list of the reports of each level, the first level is sub_reports and the last one has one report
+        '''
+        levels = [sub_reports]
+        while len(levels[-1]) > 1:
+            groups = [levels[-1][i:i+self.fan_in] for i in range(0, len(levels[-1]), self.fan_in)]
+            levels.append(list(pool.map(bind(lambda group: self.merge_reports(group, time, IP)), groups)))
+        return levels
+
+    def shard_ribs(self, history_rib, rib_before_incident, rib_after_incident):
+        '''
+        split routing tables into shards, one per collector (shard_by = "collector") or per group of prefixes
+        (shard_by = "prefix"). Prefix groups hold as many prefixes as fit in the token budget, in prefix order so that
+        more-specific prefixes are next to their covering prefix. A shard that still does not fit in the token budget is
+        split in half (by collectors, then by prefixes) until it fits
+        Return:
+            shards: list of (shard name, compact text of the shard routing tables)
+        '''
+        ribs = tuple(as_dict(rib) for rib in (history_rib, rib_before_incident, rib_after_incident))
+        collectors = list(dict.fromkeys([collector for rib in ribs for collector in rib]))
+        #the routing tables grouped by prefix in one pass: IP prefix -> ({collector: {peer: [AS path]}} of each table)
+        by_prefix = {}
+        for i, rib in enumerate(ribs):
+            for collector, collector_rib in rib.items():
+                for IP, peers in collector_rib.items():
+                    by_prefix.setdefault(IP, ({}, {}, {}))[i][collector] = peers
+        if self.shard_by == "prefix":
+            prefixes = list(Prefix_Trie(by_prefix)) #covering prefixes first, each followed by its more-specifics
+            ordered = set(prefixes)
+            prefixes += [IP for IP in by_prefix if IP not in ordered] #not valid IP prefixes (or repeated networks)
+            return self._pack_prefixes(ribs, by_prefix, collectors, prefixes) or [("all", self.compactor.compact(*ribs)[0])]
+        shards = []
+        for collector in collectors:
+            shards.extend(self._split_shard(collector, ribs, by_prefix, [collector], None))
+        return shards or [("all", self.compactor.compact(*ribs)[0])]
+
+    def _shard_tables(self, ribs, by_prefix, collectors, prefixes):
+        '''
+        Return:
+            routing tables of the given collectors, restricted to the given prefixes (all prefixes if None)
+        '''
+        if prefixes is None:
+            return [{collector: rib.get(collector, {}) for collector in collectors} for rib in ribs]
+        return [{collector: {IP: by_prefix[IP][i][collector] for IP in prefixes if collector in by_prefix[IP][i]}
+                 for collector in collectors} for i in range(len(ribs))]
+
+    def _pack_prefixes(self, ribs, by_prefix, collectors, prefixes):
+        '''
+        group consecutive prefixes into shards that fit in the token budget. The size of each group is found by doubling
+        the number of prefixes until they do not fit, then bisecting, so a group takes a logarithmic number of compactions.
+        A single prefix that does not fit is split by _split_shard
+        '''
+        shards = []
+        start = 0
+        while start < len(prefixes):
+            compact = lambda n: self._fitting_text(ribs, by_prefix, collectors, prefixes[start:start+n])
+            fit_text = compact(1)
+            if fit_text is None:
+                shards.extend(self._split_shard(prefixes[start], ribs, by_prefix, collectors, prefixes[start:start+1]))
+                start += 1
+                continue
+            fit, too_large = 1, None
+            while too_large is None and start + fit < len(prefixes):
+                n = min(2 * fit, len(prefixes) - start)
+                rib_text = compact(n)
+                if rib_text is None:
+                    too_large = n
+                else:
+                    fit, fit_text = n, rib_text
+            while too_large is not None and too_large - fit > 1:
+                n = (fit + too_large) // 2
+                rib_text = compact(n)
+                if rib_text is None:
+                    too_large = n
+                else:
+                    fit, fit_text = n, rib_text
+            name = prefixes[start] if fit == 1 else f"{prefixes[start]}..{prefixes[start+fit-1]}"
+            shards.append((name, fit_text))
+            start += fit
+        return shards
+
+    def _fitting_text(self, ribs, by_prefix, collectors, prefixes):
+        '''
+        Return:
+            compact text of the routing tables of the given collectors and prefixes, None if it does not fit
+        '''
+        rib_text, compaction_level = self.compactor.compact(*self._shard_tables(ribs, by_prefix, collectors, prefixes))
+        return rib_text if compaction_level != "truncated" else None
+
+    def _split_shard(self, name, ribs, by_prefix, collectors, prefixes):
+        '''
+        compact the routing tables of the given collectors (and prefixes, all if None), split in half if they do not fit
+        '''
+        shard = self._shard_tables(ribs, by_prefix, collectors, prefixes)
+        rib_text, compaction_level = self.compactor.compact(*shard)
+        if compaction_level != "truncated":
+            return [(name, rib_text)]
+        if len(collectors) > 1:
+            half = len(collectors) // 2
+            return self._split_shard(f"{name}/1", ribs, by_prefix, collectors[:half], prefixes) + \
+                   self._split_shard(f"{name}/2", ribs, by_prefix, collectors[half:], prefixes)
+        if prefixes is None:
+            prefixes = list(dict.fromkeys([IP for rib in shard for IP in rib[collectors[0]]]))
+        if len(prefixes) > 1:
+            half = len(prefixes) // 2
+            return self._split_shard(f"{name}/1", ribs, by_prefix, collectors, prefixes[:half]) + \
+                   self._split_shard(f"{name}/2", ribs, by_prefix, collectors, prefixes[half:])
+        return [(name, rib_text)] #a single prefix of a single collector, keep the truncated text
+
+    def generate_sub_report(self, rib_text, time, IP):
+        '''
+        generate a report about the event from one shard of the routing tables
+        Return:
+            sub-report: str
+        '''
+        system_prompt = "You are an expert in BGP network anomaly detection and explaination.\
+                            Now I detect there is an anomaly event that happened at a certain time, \
+                            but I don't know what happened exactly and need your help.\
+                            I will provide you part of the AS pathes collected to the target IP prefix and its sub-prefixes \
+                            before the anomaly event, after the anomaly event, and in the history for reference. \
+                            Write a report about what these AS pathes show about this event, including time, the changes in AS \
+                            paths, anomaly type, related AS number and IP address. It will be merged with reports on the other parts."
+        prompt = Prompt_Builder(rib_text, RIB_FORMAT, subject="part of the paths to this IP prefix in history, before the \
+event (time stamp) and after the event")
+        user_prompt = f"{IP} is the IP prefix we detected has a problem. {time} is the time that we detected the event start.\
+                        The data above is {prompt.subject}. \
+                        Now, write the report for this part of the AS pathes."
+        message = prompt.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
+        return self.chat(messages=message, model=self.model, label="sub_report")[0]
+
+    def merge_reports(self, reports, time, IP):
+        '''
+        merge reports of the same event, each written from a different part of the routing tables, into one report
+        Return:
+            merged report: str
+        '''
+        if len(reports) == 1:
+            return reports[0]
+        system_prompt = "You are an expert in BGP network anomaly detection and explaination.\
+                            Given a list of reports of the same BGP anomaly event, each written from a different part of the \
+                            AS pathes collected, write one consolidated report about this event, including time, anomaly type, \
+                            related AS number and IP address. Keep every anomaly found in any report and explain in detail."
+        user_prompt = f"{IP} is the IP prefix we detected has a problem. {time} is the time that we detected the event start.\
+                        List of reports: {reports}"
+        message = self.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
+        return self.chat(messages=message, model=self.model, label="merge_reports")[0]
+
+    def describe_and_classify(self, rib_text, time, IP, sample_index=0, diff_text=None, prompt=None):
+        '''
+        one self-consistency sample: generate a description of AS path changes before and after the event, then decide the
+        event type based on the description
+        Args:
+            rib_text: compact text of the routing tables in history, before and after the event (RIB_Compactor)
+            diff_text: optional, text of the precomputed AS path difference (Path_Diff), used instead of rib_text
+            sample_index: index of this sample, keeps the cached llm responses of different samples apart
+            prompt: optional Prompt_Builder of the data, shared by the samples of an event (built from rib_text/diff_text if None)
+        Return:
+            output_description: str, description of AS path changes
+            output_event_type: str, event type decision
+        '''
+        output_description = self.describe_changes(rib_text=rib_text, time=time, IP=IP, sample_index=sample_index,
+                                                    diff_text=diff_text, prompt=prompt)[0]
+
+        #generate Event type prediction based on the description
+        output_event_type = self.classify_event_type(output_description, sample_index=sample_index)
+        return output_description, output_event_type
+
+    def draw_samples(self, rib_text, time, IP, start, n, diff_text=None, prompt=None):
+        '''
+        draw n self-consistency samples concurrently, at most llm_concurrency at once. With batch_sample, the n descriptions
+        are sampled in one llm request and then classified concurrently
+        Args:
+            start: index of the first sample, samples of later rounds continue the indices of the earlier ones
+            n: number of samples
+        Return:
+            list of n (output_description, output_event_type)
+        '''
+        with ThreadPoolExecutor(max_workers=max(1, min(self.llm_concurrency, n))) as pool:
+            if self.batch_sample:
+                #sample n descriptions of AS path changes in one request, then decide n event types concurrently
+                description_list = self.describe_changes(rib_text=rib_text, time=time, IP=IP, n=n, sample_index=start,
+                                                         diff_text=diff_text, prompt=prompt)
+                event_type_list = list(tqdm(pool.map(bind(self.classify_event_type), description_list, range(start, start + n)),
+                                            total=n))
+                return list(zip(description_list, event_type_list))
+            #generate n descriptions of AS path changes and n event type predictions, n chains run concurrently
+            futures = [pool.submit(bind(self.describe_and_classify), rib_text=rib_text, time=time, IP=IP, sample_index=i,
+                                   diff_text=diff_text, prompt=prompt)
+                       for i in range(start, start + n)]
+            return [future.result() for future in tqdm(futures)]
+
+    def describe_changes(self, rib_text, time, IP, n=1, sample_index=0, diff_text=None, prompt=None):
+        '''
+        generate descriptions of AS path changes before and after the event
+        Args:
+            rib_text: compact text of the routing tables in history, before and after the event (RIB_Compactor)
+            diff_text: optional, text of the precomputed AS path difference (Path_Diff), used instead of rib_text
+            n: number of descriptions, all of them are sampled in one llm request
+            sample_index: index of the (first) sample, keeps the cached llm responses of different samples apart
+            prompt: optional Prompt_Builder of the data, shared by the samples of an event (built from rib_text/diff_text if None)
+        Return:
+            list of n descriptions of AS path changes
+        '''
+        system_prompt = "You are an expert in Border Gateway Protocol. Given a set of AS paths to a specific IP prefix, \
+                            describe the changes in these paths before and after a time stamp. Try to answer the following questions:\n \
+                            Does the existing path from each peer to the target IP prefix change?\
+                            If it does, does the last AS (destination) change or not?\n \
+                            Is there any new AS path to a new sub-prefix introduced?\
+                            If there is, compare it to the existing path with the same peer, is there any difference? Does the last \
+                            AS (destination) change ot not?"
+        if prompt is None:
+            prompt = self.data_prompt(rib_text, diff_text=diff_text)
+        user_prompt = f"{IP} is the target IP prefix. {time} is the time stamp. \n\
+                        The data above is {prompt.subject}. \
+                        For example, in an AS path '97600:[97600, 12334, 54323, 2134]' 2134 is last and the destination AS.\
+                        Now, describe the AS path changes."
+        message = prompt.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
+        return self.chat(messages=message, model=self.model, n=n, cache_tag=sample_index, label="describe_changes")
+
+    def data_prompt(self, rib_text, diff_text = None):
+        '''
+        Return:
+            Prompt_Builder whose data message holds the path difference if diff_text is given, the routing tables otherwise
+        '''
+        if diff_text is not None:
+            return Prompt_Builder(diff_text, DIFF_FORMAT, subject="the difference of the paths to this IP prefix and its \
+sub-prefixes before and after the time stamp")
+        return Prompt_Builder(rib_text, RIB_FORMAT, subject="the paths to this IP prefix and its sub-prefixes in history, \
+before the time stamp (event start) and after the time stamp")
+
+    def classify_event_type(self, output_description, sample_index=0):
+        '''
+        decide the event type based on a description of AS path changes
+        Args:
+            sample_index: index of the sample, keeps the cached llm responses of different samples apart
+        Return:
+            output_event_type: str, event type decision
+        '''
+        system_prompt_3 = "A BGP route leak often results in adding unexpected transit ASes without changing the \
+                            destination AS. In contrast, a BGP hijack typically leads to changing the destination AS in the AS path\
+                            and potentially redirecting traffic away from the legitimate owner. These consequence may reflect \
+                            in even just one AS path and in a sub-prefix.\n \
+                            Now I will provide you an analysis of AS path change before and after an event, you need to identify the\
+                            type of this event. Think step by step. Reply in one sentence.\n"
+        user_prompt_3 = f"Analysis:{output_description}"
+        message = self.make_message(user_prompt=user_prompt_3, system_prompt=system_prompt_3)
+        output_event_type = self.chat(messages=message, model=self.model, cache_tag=sample_index, label="classify_event_type")[0]
+        return output_event_type
+
     def generate_report(self, history_rib, rib_before_incident, rib_after_incident, time, IP="unknown", AS="unkonwn", Event_Type = "unknown"):
         '''
         provide history routing table, routing table before event, routing table after event, event time, IP or AS (must provide one)
         generate LLM explaination and report
         First generate N descriptions of changes in AS path before and after the event
         Second give N decisions of the event type based on the descriptions
+        (each description and its decision is one chain, N = n_sample chains run concurrently, at most llm_concurrency at once.
+        With batch_sample, the N descriptions are sampled in one llm request and then classified concurrently)
         Third, use self-consistency machenism with N descriptions and N event type decisions generate final description and final event type
         prediction
+        (with adaptive_vote, chains are drawn in rounds until an event type has a majority of n_sample, at most max_sample
+        chains, and the majority is tallied from the parsed event types, the llm only votes if no event type can be read)
         Finally, generate the report explaining the BGP anomaly event
+        If the rule-based decision on the AS path changes (Event_Classifier) is confident (rule_threshold), the first three
+        steps are skipped and the description and event type come from the path difference
+        If the routing tables do not fit in the token budget (or hierarchical is True), generate_report_hierarchical is used
+        The routing tables are nested dicts, or Path_Tables sharing one Vocabulary (e.g. read from a columnar store)
         '''
         if IP != "unknown":
-            event_type_list = [] #save n event type prediction
-            description_list = [] #save n descriptions of the AS path changes
-            for i in trange(5): #n=5
-                #generate description of AS path changes before and after the event
-                system_prompt = "You are an expert in Border Gateway Protocol. Given a set of AS paths to a specific IP prefix, \
-                                    describe the changes in these paths before and after a time stamp. Try to answer the following questions:\n \
-                                    Does the existing path from each peer to the target IP prefix change?\
-                                    If it does, does the last AS (destination) change or not?\n \
-                                    Is there any new AS path to a new sub-prefix introduced?\
-                                    If there is, compare it to the existing path with the same peer, is there any difference? Does the last \
-                                    AS (destination) change ot not?"
-                user_prompt = f"{IP} is the target IP prefix. {time} is the time stamp. \n\
-                                Here are the paths to this IP prefix and its sub-prefixes in history: {history_rib} \n \
-                                Here are the paths to this IP prefix and its sub-prefixes before the time stamp: {rib_before_incident}. \n \
-                                Here are the paths after the time stamp: {rib_after_incident}. \n \
-                                All pathes are stored in a dictironary in a form of \
-                                {{collector name: {{IP prefix: {{peer: [AS path from peer to the origin AS of IP prefix]}}}}}}. \
-                                For example, in an AS path '97600:[97600, 12334, 54323, 2134]' 2134 is last and the destination AS.\
-                                Now, describe the AS path changes."
-                message = self.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
-                output_description = self.chat(messages=message, model=self.model)[0]
-    
-                #generate Event type prediction based on the description
-                system_prompt_3 = "A BGP route leak often results in adding unexpected transit ASes without changing the \
-                                    destination AS. In contrast, a BGP hijack typically leads to changing the destination AS in the AS path\
-                                    and potentially redirecting traffic away from the legitimate owner. These consequence may reflect \
-                                    in even just one AS path and in a sub-prefix.\n \
-                                    Now I will provide you an analysis of AS path change before and after an event, you need to identify the\
-                                    type of this event. Think step by step. Reply in one sentence.\n"
-                user_prompt_3 = f"Analysis:{output_description}"
-                message = self.make_message(user_prompt=user_prompt_3, system_prompt=system_prompt_3)
-                output_event_type = self.chat(messages=message, model=self.model)[0]
-                event_type_list.append(output_event_type)
-                description_list.append(output_description)
-
-            #generate final description and event type prediction that is in accordance with most of the descriptions and event types
-            system_prompt_00 = f"Given a list of descriptions of the event type of the same event, identify the event type by choose the \
-                                one in most descriptions. Output the event type and one sentence of explaination."
-            user_prompt_00 = f"List of event type description {event_type_list}."
-            message = self.make_message(user_prompt=user_prompt_00, system_prompt=system_prompt_00)
-            output_event = self.chat(messages=message, model=self.model)[0]
-
-            system_prompt_01 = f"Given a list of report of the AS path changes, generate one output report that is in accordance to the most\
-                                report in the given list."
-            user_prompt_01 = f"List of AS path change report {description_list}."
-            message = self.make_message(user_prompt=user_prompt_01, system_prompt=system_prompt_01)
-            output_change = self.chat(messages=message, model=self.model)[0]
+            #precompute AS path changes, the descriptions are generated from them instead of the routing tables (Path_Tables
+            #of a columnar store are compared with vectorized numpy operations)
+            path_diff = diff_ribs(history_rib, rib_before_incident, rib_after_incident, target_prefix=IP)
+            #Path_Tables are decoded to dicts only for the prompts, and the dicts are dropped before the llm requests
+            ribs = [as_dict(rib) for rib in (history_rib, rib_before_incident, rib_after_incident)]
+            if self.hierarchical is True: #shards are compacted one by one, the whole tables are not
+                return self.generate_report_hierarchical(*ribs, time=time, IP=IP, path_diff=path_diff)
+            #compact routing tables that fit in the token budget, shared by all prompts
+            rib_text, compaction_level = self.compactor.compact(*ribs)
+            if self.hierarchical == "auto" and compaction_level == "truncated":
+                #routing tables do not fit in one prompt, summarize shards of them and merge the sub-reports
+                return self.generate_report_hierarchical(*ribs, time=time, IP=IP, path_diff=path_diff)
+            del ribs
+            diff_text = render_diff(path_diff, token_budget=self.compactor.token_budget, model=self.model) if self.use_path_diff else None
+            #rule-based event type decision, the llm samples and votes only run when it is not clear
+            decision = classify_event(path_diff, min_peers=self.rule_min_peers)
+            #every request on the same data starts with the same data message, a prompt prefix shared by the samples (and
+            #by the report if the descriptions also use the routing tables)
+            rib_prompt = self.data_prompt(rib_text)
+            describe_prompt = self.data_prompt(rib_text, diff_text=diff_text) if diff_text is not None else rib_prompt
+            if self.rule_threshold is not None and decision["confidence"] >= self.rule_threshold:
+                description_list = []
+                event_type_list = []
+                vote = None
+                output_change = describe_diff(path_diff)
+                output_event = describe_decision(decision)
+            else:
+                if self.adaptive_vote:
+                    #draw samples until an event type has a majority of n_sample, then tally the vote locally
+                    samples = []
+                    labels = []
+                    while True:
+                        winner, n_more, votes = majority_vote(labels, self.n_sample, self.max_sample)
+                        if not n_more:
+                            break
+                        new_samples = self.draw_samples(rib_text, time, IP, len(samples), n_more, diff_text=diff_text,
+                                                        prompt=describe_prompt)
+                        samples += new_samples
+                        labels += [parse_event_type(output_event_type) for output_description, output_event_type in new_samples]
+                else:
+                    samples = self.draw_samples(rib_text, time, IP, 0, self.n_sample, diff_text=diff_text, prompt=describe_prompt)
+                    labels = [parse_event_type(output_event_type) for output_description, output_event_type in samples]
+                    winner, votes = None, majority_vote(labels, self.n_sample)[2]
+                description_list = [output_description for output_description, output_event_type in samples] #save n descriptions of the AS path changes
+                event_type_list = [output_event_type for output_description, output_event_type in samples] #save n event type prediction
+                vote = {"votes": votes, "n_samples": len(samples), "by": "local"}
+
+                if winner not in (None, UNKNOWN):
+                    #the first sample of the winning type gives the final event type and description
+                    chosen = labels.index(winner)
+                    output_event = event_type_list[chosen]
+                    output_change = description_list[chosen]
+                else:
+                    #no event type could be read from the samples (or adaptive_vote is off), the llm votes on them
+                    vote["by"] = "llm"
+                    #generate final description and event type prediction that is in accordance with most of the descriptions and event types
+                    system_prompt_00 = "Given a list of descriptions of the event type of the same event, identify the event type by choose the \
+                                        one in most descriptions. Output the event type and one sentence of explaination."
+                    user_prompt_00 = f"List of event type description {event_type_list}."
+                    message = self.make_message(user_prompt=user_prompt_00, system_prompt=system_prompt_00)
+                    output_event = self.chat(messages=message, model=self.model, label="vote_event_type")[0]
+
+                    system_prompt_01 = "Given a list of report of the AS path changes, generate one output report that is in accordance to the most\
+                                        report in the given list."
+                    user_prompt_01 = f"List of AS path change report {description_list}."
+                    message = self.make_message(user_prompt=user_prompt_01, system_prompt=system_prompt_01)
+                    output_change = self.chat(messages=message, model=self.model, label="vote_change")[0]
 
             #Write report
             system_prompt_4 = "You are an expert in BGP network anomaly detection and explaination.\
@@ -382,19 +994,19 @@ class BEAR(LLM_Module):
             user_prompt_4 = f"{IP} is the IP prefix we detected has a problem. {time} is the time that we detected the event start.\
                             {output_event} is the description about the event type. \n \
                             {output_change} is the description of the change in AS paths before and after the event. \n \
-                            Here are the paths to this IP prefix in history: {history_rib} \n \
-                            Here are the paths to this IP prefix before the event: {rib_before_incident}. \n \
-                            Here are the paths after the event: {rib_after_incident}. \n \
-                            All pathes are stored in a dictironary in a form of \
-                            {{collector name: {{IP prefix: {{peer: [AS path from peer to IP prefix]}}}}}}. \
+                            The data above is {rib_prompt.subject}. \
                             Now, write the BGP anomaly event report."
-            message = self.make_message(user_prompt=user_prompt_4, system_prompt=system_prompt_4)
-            output_report = self.chat(messages=message, model=self.model)[0]
+            message = rib_prompt.make_message(user_prompt=user_prompt_4, system_prompt=system_prompt_4)
+            output_report = self.chat(messages=message, model=self.model, label="report")[0]
             output_dict = {"raw_change": description_list,
                           "raw_event": event_type_list,
                           "final_change": output_change,
                           "final_event": output_event,
-                          "report": output_report}
+                          "report": output_report,
+                          "rib_compaction": compaction_level,
+                          "path_diff_counts": path_diff["counts"],
+                          "rule_decision": decision,
+                          "vote": vote}
             
             
         elif AS != "unknown": #not using
@@ -408,14 +1020,13 @@ class BEAR(LLM_Module):
                             Then you need to write a report about this event, including time, anomaly type, \
                             related AS number and IP address. If the data provided is not enough for you to write the report, please \
                             explain what data is missing."
+            prompt = Prompt_Builder.from_ribs(history_rib, rib_before_incident, rib_after_incident,
+                                              subject="the paths to the IP prefixes of this AS in history, before the event \
+(time stamp) and after the event")
             user_prompt = f"AS{AS} is the autonomous system we detected has a problem. {time} is the time that we detected the event start.\
-                            Here are the paths to this AS in history: {history_rib} \n \
-                            Here are the paths to this AS before the event: {rib_before_incident}. \n \
-                            Here are the paths after the event: {rib_after_incident}. \n \
-                            All pathes are stored in a dictironary in a form of \
-                            {{collector name: {{IP prefix: {{peer: [AS path from peer to IP prefix]}}}}}}. Now, write the report."
-            message = self.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
-            output_report = self.chat(messages=message, model=self.model)[0]
+                            The data above is {prompt.subject}. Now, write the report."
+            message = prompt.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
+            output_report = self.chat(messages=message, model=self.model, label="report")[0]
         else:
             raise("Must provide at least one IP or AS!")
         return output_report, output_dict
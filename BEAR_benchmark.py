@@ -0,0 +1,404 @@
+'''
+offline benchmark of BEAR: replays the BGP data of the events in Experiment/e_1 and of the synthetic events in
+Data/Synthetic_events.zip through generate_multi_event (or generate_single_event one by one) with a local stand-in for
+the llm api, so neither BGPStream nor OpenAI is needed. Reports the time of each stage, memory peak, prompt size and
+throughput, and compares them with a previous run to catch regressions.
+
+python BEAR_benchmark.py bench/ --sources e_1 synthetic --mode multi --event-workers 4 --latency 0.2
+'''
+import os
+import re
+import csv
+import json
+import hashlib
+import time
+import random
+import shutil
+import zipfile
+import argparse
+import ipaddress
+import asyncio
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from types import SimpleNamespace
+try:
+    import resource
+except ImportError: #not available on windows, max_rss is not reported
+    resource = None
+from LLM_Module import LLM_Module
+from BEAR import BEAR
+from RIB_Compactor import count_tokens
+from RIB_Store import JSON_FILES
+from Event_Metrics import Event_Metrics, summarize
+
+#default data paths are relative to this file, so the benchmark runs from any directory
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+RCC_COLLECTORS = ["rrc00", "rrc01", "rrc03", "rrc04", "rrc05", "rrc06", "rrc07", "rrc10", "rrc11", "rrc12", "rrc13", "rrc14",
+                  "rrc15", "rrc16", "rrc17", "rrc18", "rrc19", "rrc20", "rrc21", "rrc22", "rrc23", "rrc24", "rrc25", "rrc26"]
+EVENT_FIELDS = ["Event Type", "AS", "AS2", "IP", "Start", "End", "Event Name", "More info"]
+#answer of the mock llm, repeated to about completion_tokens tokens
+MOCK_ANSWER = "The destination AS of the paths to the target prefix changed after the time stamp, so the event is a BGP hijack."
+#result fields compared with the baseline, a larger value is worse
+REGRESSION_FIELDS = ["seconds", "memory_peak_bytes", "prompt_tokens", "llm_requests"]
+#smallest prompt prefix cached by the provider (openai caches prompts of 1024 tokens or more)
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+
+class Mock_Client():
+    '''
+    local stand-in for the openai client used by LLM_Module: answers every chat completion request with a fixed text after
+    a latency that grows with the prompt tokens, and reports token usage like the api. Counts requests and the largest
+    number of requests in flight at the same time, to check the concurrency limits. Like the provider prompt cache, leading
+    messages of at least PROMPT_CACHE_MIN_TOKENS tokens that were sent before are cached: reported as cached tokens and
+    not counted in the latency.
+    '''
+    def __init__(self, latency = 0.0, latency_per_1k_tokens = 0.0, completion_tokens = 50, model = "gpt-4o",
+                 prompt_cache = True):
+        '''
+        Args:
+            latency: float, seconds of every request
+            latency_per_1k_tokens: float, additional seconds per 1000 prompt tokens that are not cached
+            completion_tokens: int, approximate tokens of every answer
+            model: llm name, used to count tokens
+            prompt_cache: if True, simulate the provider prompt cache
+        '''
+        self.latency = latency
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.model = model
+        self.answer = " ".join([MOCK_ANSWER] * max(1, round(completion_tokens / max(1, count_tokens(MOCK_ANSWER, model)))))
+        self.completion_tokens = count_tokens(self.answer, model)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=self.acreate)))
+        self.lock = threading.Lock()
+        self.prompt_tokens = []
+        self.cached_prompt_tokens = []
+        self.prompt_cache = prompt_cache
+        self.prefixes = set() #hashes of the leading messages sent before
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def create(self, model, messages, n = 1, timeout = None):
+        tokens, cached = self._start(messages)
+        try:
+            time.sleep(self.latency + self.latency_per_1k_tokens * (tokens - cached) / 1000)
+        finally:
+            self._finish()
+        return self._response(tokens, cached, n)
+
+    async def acreate(self, model, messages, n = 1, timeout = None):
+        '''
+        create of the async client (async_client), waits without blocking the event loop
+        '''
+        tokens, cached = self._start(messages)
+        try:
+            await asyncio.sleep(self.latency + self.latency_per_1k_tokens * (tokens - cached) / 1000)
+        finally:
+            self._finish()
+        return self._response(tokens, cached, n)
+
+    def _start(self, messages):
+        '''
+        count a new request in flight
+        Return:
+            tokens, cached: prompt tokens of the request and how many of them are served by the prompt cache
+        '''
+        message_tokens = [count_tokens(message["content"], self.model) for message in messages]
+        tokens = sum(message_tokens)
+        prefixes = [hashlib.sha256(json.dumps(messages[:k+1], sort_keys=True).encode()).hexdigest() for k in range(len(messages))]
+        with self.lock:
+            cached = 0
+            for k, prefix in enumerate(prefixes):
+                if not self.prompt_cache or prefix not in self.prefixes:
+                    break
+                if sum(message_tokens[:k+1]) >= PROMPT_CACHE_MIN_TOKENS:
+                    cached = sum(message_tokens[:k+1])
+            self.prefixes.update(prefixes)
+            self.prompt_tokens.append(tokens)
+            self.cached_prompt_tokens.append(cached)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return tokens, cached
+
+    def _finish(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def _response(self, tokens, cached, n):
+        message = SimpleNamespace(message=SimpleNamespace(content=self.answer))
+        usage = SimpleNamespace(prompt_tokens=tokens, completion_tokens=n * self.completion_tokens,
+                                total_tokens=tokens + n * self.completion_tokens,
+                                prompt_tokens_details=SimpleNamespace(cached_tokens=cached))
+        return SimpleNamespace(choices=[message] * n, usage=usage)
+
+
+@contextmanager
+def mock_llm(client):
+    '''
+    LLM_Module instances created in the block use client (and client.async_client in achat) instead of the openai clients
+    '''
+    previous = LLM_Module._client, LLM_Module._async_client
+    LLM_Module._client, LLM_Module._async_client = client, client.async_client
+    try:
+        yield client
+    finally:
+        LLM_Module._client, LLM_Module._async_client = previous
+
+
+def prepare_events(work_path, sources = ("e_1", "synthetic"), data_path = os.path.join(REPO_PATH, "Data/BGP_explain_data.csv"),
+                   e1_path = os.path.join(REPO_PATH, "Experiment/e_1/"),
+                   synthetic_zip = os.path.join(REPO_PATH, "Data/Synthetic_events.zip"),
+                   synthetic_history = os.path.join(REPO_PATH, "Data/synthetic_history_rib.json"), n_events = None, seed = 0):
+    '''
+    gather the BGP data of the benchmark events in work_path/ribs/ (numbered from 0 like a read_path of BEAR) and list the
+    events in work_path/events.csv
+    Args:
+        sources: "e_1" for the events of data_path with BGP data in e1_path, "synthetic" for the synthetic events of
+                 data_path, whose BGP data is rebuilt from synthetic_zip and synthetic_history (synthetic_ribs)
+        n_events: optional, maximum number of events
+        seed: seed of the peers chosen for the synthetic events
+    Return:
+        read_path, events_path
+    '''
+    read_path = os.path.join(work_path, "ribs/")
+    shutil.rmtree(read_path, ignore_errors=True)
+    os.makedirs(read_path)
+    with open(data_path, "r", newline="") as f:
+        records = list(csv.DictReader(f))
+    events = []
+    if "e_1" in sources:
+        for i, record in enumerate(records):
+            files = [os.path.join(e1_path, f"{i}_{name}") for name in JSON_FILES.values()]
+            if record["IP"] and all(os.path.isfile(file) for file in files):
+                events.append((record, files))
+    if "synthetic" in sources:
+        with open(synthetic_history, "r") as f:
+            all_history_rib = json.load(f)
+        with zipfile.ZipFile(synthetic_zip) as archive:
+            texts = {name: json.loads(archive.read(name)) for name in archive.namelist()}
+        for i, record in enumerate(records):
+            name = os.path.basename(record["More info"])
+            if name in texts and record["IP"]:
+                ribs = synthetic_ribs(all_history_rib, record["IP"], record["Event Type"], record["AS2"], texts[name],
+                                      random.Random(seed * 1000 + i))
+                if ribs[0]: #target prefix in synthetic_history
+                    events.append((record, ribs))
+    events = events[:n_events] if n_events else events
+    for j, (record, ribs) in enumerate(events):
+        for name, rib in zip(JSON_FILES.values(), ribs):
+            if isinstance(rib, str): #json file of e_1
+                shutil.copyfile(rib, os.path.join(read_path, f"{j}_{name}"))
+            else:
+                with open(os.path.join(read_path, f"{j}_{name}"), "w") as f:
+                    json.dump(rib, f)
+    events_path = os.path.join(work_path, "events.csv")
+    with open(events_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=EVENT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(record for record, ribs in events)
+    return read_path, events_path
+
+
+def synthetic_ribs(all_history_rib, target_IP, event_type, attacker_AS, text, rng):
+    '''
+    rebuild the BGP data of a synthetic event the way Synthetic_BGP_Event_Data generates it, from the event description
+    instead of llm extractions: the paths of a share of the peers to the target prefix (or the sub-prefix) are replaced by
+    example paths of the description: cut at the hijacker (hijack), or the leaker and the ASes after it in the example are
+    inserted into the historical path before its origin AS, which is kept (route leak)
+    Args:
+        all_history_rib: {collector: {IP prefix: {peer: [AS path]}}} of every synthetic target prefix
+        target_IP: target IP prefix of the event
+        event_type: "Hijack" or "Route Leak"
+        attacker_AS: hijacker or leaker AS
+        text: description of the event
+        rng: random.Random, chooses the peers that see the event
+    Return:
+        history_rib, rib_before_incident, rib_after_incident
+    '''
+    history_rib = {collector: {target_IP: rib[target_IP]} for collector, rib in all_history_rib.items() if target_IP in rib}
+    attacker_AS = re.sub(r"\D", "", attacker_AS)
+    text = re.sub(r"\([^)]*\)", "", text) #AS names
+    text = re.sub(r"\bAS\s*(?=\d)", "", text) #"AS 15562 -> AS 2914" -> "15562 -> 2914"
+    target = _network(target_IP)
+    sub_prefixes = [IP for IP in re.findall(r"\d+\.\d+\.\d+\.\d+/\d+", text) if _network(IP) is not None and target is not None
+                    and _network(IP) != target and _network(IP).subnet_of(target)]
+    #paths such as "15562 -> 2914 -> 15169", "34854 - 1239 - 15169", "[3356, 1299, 15169]" or "3356 1299 15169"
+    paths = [re.findall(r"\d+", path) for path in re.findall(r"\d+(?:(?:\s*(?:->|→|-|,)\s*|[ \t]+)\d+)+", text)]
+    paths = [path for path in paths if attacker_AS in path] or [[attacker_AS]]
+    percentage = re.search(r"(\d+)\s*%", text)
+    percentage = int(percentage.group(1)) if percentage else 50
+
+    rib_after_incident = json.loads(json.dumps(history_rib))
+    operate_IP = sub_prefixes[0] if sub_prefixes else target_IP
+    for rib in rib_after_incident.values():
+        rib[operate_IP] = json.loads(json.dumps(rib[target_IP]))
+    selected = []
+    while not selected and any(rib[operate_IP] for rib in rib_after_incident.values()):
+        selected = [(collector, peer) for collector, rib in rib_after_incident.items() for peer in rib[operate_IP]
+                    if rng.randint(1, 100) <= percentage]
+    for collector, peer in selected:
+        old_path = rib_after_incident[collector][operate_IP][peer]
+        new_path = rng.choice(paths)
+        i = new_path.index(attacker_AS)
+        if event_type == "Route Leak":
+            if old_path:
+                rib_after_incident[collector][operate_IP][peer] = _leak_path(old_path, new_path[i:], attacker_AS)
+            continue
+        new_path = new_path[:i+1]
+        if new_path[0] != attacker_AS:
+            new_path = new_path[1:]
+        if len(old_path) - 1 < len(new_path):
+            rib_after_incident[collector][operate_IP][peer] = old_path[:1] + new_path
+        else:
+            rib_after_incident[collector][operate_IP][peer] = old_path[:-len(new_path)] + new_path
+    return history_rib, history_rib, rib_after_incident
+
+
+def _leak_path(old_path, leaked, leaker_AS):
+    '''
+    Args:
+        old_path: historical AS path of a peer, its last AS is the origin
+        leaked: example path from the leaker on, its last AS is the origin of the example
+    Return:
+        old_path with the leaker (or, if it is already on the path, the ASes after it in the example) inserted before the
+        origin AS, the origin AS is kept
+    '''
+    origin = old_path[-1]
+    leaked = [AS for AS in (leaked[:-1] if len(leaked) > 1 else leaked) if AS != origin]
+    if leaker_AS in old_path[:-1]:
+        j = old_path.index(leaker_AS) + 1
+        leaked = leaked[1:]
+    else:
+        j = len(old_path) - 1
+    inserted = list(dict.fromkeys(AS for AS in leaked if AS not in old_path))
+    return old_path[:j] + inserted + old_path[j:]
+
+
+def _network(IP):
+    try:
+        return ipaddress.ip_network(IP, strict=False)
+    except ValueError:
+        return None
+
+
+def run_benchmark(work_path, sources = ("e_1", "synthetic"), mode = "multi", n_events = None, n_event_workers = 4,
+                  latency = 0.0, latency_per_1k_tokens = 0.0, completion_tokens = 50, trace_memory = True, seed = 0,
+                  **bear_kwargs):
+    '''
+    run BEAR over the benchmark events with the mock llm
+    Args:
+        work_path: directory of the benchmark data, reports and result
+        sources: see prepare_events
+        mode: "multi" to run generate_multi_event with n_event_workers, "single" to run generate_single_event one by one
+        latency, latency_per_1k_tokens, completion_tokens: see Mock_Client
+        trace_memory: if True, the peak of python memory allocations is measured with tracemalloc (slower)
+        bear_kwargs: keyword arguments of BEAR, e.g. n_sample, hierarchical, llm_concurrency
+    Return:
+        result: throughput, memory peak, prompt sizes, llm requests and the summary of the metrics of every event (also
+                saved to work_path/benchmark.json)
+    '''
+    read_path, events_path = prepare_events(work_path, sources=sources, n_events=n_events, seed=seed)
+    save_path = os.path.join(work_path, "reports/")
+    shutil.rmtree(save_path, ignore_errors=True)
+    with open(events_path, "r", newline="") as f:
+        events = list(csv.DictReader(f))
+    client = Mock_Client(latency=latency, latency_per_1k_tokens=latency_per_1k_tokens, completion_tokens=completion_tokens)
+    with mock_llm(client):
+        generator = BEAR(collector_list=RCC_COLLECTORS, save_path=save_path, read_path=read_path, **bear_kwargs)
+        if trace_memory:
+            tracemalloc.start()
+        begin = time.time()
+        try:
+            if mode == "multi":
+                status = generator.generate_multi_event(events_path, n_event_workers=n_event_workers, resume=False)
+                n_done = sum(record["status"] == "done" for record in status.values())
+                records = generator.batch_metrics
+            else:
+                n_done = 0
+                records = {}
+                for i, event in enumerate(events):
+                    metrics = Event_Metrics(str(i))
+                    with metrics.activate():
+                        report = generator.generate_single_event(start_time=event["Start"], file_save_prefix=f"{i}_",
+                                                                 IP=event["IP"], end_time=event["End"] or None)
+                    n_done += report is not None
+                    records[i] = metrics.to_dict()
+            seconds = time.time() - begin
+            memory_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+    prompt_tokens = sorted(client.prompt_tokens)
+    result = {"mode": mode,
+              "sources": list(sources),
+              "events": len(events),
+              "done": n_done,
+              "seconds": round(seconds, 3),
+              "events_per_minute": round(n_done / seconds * 60, 2) if seconds else None,
+              "memory_peak_bytes": memory_peak,
+              "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None,
+              "llm_requests": len(prompt_tokens),
+              "llm_peak_in_flight": client.peak_in_flight,
+              "prompt_tokens": sum(prompt_tokens),
+              "cached_prompt_tokens": sum(client.cached_prompt_tokens),
+              "prompt_tokens_max": prompt_tokens[-1] if prompt_tokens else 0,
+              "prompt_tokens_median": prompt_tokens[len(prompt_tokens) // 2] if prompt_tokens else 0,
+              "settings": {"n_event_workers": n_event_workers, "latency": latency,
+                           "latency_per_1k_tokens": latency_per_1k_tokens, "completion_tokens": completion_tokens,
+                           "seed": seed, **bear_kwargs},
+              "summary": summarize(records)}
+    with open(os.path.join(work_path, "benchmark.json"), "w") as f:
+        json.dump(result, f, indent=1)
+    return result
+
+
+def compare(result, baseline, tolerance = 0.2):
+    '''
+    Args:
+        result, baseline: outputs of run_benchmark with the same settings
+        tolerance: float, relative increase above which a field is a regression
+    Return:
+        list of (field, baseline value, value) of the fields of REGRESSION_FIELDS that increased by more than tolerance,
+        and of events_per_minute if it decreased by more than tolerance
+    '''
+    regressions = []
+    for field in REGRESSION_FIELDS:
+        if result.get(field) is not None and baseline.get(field) and result[field] > baseline[field] * (1 + tolerance):
+            regressions.append((field, baseline[field], result[field]))
+    if result.get("events_per_minute") is not None and baseline.get("events_per_minute") and \
+       result["events_per_minute"] < baseline["events_per_minute"] * (1 - tolerance):
+        regressions.append(("events_per_minute", baseline["events_per_minute"], result["events_per_minute"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline benchmark of BEAR with a mock llm")
+    parser.add_argument("work_path", help="directory of the benchmark data, reports and result")
+    parser.add_argument("--sources", nargs="+", default=["e_1", "synthetic"], choices=["e_1", "synthetic"])
+    parser.add_argument("--mode", default="multi", choices=["multi", "single"])
+    parser.add_argument("--events", type=int, default=None, help="maximum number of events")
+    parser.add_argument("--event-workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of every llm request")
+    parser.add_argument("--latency-per-1k", type=float, default=0.0, help="additional seconds per 1000 prompt tokens")
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--n-sample", type=int, default=5)
+    parser.add_argument("--hierarchical", default="auto", choices=["auto", "true", "false"])
+    parser.add_argument("--no-memory", action="store_true", help="do not trace memory allocations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=None, help="benchmark.json of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    result = run_benchmark(args.work_path, sources=args.sources, mode=args.mode, n_events=args.events,
+                           n_event_workers=args.event_workers, latency=args.latency,
+                           latency_per_1k_tokens=args.latency_per_1k, completion_tokens=args.completion_tokens,
+                           trace_memory=not args.no_memory, seed=args.seed, n_sample=args.n_sample,
+                           hierarchical={"auto": "auto", "true": True, "false": False}[args.hierarchical])
+    print(json.dumps({key: value for key, value in result.items() if key not in ("summary", "settings")}, indent=1))
+    print("stages:", json.dumps(result["summary"]["stages"]))
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(result, json.load(f), tolerance=args.tolerance)
+        for field, before, after in regressions:
+            print(f"regression: {field} {before} -> {after}")
+        if regressions:
+            raise SystemExit(1)
@@ -3,14 +3,17 @@ from BEAR import BEAR
 
 #repeat our experiment
 data = 'Data/BGP_explain_data.csv' #path to event data
-rcc_collector_lists = ["rrc00", "rrc01", "rrc03", "rrc04", "rrc05", "rrc06", "rrc07", "rrc10", "rrc11", "rrc12", "rrc10", "rrc11",
-                      "rrc12", "rrc13", "rrc14", "rrc15", "rrc16", "rrc17", "rrc18", "rrc19", "rrc20", "rrc21", "rrc22", "rrc23",
+rcc_collector_lists = ["rrc00", "rrc01", "rrc03", "rrc04", "rrc05", "rrc06", "rrc07", "rrc10", "rrc11", "rrc12",
+                      "rrc13", "rrc14", "rrc15", "rrc16", "rrc17", "rrc18", "rrc19", "rrc20", "rrc21", "rrc22", "rrc23",
                       "rrc24", "rrc25", "rrc26"] #since we use rcc, the collector list includes all rcc collectors
 #initialize generator, need to download e_1 for reading BGP data. remember to change the save path to where you want to save the results
 #if change llm to non-openai llm, remember to change functions in LLM_module.py.
-generator = BEAR(collector_list=rcc_collector_lists, model = "gpt-4o", project = "rcc", save_path = "e_8/", read_path = "e_1/")
-#generate event report
-generator.generate_multi_event(data)
+#n_workers sets how many collectors are retrieved from bgpstream in parallel (executor can be "thread" or "process")
+#cache_path keeps BGP data retrieved from bgpstream on disk, re-running an event reuses it instead of bgpstream
+generator = BEAR(collector_list=rcc_collector_lists, model = "gpt-4o", project = "rcc", save_path = "e_8/", read_path = "e_1/",
+                 n_workers = 8, executor = "process", cache_path = "bgp_cache/")
+#generate event report, events are processed concurrently and events that already have a report in save_path are skipped
+generator.generate_multi_event(data, n_event_workers = 4, fetch_concurrency = 2, llm_request_concurrency = 16)
 
 #To generate report for your customized BGP anomaly event, you can use generate_single_event function after initializing
 #the BEAR generator
@@ -1,13 +1,10 @@
-import pybgpstream
 from itertools import groupby
 from collections import defaultdict
 import os
-import re
-import numpy as np
 import copy
-import time
+import random
 # if run script in jupyter notebook
-from tqdm.notebook import trange, tqdm
+from tqdm.auto import trange, tqdm
 #if run script in python script
 #from tqdm import trange, tqdm
 import pandas as pd
@@ -16,6 +13,12 @@ from datetime import datetime, timedelta
 
 
 from LLM_Module import LLM_Module
+from BGP_Module import collector_event_ribs, fetch_collectors, _stream
+from RIB_Snapshot import RIB_Snapshot
+from RIB_Store import RIB_Store, store_path
+from Collector_Planner import Collector_Planner
+from Prompt_Builder import Prompt_Builder
+from Event_Classifier import UNKNOWN, majority_vote, parse_event_type
 
 
 class BEAR_few_collector(LLM_Module):
@@ -24,48 +27,81 @@ class BEAR_few_collector(LLM_Module):
     given detected time, IP/Target AS, extract AS paths from history routing table data, BGP messages before event, BGP messages after event
     feed them to llm
     '''
-    def __init__(self, collector_list, model = "gpt-4o", project = "rcc", save_path = "e/", read_path = None, n_collector = 24):
+    def __init__(self, collector_list, model = "gpt-4o", project = "rcc", save_path = "e/", read_path = None, n_collector = 24,
+                 llm_kwargs = None, seed = None, n_workers = 1, executor = "thread", collector_coverage = None,
+                 n_sample = 5, adaptive_vote = True, max_sample = None):
         '''
         initialize llm, collector_list, collector project, saving path and read path
         Args:
-            collector_list: list of collector names where we collect BGP data to write report
+            collector_list: list of collector names where we collect BGP data to write report, repeated collectors are
+                            only used once
             model: backbone llm, default is gpt-4o
             project: which project that the collector we use is coming from. (for bgpstream)
             save_path: directory to save results/reports
             read_path: if provided, we read BGP data from this directory instead of using bgpstream to retrieve BGP data (if we already
                         retrieved relevant BGP data before and saved here)
-            n_collector: Int, number of collectors' data you want to use when generating report.
+            n_collector: Int, number of collectors' data you want to use when generating report. The collectors are sampled
+                         (without repeats) from collector_list before BGP data is read or retrieved, so only their data is used
+            llm_kwargs: optional dict of keyword arguments for LLM_Module (max_retries, timeout, requests_per_minute,
+                        tokens_per_minute, backoff_base, backoff_max, cache_path, cache_size, replay)
+            seed: optional, seed of the collector sampling, the collectors of an event then only depend on the seed and the
+                  event (file_save_prefix). Random if None
+            n_workers: number of collectors retrieved from bgpstream in parallel
+            executor: "thread" or "process", type of worker pool used when n_workers > 1
+            collector_coverage: optional float, if provided the collectors are not sampled but planned by Collector_Planner
+                                from the historical routing tables in read_path: at most n_collector collectors, the most
+                                useful first, until their peers and AS paths toward the target prefix cover this fraction of
+                                those of all collectors
+            n_sample: number of self-consistency samples (AS path change description + event type decision) per report,
+                      with adaptive_vote the number of samples of a full vote
+            adaptive_vote: if True, samples stop once an event type has a majority of n_sample (e.g. 3 of 3 agree) and the
+                           vote is tallied from the event types parsed from the samples instead of by llm requests. If
+                           False, n_sample samples are drawn and the llm votes on them
+            max_sample: maximum number of samples drawn by adaptive_vote when votes split, default n_sample
         '''
-        super().__init__(model=model) #initialize LLM module
+        super().__init__(model=model, **(llm_kwargs or {})) #initialize LLM module
         self.n_collector = n_collector
-        self.collector_list = collector_list
+        self.collector_list = list(dict.fromkeys(collector_list))
         self.model = model
         self.project = project
         self.save_path = save_path #directory to save files
         if not read_path:
             read_path = save_path
         self.read_path = read_path
+        self.seed = seed
+        self.n_workers = n_workers
+        self.executor = executor
+        self.collector_coverage = collector_coverage
+        self.n_sample = n_sample
+        self.adaptive_vote = adaptive_vote
+        self.max_sample = max_sample
+        self.planner = Collector_Planner(self.collector_list, read_paths=[self.read_path]) \
+                       if collector_coverage is not None else None
         os.makedirs(save_path, exist_ok=True)
 
-    def generate_multi_event(self, data_path):
+    def generate_multi_event(self, data_path, n_collectors = None, seeds = None):
         '''
         generate report for each event recorded in data_path
         Args:
             data_path: path to a csv file that records the information for each detected BGP anomaly event
+            n_collectors: optional list of numbers of collectors, if given every event is evaluated with each of them and each
+                          seed (generate_sweep) from one retrieval of BGP data
+            seeds: optional list of seeds of the collector sampling for n_collectors, default [seed]
         '''
         data = pd.read_csv(data_path, na_filter=False)
         N = len(data)
-        for i in trange(N):
-            #note that currently, event 9 and event 20 are the two events that exceeds token limit
-            if i == 9 or i == 20:
-                continue
+        for i in trange(N): #events whose report fails (e.g. data exceeds the llm token limit) are skipped when saving
             event = data.iloc[i]
             start_time = event['Start'].split(';')[0] if event['Start'] else None
             IP = event['IP'].split(';')[0] if event['IP'] else None
             AS = event['AS'].split(';')[0] if event['AS'] else None
             end_time = event['End'].split(';')[0] if event['End'] else None
             event_type = event['Event Type'].split(';')[0] if event['Event Type'] else None
-            self.generate_single_event(start_time=start_time, file_save_prefix=str(i)+"_", IP=IP, AS=AS, end_time=end_time, Event_Type=event_type)
+            if n_collectors:
+                self.generate_sweep(start_time=start_time, file_save_prefix=str(i)+"_", IP=IP, end_time=end_time,
+                                    n_collectors=n_collectors, seeds=seeds, Event_Type=event_type)
+            else:
+                self.generate_single_event(start_time=start_time, file_save_prefix=str(i)+"_", IP=IP, AS=AS, end_time=end_time, Event_Type=event_type)
         return None
             
     def generate_single_event(self, start_time, file_save_prefix="", IP=None, AS=None, end_time=None, Event_Type=None):
@@ -81,44 +117,20 @@ class BEAR_few_collector(LLM_Module):
         '''
         if IP: #all of our experiment assume victim IP available
             '''if IP is provided'''
-            try: #read BGP data from read_path
-                with open(self.read_path + file_save_prefix + "history_rib.json", "r") as f:
-                    history_rib = json.load(f)
-                with open(self.read_path + file_save_prefix + "before_event_rib.json", "r") as f:
-                    rib_before_incident = json.load(f)
-                with open(self.read_path + file_save_prefix + "after_event_rib.json", "r") as f:
-                    rib_after_incident = json.load(f)
-            except: #if BGP data not provided, retrieve them from BGPStream
-                history_rib, rib_before_incident, rib_after_incident = self.AS_Path_IP(start_time=start_time, IP_prefix=IP, end_time = end_time)
-
-            
-            chosed_collectors = random.choices(self.collector_list, k=self.n_collector)
-            rib_before_incident = {i:rib_before_incident[i] for i in chosed_collectors}
-            rib_after_incident = {i:rib_after_incident[i] for i in chosed_collectors}
-            
-            
-            try: #to automatically skip event with data exceeds llm token limit
-                report, report_dict = self.generate_report(history_rib=history_rib,
-                                              rib_before_incident=rib_before_incident,
-                                              rib_after_incident=rib_after_incident,
-                                              time=start_time,
-                                              IP=IP,
-                                             Event_Type=Event_Type)
-                with open(self.save_path + file_save_prefix + "report.txt", "w") as f:
-                    json.dump(report, f) #final report
-                with open(self.save_path + file_save_prefix + "reprot_dict.json", "w") as f:
-                    json.dump(report_dict, f) #includes intermediate results
-            except:
-                return None
+            #choose the collectors first, only their BGP data is read or retrieved
+            chosed_collectors = self.sample_collectors(self.n_collector, self.seed, file_save_prefix, IP=IP)
+            ribs = self.load_event_ribs(start_time, file_save_prefix, IP, chosed_collectors, end_time=end_time)
+            self._generate_and_save(ribs, chosed_collectors, start_time, IP, file_save_prefix, Event_Type=Event_Type)
             
         elif AS: #not using
             '''IP not available but target AS available'''
-            history_rib, rib_before_incident, rib_after_incident = self.AS_Path_AS(start_time=start_time, target_AS=AS, end_time = end_time)
-            report = self.generate_report(history_rib=history_rib,
-                                          rib_before_incident=rib_before_incident,
-                                          rib_after_incident=rib_after_incident,
-                                          time=start_time,
-                                          AS=AS)
+            history_rib, rib_before_incident, rib_after_incident = self.AS_Path_AS(start_time=start_time, target_AS=AS, end_time = end_time,
+                                                                                   collectors=self.sample_collectors(self.n_collector, self.seed, file_save_prefix))
+            self.generate_report(history_rib=history_rib,
+                                 rib_before_incident=rib_before_incident,
+                                 rib_after_incident=rib_after_incident,
+                                 time=start_time,
+                                 AS=AS)
         else:
             raise("Must provide IP or AS")
         ###save routing table and report
@@ -132,9 +144,94 @@ class BEAR_few_collector(LLM_Module):
             
         return None
 
-    def AS_Path_IP(self, start_time, IP_prefix, end_time = None):
+    def generate_sweep(self, start_time, file_save_prefix, IP, end_time = None, n_collectors = (1, 2, 4, 8), seeds = None,
+                       Event_Type = None):
+        '''
+        generate reports of one event with several numbers of collectors and seeds of the collector sampling. BGP data is
+        read or retrieved once for the union of the sampled collectors and every report uses its own sample of it.
+        Reports are saved with the file prefix {file_save_prefix}{n}collector_{seed}seed_
+        Args:
+            n_collectors: list of numbers of collectors
+            seeds: optional list of seeds of the collector sampling, default [seed]
+        Return:
+            {(n collector, seed): report}, None for the reports that could not be generated
+        '''
+        seeds = seeds if seeds is not None else [self.seed]
+        samples = {(n, seed): self.sample_collectors(n, seed, file_save_prefix, IP=IP) for n in n_collectors for seed in seeds}
+        superset = [c for c in dict.fromkeys(self.collector_list) if any(c in sample for sample in samples.values())]
+        ribs = self.load_event_ribs(start_time, file_save_prefix, IP, superset, end_time=end_time)
+        reports = {}
+        for (n, seed), collectors in samples.items():
+            sample_ribs = [{c: rib[c] for c in collectors if c in rib} for rib in ribs]
+            reports[(n, seed)] = self._generate_and_save(sample_ribs, collectors, start_time, IP,
+                                                         f"{file_save_prefix}{n}collector_{seed}seed_", Event_Type=Event_Type)
+        return reports
+
+    def sample_collectors(self, n_collector, seed = None, file_save_prefix = "", IP = None):
+        '''
+        Args:
+            n_collector: number of collectors, all collectors if larger than collector_list
+            seed: optional, seed of the sampling, combined with file_save_prefix so that events get different collectors
+            IP: optional, target IP prefix, used by the collector plan
+        Return:
+            n_collector distinct collectors of collector_list, in the order of collector_list. With collector_coverage, the
+            collectors planned by Collector_Planner instead (at most n_collector, the most useful first, seed is unused)
+        '''
+        if self.planner is not None:
+            return self.planner.plan(IP, coverage=self.collector_coverage, max_collectors=n_collector)["collectors"]
+        collectors = self.collector_list
+        rng = random.Random(f"{seed}:{file_save_prefix}") if seed is not None else random
+        chosen = set(rng.sample(collectors, min(n_collector, len(collectors))))
+        return [c for c in collectors if c in chosen]
+
+    def load_event_ribs(self, start_time, file_save_prefix, IP, collectors, end_time = None):
+        '''
+        read BGP data of the given collectors from read_path (columnar store or json files), or retrieve it from BGPStream
+        Return:
+            history_rib, rib_before_incident, rib_after_incident: {collector name: {IP prefix: {peer: [AS path]}}}
+        '''
+        if not self.read_path: #no stored BGP data
+            return self.AS_Path_IP(start_time=start_time, IP_prefix=IP, end_time=end_time, collectors=collectors)
+        if RIB_Store.exists(store_path(self.read_path, file_save_prefix)): #only the rows of the collectors are read
+            return RIB_Store(store_path(self.read_path, file_save_prefix)).load(collectors=collectors)
+        try: #read BGP data from read_path
+            ribs = []
+            for name in ["history_rib.json", "before_event_rib.json", "after_event_rib.json"]:
+                with open(self.read_path + file_save_prefix + name, "r") as f:
+                    rib = json.load(f)
+                ribs.append({c: rib[c] for c in collectors if c in rib})
+            return ribs
+        except (OSError, ValueError): #if BGP data not provided, retrieve them from BGPStream
+            return self.AS_Path_IP(start_time=start_time, IP_prefix=IP, end_time=end_time, collectors=collectors)
+
+    def _generate_and_save(self, ribs, collectors, start_time, IP, file_save_prefix, Event_Type = None):
+        '''
+        generate the report of an event from the BGP data of the chosen collectors and save it with file_save_prefix
+        Return:
+            report, None if it could not be generated
+        '''
+        history_rib, rib_before_incident, rib_after_incident = ribs
+        try: #to automatically skip event with data exceeds llm token limit
+            report, report_dict = self.generate_report(history_rib=history_rib,
+                                          rib_before_incident=rib_before_incident,
+                                          rib_after_incident=rib_after_incident,
+                                          time=start_time,
+                                          IP=IP,
+                                          Event_Type=Event_Type)
+            report_dict["collectors"] = collectors
+            with open(self.save_path + file_save_prefix + "report.txt", "w") as f:
+                json.dump(report, f) #final report
+            with open(self.save_path + file_save_prefix + "reprot_dict.json", "w") as f:
+                json.dump(report_dict, f) #includes intermediate results
+        except Exception:
+            return None
+        return report
+
+    def AS_Path_IP(self, start_time, IP_prefix, end_time = None, collectors = None):
         '''
         provide target IP and time extract BGP data, end time is optional
+        Args:
+            collectors: optional list of collectors to retrieve, collector_list if None
         '''
         # convert start time to datetime object
         start = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
@@ -144,86 +241,22 @@ class BEAR_few_collector(LLM_Module):
         else: #default 1 day after start
             end = start + timedelta(days=1)
 
+        #history routing table and updates before and after the event of each collector, n_workers collectors at a time
+        collector_ribs = fetch_collectors(collector_event_ribs, collectors or self.collector_list, n_workers=self.n_workers,
+                                          executor=self.executor, progress=tqdm, start=start, end=end,
+                                          bgp_filter=f"prefix any {IP_prefix}")
+        history_rib = RIB_Snapshot({collector: ribs[0] for collector, ribs in collector_ribs.items()})
+        rib_before_incident = history_rib.snapshot({collector: ribs[1] for collector, ribs in collector_ribs.items()})
+        rib_after_incident = rib_before_incident.snapshot({collector: ribs[2] for collector, ribs in collector_ribs.items()})
+        return history_rib.to_dict(), rib_before_incident.to_dict(), rib_after_incident.to_dict()
 
-        ###extract history routing table
-        history_rib = defaultdict(dict)
-        for collector in tqdm(self.collector_list):
-            #rcc collects rib every 8 hours, we pick the 2nd last checkpoint
-            stream = pybgpstream.BGPStream(
-                from_time=str(start-timedelta(hours=16)), until_time=str(start-timedelta(hours=8)),
-                collectors=[collector],
-                record_type="ribs",
-                filter = f"prefix any {IP_prefix}"  #collect as path to ip prefix that are less or more specific to the target IP prefix
-            )
-            as_path = defaultdict(dict)
-
-            for rec in tqdm(stream.records()):
-                for ele in rec:
-                    # Get the peer ASn
-                    peer = str(ele.peer_asn)
-                    hops = [k for k, g in groupby(ele.fields['as-path'].split(" "))]
-                    #print(ele)
-                    if str(ele.type) == "R":
-                        if 'as-path' and "prefix" in ele.fields:
-                            IP = ele.fields["prefix"]
-                            as_path[IP][peer] = hops
-            history_rib[collector] = as_path
-
-        ###extract AS-paths before event
-        rib_before_incident = copy.deepcopy(history_rib)
-        types = {"A", "W"}
-        for collector in tqdm(self.collector_list):
-            stream1 = pybgpstream.BGPStream(
-                from_time=str(start-timedelta(hours=8)), until_time=str(start-timedelta(minutes=10)),
-                collectors=[collector],
-                record_type="updates",
-                filter = f"prefix any {IP_prefix}"
-            )
-            
-            for rec in tqdm(stream1.records()):
-                for elem in rec:
-                    if (str(elem.type) in types) and "prefix" in elem.fields:
-                        IP = str(elem.fields["prefix"])
-                        if str(elem.type) == "A" and "as-path" in elem.fields:
-                            peer = str(elem.peer_asn)
-                            hops = [k for k, g in groupby(elem.fields['as-path'].split(" "))]
-                            rib_before_incident[collector][IP][peer] = hops
-                            
-                        if str(elem.type) == "W":
-                            peer = str(elem.peer_asn)
-                            rib_before_incident[collector][IP][peer] = []
-
-        ###extract AS-paths after event
-        rib_after_incident = copy.deepcopy(rib_before_incident)
-        #collect information until 1min before event end or 10min after event start
-        until = min(end-timedelta(minutes=1), start+timedelta(minutes=10))
-        for collector in tqdm(self.collector_list):
-            stream1 = pybgpstream.BGPStream(
-                from_time=str(start-timedelta(minutes=10)), until_time=str(until),
-                collectors=[collector],
-                record_type="updates",
-                filter = f"prefix any {IP_prefix}"
-            )
-            
-            for rec in tqdm(stream1.records()):
-                for elem in rec:
-                    if (str(elem.type) in types) and "prefix" in elem.fields:
-                        IP = str(elem.fields["prefix"])
-                        if str(elem.type) == "A" and "as-path" in elem.fields:
-                            peer = str(elem.peer_asn)
-                            hops = [k for k, g in groupby(elem.fields['as-path'].split(" "))]
-                            rib_after_incident[collector][IP][peer] = hops
-                            
-                        if str(elem.type) == "W":
-                            peer = str(elem.peer_asn)
-                            rib_after_incident[collector][IP][peer] = []
-
-        return history_rib, rib_before_incident, rib_after_incident
-
-    def AS_Path_AS(self, start_time, target_AS, end_time = None):
+    def AS_Path_AS(self, start_time, target_AS, end_time = None, collectors = None):
         '''
         Missing IP but provide target AS number and time to extract AS paths, end time is optional
+        Args:
+            collectors: optional list of collectors to retrieve (e.g. planned by Collector_Planner), collector_list if None
         '''
+        collectors = collectors or self.collector_list
         # convert start time to datetime object
         start = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
         #convert end time to datetime object
@@ -236,9 +269,9 @@ class BEAR_few_collector(LLM_Module):
         ###extract history routing table
         history_rib = defaultdict(dict)
         target_IP_prefix = set([])
-        for collector in tqdm(self.collector_list):
+        for collector in tqdm(collectors):
             #rcc collects rib every 8 hours, we pick the 2nd last checkpoint
-            stream = pybgpstream.BGPStream(
+            stream = _stream(
                 from_time=str(start-timedelta(hours=16)), until_time=str(start-timedelta(hours=8)),
                 collectors=[collector],
                 record_type="ribs",
@@ -263,11 +296,11 @@ class BEAR_few_collector(LLM_Module):
         rib_before_incident = copy.deepcopy(history_rib)
         types = {"A", "W"}
         #construct filter by target IP prefix
-        filter_string = f"prefix any"
+        filter_string = "prefix any"
         for ip_p in target_IP_prefix:
             filter_string += f" {ip_p}" 
-        for collector in tqdm(self.collector_list):
-            stream1 = pybgpstream.BGPStream(
+        for collector in tqdm(collectors):
+            stream1 = _stream(
                 from_time=str(start-timedelta(hours=8)), until_time=str(start-timedelta(minutes=10)),
                 collectors=[collector],
                 record_type="updates",
@@ -291,8 +324,8 @@ class BEAR_few_collector(LLM_Module):
         rib_after_incident = copy.deepcopy(rib_before_incident)
         #collect information until 1min before event end or 10min after event start
         until = min(end-timedelta(minutes=1), start+timedelta(minutes=10))
-        for collector in tqdm(self.collector_list):
-            stream1 = pybgpstream.BGPStream(
+        for collector in tqdm(collectors):
+            stream1 = _stream(
                 from_time=str(start-timedelta(minutes=10)), until_time=str(until),
                 collectors=[collector],
                 record_type="updates",
@@ -314,6 +347,27 @@ class BEAR_few_collector(LLM_Module):
 
         return history_rib, rib_before_incident, rib_after_incident
 
+    def vote_samples(self, event_type_list, description_list):
+        '''
+        llm vote over the samples, used when no event type can be parsed from them
+        Return:
+            output_event: final event type decision
+            output_change: final description of the AS path changes
+        '''
+        #generate final description and event type prediction that is in accordance with most of the descriptions and event types
+        system_prompt_00 = "Given a list of descriptions of the event type of the same event, identify the event type by choose the \
+                            one in most descriptions. Output the event type and one sentence of explaination."
+        user_prompt_00 = f"List of event type description {event_type_list}."
+        message = self.make_message(user_prompt=user_prompt_00, system_prompt=system_prompt_00)
+        output_event = self.chat(messages=message, model=self.model, label="vote_event_type")[0]
+
+        system_prompt_01 = "Given a list of report of the AS path changes, generate one output report that is in accordance to the most\
+                            report in the given list."
+        user_prompt_01 = f"List of AS path change report {description_list}."
+        message = self.make_message(user_prompt=user_prompt_01, system_prompt=system_prompt_01)
+        output_change = self.chat(messages=message, model=self.model, label="vote_change")[0]
+        return output_event, output_change
+
     def generate_report(self, history_rib, rib_before_incident, rib_after_incident, time, IP="unknown", AS="unkonwn", Event_Type = "unknown"):
         '''
         provide history routing table, routing table before event, routing table after event, event time, IP or AS (must provide one)
@@ -321,13 +375,22 @@ class BEAR_few_collector(LLM_Module):
         First generate N descriptions of changes in AS path before and after the event
         Second give N decisions of the event type based on the descriptions
         Third, use self-consistency machenism with N descriptions and N event type decisions generate final description and final event type
-        prediction
+        prediction (with adaptive_vote, samples stop once an event type has a majority of n_sample, the majority is tallied
+        from the parsed event types and the llm only votes if no event type can be read)
         Finally, generate the report explaining the BGP anomaly event
+        The routing tables are serialized once and sent as the first message of every request on them (Prompt_Builder), a
+        prompt prefix shared by the descriptions and the report
         '''
         if IP != "unknown":
+            prompt = Prompt_Builder.from_ribs(history_rib, rib_before_incident, rib_after_incident)
             event_type_list = [] #save n event type prediction
             description_list = [] #save n descriptions of the AS path changes
-            for i in trange(5): #n=5
+            labels = [] #event types parsed from the event type predictions
+            winner, n_more, votes = majority_vote(labels, self.n_sample, self.max_sample)
+            if not self.adaptive_vote:
+                n_more = self.n_sample
+            i = 0
+            while n_more: #until an event type has a majority of n_sample (n_sample samples without adaptive_vote)
                 #generate description of AS path changes before and after the event
                 system_prompt = "You are an expert in Border Gateway Protocol. Given a set of AS paths to a specific IP prefix, \
                                     describe the changes in these paths before and after a time stamp. Try to answer the following questions:\n \
@@ -337,15 +400,11 @@ class BEAR_few_collector(LLM_Module):
                                     If there is, compare it to the existing path with the same peer, is there any difference? Does the last \
                                     AS (destination) change ot not?"
                 user_prompt = f"{IP} is the target IP prefix. {time} is the time stamp. \n\
-                                Here are the paths to this IP prefix and its sub-prefixes in history: {history_rib} \n \
-                                Here are the paths to this IP prefix and its sub-prefixes before the time stamp: {rib_before_incident}. \n \
-                                Here are the paths after the time stamp: {rib_after_incident}. \n \
-                                All pathes are stored in a dictironary in a form of \
-                                {{collector name: {{IP prefix: {{peer: [AS path from peer to the origin AS of IP prefix]}}}}}}. \
+                                The data above is {prompt.subject}. \
                                 For example, in an AS path '97600:[97600, 12334, 54323, 2134]' 2134 is last and the destination AS.\
                                 Now, describe the AS path changes."
-                message = self.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
-                output_description = self.chat(messages=message, model=self.model)[0]
+                message = prompt.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
+                output_description = self.chat(messages=message, model=self.model, cache_tag=i, label="describe_changes")[0]
     
                 #generate Event type prediction based on the description
                 system_prompt_3 = "A BGP route leak often results in adding unexpected transit ASes without changing the \
@@ -356,22 +415,25 @@ class BEAR_few_collector(LLM_Module):
                                     type of this event. Think step by step. Reply in one sentence.\n"
                 user_prompt_3 = f"Analysis:{output_description}"
                 message = self.make_message(user_prompt=user_prompt_3, system_prompt=system_prompt_3)
-                output_event_type = self.chat(messages=message, model=self.model)[0]
+                output_event_type = self.chat(messages=message, model=self.model, cache_tag=i, label="classify_event_type")[0]
                 event_type_list.append(output_event_type)
                 description_list.append(output_description)
+                labels.append(parse_event_type(output_event_type))
+                i += 1
+                if self.adaptive_vote:
+                    winner, n_more, votes = majority_vote(labels, self.n_sample, self.max_sample)
+                else:
+                    n_more = self.n_sample - i
+                    winner, votes = None, majority_vote(labels, self.n_sample)[2]
 
-            #generate final description and event type prediction that is in accordance with most of the descriptions and event types
-            system_prompt_00 = f"Given a list of descriptions of the event type of the same event, identify the event type by choose the \
-                                one in most descriptions. Output the event type and one sentence of explaination."
-            user_prompt_00 = f"List of event type description {event_type_list}."
-            message = self.make_message(user_prompt=user_prompt_00, system_prompt=system_prompt_00)
-            output_event = self.chat(messages=message, model=self.model)[0]
-
-            system_prompt_01 = f"Given a list of report of the AS path changes, generate one output report that is in accordance to the most\
-                                report in the given list."
-            user_prompt_01 = f"List of AS path change report {description_list}."
-            message = self.make_message(user_prompt=user_prompt_01, system_prompt=system_prompt_01)
-            output_change = self.chat(messages=message, model=self.model)[0]
+            if winner not in (None, UNKNOWN):
+                #tally the vote locally, the first sample of the winning type gives the final event type and description
+                chosen = labels.index(winner)
+                output_event = event_type_list[chosen]
+                output_change = description_list[chosen]
+            else:
+                #no event type could be read from the samples (or adaptive_vote is off), the llm votes on them
+                output_event, output_change = self.vote_samples(event_type_list, description_list)
 
             #Write report
             system_prompt_4 = "You are an expert in BGP network anomaly detection and explaination.\
@@ -388,19 +450,16 @@ class BEAR_few_collector(LLM_Module):
             user_prompt_4 = f"{IP} is the IP prefix we detected has a problem. {time} is the time that we detected the event start.\
                             {output_event} is the description about the event type. \n \
                             {output_change} is the description of the change in AS paths before and after the event. \n \
-                            Here are the paths to this IP prefix in history: {history_rib} \n \
-                            Here are the paths to this IP prefix before the event: {rib_before_incident}. \n \
-                            Here are the paths after the event: {rib_after_incident}. \n \
-                            All pathes are stored in a dictironary in a form of \
-                            {{collector name: {{IP prefix: {{peer: [AS path from peer to IP prefix]}}}}}}. \
+                            The data above is {prompt.subject}, the time stamp is the event start. \
                             Now, write the BGP anomaly event report. List what necessary data is missing"
-            message = self.make_message(user_prompt=user_prompt_4, system_prompt=system_prompt_4)
-            output_report = self.chat(messages=message, model=self.model)[0]
+            message = prompt.make_message(user_prompt=user_prompt_4, system_prompt=system_prompt_4)
+            output_report = self.chat(messages=message, model=self.model, label="report")[0]
             output_dict = {"raw_change": description_list,
                           "raw_event": event_type_list,
                           "final_change": output_change,
                           "final_event": output_event,
-                          "report": output_report}
+                          "report": output_report,
+                          "vote": {"votes": votes, "n_samples": len(labels), "by": "local" if winner not in (None, UNKNOWN) else "llm"}}
             
             
         elif AS != "unknown": #not using
@@ -414,14 +473,13 @@ class BEAR_few_collector(LLM_Module):
                             Then you need to write a report about this event, including time, anomaly type, \
                             related AS number and IP address. If the data provided is not enough for you to write the report, please \
                             explain what data is missing."
+            prompt = Prompt_Builder.from_ribs(history_rib, rib_before_incident, rib_after_incident,
+                                              subject="the paths to the IP prefixes of this AS in history, before the event \
+(time stamp) and after the event")
             user_prompt = f"AS{AS} is the autonomous system we detected has a problem. {time} is the time that we detected the event start.\
-                            Here are the paths to this AS in history: {history_rib} \n \
-                            Here are the paths to this AS before the event: {rib_before_incident}. \n \
-                            Here are the paths after the event: {rib_after_incident}. \n \
-                            All pathes are stored in a dictironary in a form of \
-                            {{collector name: {{IP prefix: {{peer: [AS path from peer to IP prefix]}}}}}}. Now, write the report."
-            message = self.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
-            output_report = self.chat(messages=message, model=self.model)[0]
+                            The data above is {prompt.subject}. Now, write the report."
+            message = prompt.make_message(user_prompt=user_prompt, system_prompt=system_prompt)
+            output_report = self.chat(messages=message, model=self.model, label="report")[0]
         else:
             raise("Must provide at least one IP or AS!")
         return output_report, output_dict
@@ -0,0 +1,395 @@
+'''
+functions that retrieve BGP data of a single collector from BGPStream, and a bounded worker pool that runs them for many
+collectors in parallel. They are module level functions (not methods) so that they can be sent to worker processes.
+Shared_RIB_Dumps reads the rib dumps once for many events that share them.
+'''
+try:
+    import pybgpstream
+except ImportError: #optional when BGP data is read from disk (read_path, BGP cache), required to retrieve it
+    pybgpstream = None
+from itertools import groupby
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+import calendar
+import threading
+import time
+from datetime import datetime, timedelta
+from Prefix_Trie import Prefix_Trie
+
+
+def collector_history_rib(collector, start, bgp_filter):
+    '''
+    extract history routing table of one collector
+    Args:
+        collector: collector name
+        start: datetime, time when the anomaly event starts
+        bgp_filter: bgpstream filter string
+    Return:
+        as_path: {IP prefix: {peer: [AS path]}}
+    '''
+    #rcc collects rib every 8 hours, we pick the 2nd last checkpoint
+    return collector_rib_dump(collector, start-timedelta(hours=16), start-timedelta(hours=8), bgp_filter)
+
+
+def collector_rib_dump(collector, from_time, until_time, bgp_filter):
+    '''
+    read the rib dumps of one collector between from_time and until_time
+    Args:
+        collector: collector name
+        from_time, until_time: datetime, time window of the rib dumps
+        bgp_filter: bgpstream filter string
+    Return:
+        as_path: {IP prefix: {peer: [AS path]}}, the last path of each peer in the window
+    '''
+    stream = _stream(
+        from_time=str(from_time), until_time=str(until_time),
+        collectors=[collector],
+        record_type="ribs",
+        filter = bgp_filter
+    )
+    as_path = defaultdict(dict)
+
+    for ele in _elements(stream):
+        # Get the peer ASn
+        peer = str(ele.peer_asn)
+        if str(ele.type) == "R" and "as-path" in ele.fields and "prefix" in ele.fields:
+            hops = [k for k, g in groupby(ele.fields['as-path'].split(" "))]
+            IP = ele.fields["prefix"]
+            as_path[IP][peer] = hops
+    return as_path
+
+
+def collector_updates(collector, from_time, until_time, bgp_filter, boundary=None):
+    '''
+    read announcements and withdrawals of one collector between from_time and until_time in a single stream, in time order
+    Args:
+        collector: collector name
+        from_time: datetime, start of the update window
+        until_time: datetime, end of the update window
+        bgp_filter: bgpstream filter string
+        boundary: optional datetime, updates before it and updates from it on are returned separately
+    Return:
+        delta_before, delta_after: {IP prefix: {peer: [AS path]}}, last path of each peer before boundary and from boundary
+                                   on, withdrawn paths are []. delta_after is empty if boundary is not given
+    '''
+    types = {"A", "W"}
+    split_time = calendar.timegm(boundary.timetuple()) if boundary else float("inf") #event times are in UTC
+    stream = _stream(
+        from_time=str(from_time), until_time=str(until_time),
+        collectors=[collector],
+        record_type="updates",
+        filter = bgp_filter
+    )
+
+    delta_before = defaultdict(dict)
+    delta_after = defaultdict(dict)
+    for elem in _elements(stream):
+        if (str(elem.type) in types) and "prefix" in elem.fields:
+            delta = delta_before if elem.time < split_time else delta_after
+            IP = str(elem.fields["prefix"])
+            if str(elem.type) == "A" and "as-path" in elem.fields:
+                peer = str(elem.peer_asn)
+                hops = [k for k, g in groupby(elem.fields['as-path'].split(" "))]
+                delta[IP][peer] = hops
+
+            if str(elem.type) == "W":
+                peer = str(elem.peer_asn)
+                delta[IP][peer] = []
+    return delta_before, delta_after
+
+
+def collector_update_list(collector, from_time, until_time, bgp_filter):
+    '''
+    read announcements and withdrawals of one collector between from_time and until_time, every update kept
+    Args:
+        collector: collector name
+        from_time, until_time: datetime, update window
+        bgp_filter: bgpstream filter string
+    Return:
+        updates: list of (time, IP prefix, peer, [AS path]) in time order, withdrawn paths are []
+    '''
+    stream = _stream(
+        from_time=str(from_time), until_time=str(until_time),
+        collectors=[collector],
+        record_type="updates",
+        filter = bgp_filter
+    )
+    return [(elem_time, IP, peer, hops) for elem_time, _, IP, peer, hops in stream_updates(stream)]
+
+
+def stream_updates(stream):
+    '''
+    Args:
+        stream: BGPStream (e.g. of a local MRT file)
+    Return:
+        generator of (time, collector, IP prefix, peer, [AS path]) of the announcements, withdrawals and rib entries of
+        stream, withdrawn paths are []
+    '''
+    for elem in _elements(stream):
+        elem_type = str(elem.type)
+        if elem_type not in {"A", "W", "R"} or "prefix" not in elem.fields:
+            continue
+        if elem_type != "W" and "as-path" not in elem.fields:
+            continue
+        hops = [k for k, g in groupby(elem.fields['as-path'].split(" "))] if elem_type != "W" else []
+        yield elem.time, str(getattr(elem, "collector", "")), str(elem.fields["prefix"]), str(elem.peer_asn), hops
+
+
+def _stream(**kwargs):
+    if pybgpstream is None:
+        raise ImportError("pybgpstream is required to retrieve BGP data, install it or provide read_path")
+    return pybgpstream.BGPStream(**kwargs)
+
+
+#records, elements and approximate bytes read from BGPStream by the current thread, reset by _measured
+_stream_stats = threading.local()
+
+
+def _elements(stream):
+    '''
+    yield every element of every record of stream, counting what is read in _stream_stats. Bytes are approximated by
+    the length of the element fields, BGPStream does not give the size of the raw data
+    '''
+    stats = getattr(_stream_stats, "stats", None)
+    if stats is None:
+        stats = _stream_stats.stats = {"records": 0, "elems": 0, "bytes": 0}
+    for rec in stream.records():
+        stats["records"] += 1
+        for elem in rec:
+            stats["elems"] += 1
+            stats["bytes"] += sum(len(str(value)) for value in elem.fields.values())
+            yield elem
+
+
+def _measured(collector, measured_func, **kwargs):
+    '''
+    run measured_func(collector, **kwargs) in a worker and measure it
+    Return:
+        output of measured_func, {"seconds", "records", "elems", "bytes"} read from BGPStream by measured_func
+    '''
+    _stream_stats.stats = {"records": 0, "elems": 0, "bytes": 0}
+    begin = time.time()
+    try:
+        result = measured_func(collector, **kwargs)
+        return result, dict(_stream_stats.stats, seconds=time.time() - begin)
+    finally:
+        _stream_stats.stats = None
+
+
+def collector_event_ribs(collector, start, end, bgp_filter, history_rib=None):
+    '''
+    extract history routing table and the AS-path updates before event and after event of one collector
+    updates before and after the event are read in one stream over [start-8h, until] and split at start-10min
+    Args:
+        collector: collector name
+        start: datetime, time when the anomaly event starts
+        end: datetime, time when the anomaly event ends
+        bgp_filter: bgpstream filter string
+        history_rib: optional, history routing table of this collector if it is already retrieved
+    Return:
+        history_rib, delta_before, delta_after of this collector, each is {IP prefix: {peer: [AS path]}}. The routing table
+        before event is history_rib updated by delta_before, the table after event is that table updated by delta_after
+    '''
+    if history_rib is None:
+        history_rib = collector_history_rib(collector, start, bgp_filter)
+
+    #collect information until 1min before event end or 10min after event start
+    boundary = start-timedelta(minutes=10)
+    until = min(end-timedelta(minutes=1), start+timedelta(minutes=10))
+    delta_before, delta_after = collector_updates(collector, start-timedelta(hours=8), max(boundary, until), bgp_filter,
+                                                  boundary=boundary)
+    if until < boundary: #after-event window is empty
+        delta_after = {}
+
+    return history_rib, delta_before, delta_after
+
+
+def iter_collectors(func, collector_list, n_workers=1, executor="thread", per_collector_kwargs=None, stats=None, **kwargs):
+    '''
+    run func(collector, **kwargs) for every collector with a bounded pool of workers and yield each result as soon as its
+    collector is done, so the caller can process early collectors while slow ones are still streaming. At most n_workers
+    collectors are submitted at a time, so results that are not consumed yet do not pile up in memory.
+    Args:
+        func: module level function whose first argument is the collector name
+        collector_list: list of collector names, repeated collectors are only fetched once
+        n_workers: int, maximum number of collectors retrieved at the same time, 1 means retrieve one by one
+        executor: "thread" or "process", type of the worker pool
+        per_collector_kwargs: optional, {collector: dict of extra keyword arguments for this collector}
+        stats: optional dict, filled with {collector: {"seconds", "records", "elems", "bytes"}} read from BGPStream, the
+               stats of a collector are set before it is yielded
+        kwargs: keyword arguments shared by all collectors
+    Return:
+        generator of (collector, output of func), in the order the collectors finish
+    '''
+    collectors = list(dict.fromkeys(collector_list))
+    per_collector_kwargs = per_collector_kwargs or {}
+    if stats is not None: #measure func in the worker, it returns (output of func, stats)
+        for collector, (result, collector_stats) in iter_collectors(_measured, collectors, n_workers=n_workers,
+                                                                     executor=executor,
+                                                                     per_collector_kwargs=per_collector_kwargs,
+                                                                     measured_func=func, **kwargs):
+            stats[collector] = collector_stats
+            yield collector, result
+        return
+    if n_workers <= 1: #retrieve collectors one by one in this process
+        for collector in collectors:
+            yield collector, func(collector, **kwargs, **per_collector_kwargs.get(collector, {}))
+        return
+    if executor == "process":
+        pool_class = ProcessPoolExecutor
+    elif executor == "thread":
+        pool_class = ThreadPoolExecutor
+    else:
+        raise ValueError(f"executor must be 'thread' or 'process', got {executor}")
+    pending = iter(collectors)
+    with pool_class(max_workers=max(1, min(n_workers, len(collectors)))) as pool:
+        futures = {}
+        for collector in pending:
+            futures[pool.submit(func, collector, **kwargs, **per_collector_kwargs.get(collector, {}))] = collector
+            if len(futures) >= n_workers:
+                break
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                collector = futures.pop(future)
+                for next_collector in pending: #keep n_workers collectors running
+                    futures[pool.submit(func, next_collector, **kwargs,
+                                        **per_collector_kwargs.get(next_collector, {}))] = next_collector
+                    break
+                yield collector, future.result()
+
+
+def fetch_collectors(func, collector_list, n_workers=1, executor="thread", progress=None, per_collector_kwargs=None,
+                     stats=None, **kwargs):
+    '''
+    run func(collector, **kwargs) for every collector with a bounded pool of workers and wait for all of them
+    Args:
+        func: module level function whose first argument is the collector name
+        collector_list: list of collector names, repeated collectors are only fetched once
+        n_workers: int, maximum number of collectors retrieved at the same time, 1 means retrieve one by one
+        executor: "thread" or "process", type of the worker pool
+        progress: optional, wrapper for progress bar (e.g. tqdm), called as progress(iterable, total=...)
+        per_collector_kwargs: optional, {collector: dict of extra keyword arguments for this collector}
+        stats: optional dict, filled with {collector: {"seconds", "records", "elems", "bytes"}} read from BGPStream
+        kwargs: keyword arguments shared by all collectors
+    Return:
+        results: {collector: output of func}, in the order of collector_list
+    '''
+    collectors = list(dict.fromkeys(collector_list))
+    if progress is None:
+        progress = lambda iterable, total=None: iterable
+    results = dict(progress(iter_collectors(func, collectors, n_workers=n_workers, executor=executor,
+                                            per_collector_kwargs=per_collector_kwargs, stats=stats, **kwargs),
+                            total=len(collectors)))
+    return {collector: results[collector] for collector in collectors}
+
+
+class Shared_RIB_Dumps():
+    '''
+    history routing tables of many events, read once per rib dump slot. Events whose history window
+    [start-16h, start-8h] holds the same rib dumps are grouped, the dumps of each collector are read once with a filter
+    on the prefixes of all events of the group, and every event gets the entries that overlap its own prefix.
+    Only the collectors registered by the events of a slot (e.g. planned by Collector_Planner) are read.
+    The dumps of a slot are read by the first event that needs them (the others wait for it) and dropped once every
+    event of the slot got its entries or released its registration.
+    '''
+    def __init__(self, collector_list, n_workers=1, executor="thread", rib_interval=timedelta(hours=8)):
+        '''
+        Args:
+            collector_list: list of collector names
+            n_workers: int, maximum number of collectors retrieved at the same time
+            executor: "thread" or "process", type of the worker pool
+            rib_interval: timedelta, time between two rib dumps of a collector (8 hours for ris)
+        '''
+        self.collector_list = list(dict.fromkeys(collector_list))
+        self.n_workers = n_workers
+        self.executor = executor
+        self.rib_interval = rib_interval
+        self.slots = {} #(first dump, last dump) -> {"prefixes": {IP: events left}, "collectors": {collector: None},
+                        #                             "future": Future of the dumps}
+        self.lock = threading.Lock()
+
+    def slot(self, start):
+        '''
+        Args:
+            start: datetime, time when the event starts
+        Return:
+            (first dump time, last dump time) in the history window of the event, the window itself if it has no dump
+        '''
+        from_time, until_time = start-timedelta(hours=16), start-timedelta(hours=8)
+        interval = int(self.rib_interval.total_seconds())
+        first = -(-calendar.timegm(from_time.timetuple()) // interval) * interval
+        last = calendar.timegm(until_time.timetuple()) // interval * interval
+        if first > last:
+            return from_time, until_time
+        epoch = datetime(1970, 1, 1)
+        return epoch + timedelta(seconds=first), epoch + timedelta(seconds=last)
+
+    def register(self, start, IP, collectors = None):
+        '''
+        add an event before its history routing table is requested, so its prefix is in the filter of its slot
+        Args:
+            start: datetime, time when the event starts
+            IP: IP prefix of the event
+            collectors: optional, collectors the event retrieves, collector_list if None
+        '''
+        with self.lock:
+            slot = self.slots.setdefault(self.slot(start), {"prefixes": {}, "collectors": {}, "future": None})
+            if slot["future"] is not None:
+                return #the dumps of this slot are already read, the event retrieves its own history routing table
+            slot["prefixes"][IP] = slot["prefixes"].get(IP, 0) + 1
+            slot["collectors"].update(dict.fromkeys(collectors if collectors is not None else self.collector_list))
+
+    def release(self, start, IP):
+        '''
+        remove a registered event that does not request its history routing table (e.g. its BGP data is all in the
+        BGP cache), the dumps of its slot are dropped once no other event needs them
+        '''
+        key = self.slot(start)
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None or slot["prefixes"].get(IP, 0) <= 0:
+                return
+            self._done(key, slot, IP)
+
+    def _done(self, key, slot, IP):
+        slot["prefixes"][IP] -= 1
+        if not any(slot["prefixes"].values()): #every event of the slot got its entries
+            self.slots.pop(key, None)
+
+    def history_ribs(self, start, IP):
+        '''
+        Args:
+            start: datetime, time when the event starts
+            IP: IP prefix of the event
+        Return:
+            {collector: {IP prefix: {peer: [AS path]}}}, history routing table of each collector read for the slot for
+            prefixes that overlap IP, or None if the event was not registered
+        '''
+        key = self.slot(start)
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None or slot["prefixes"].get(IP, 0) <= 0:
+                return None
+            owner = slot["future"] is None
+            if owner:
+                slot["future"] = Future()
+        if owner: #read the dumps of this slot for all events
+            try:
+                collectors = [c for c in self.collector_list if c in slot["collectors"]]
+                dumps = fetch_collectors(collector_rib_dump, collectors, n_workers=self.n_workers,
+                                         executor=self.executor, from_time=key[0], until_time=key[1],
+                                         bgp_filter="prefix any " + " ".join(slot["prefixes"]))
+                #one index of the prefixes of all dumps, every event looks up the prefixes that overlap its own
+                trie = Prefix_Trie(prefix for rib in dumps.values() for prefix in rib)
+                slot["future"].set_result((dumps, trie))
+            except Exception as e:
+                slot["future"].set_exception(e)
+        try:
+            dumps, trie = slot["future"].result()
+        finally:
+            with self.lock:
+                self._done(key, slot, IP)
+        prefixes = trie.overlapping(IP)
+        return {collector: {prefix: dict(rib[prefix]) for prefix in prefixes if prefix in rib}
+                for collector, rib in dumps.items()}
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import atexit
+import weakref
+import hashlib
+import threading
+import ipaddress
+from Prefix_Trie import Prefix_Trie
+
+
+class Disk_Cache():
+    '''
+    a persistent key-value cache on disk with a size limit and least-recently-used eviction.
+    Each value is saved as one json file named by the hash of its key, an index file records key, size and last access time
+    of every entry. Access times of cache hits are kept in memory and written with the index on the next put, at most every
+    flush_interval seconds, on flush/close and at exit, so reads do not write to disk.
+    '''
+    def __init__(self, cache_path, max_bytes = 2*1024**3, flush_interval = 60):
+        '''
+        initialize the cache directory and load its index
+        Args:
+            cache_path: directory to save cached entries
+            max_bytes: int, maximum total size of the cached entries, least recently used entries are removed beyond it
+            flush_interval: seconds, maximum time the access times of cache hits are only kept in memory
+        '''
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.dirty = False #index in memory has changes that are not saved
+        self.saved_at = time.time()
+        os.makedirs(cache_path, exist_ok=True)
+        self.index_file = os.path.join(cache_path, "index.json")
+        try:
+            with open(self.index_file, "r") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError): #new cache or broken index
+            self.index = {}
+        _open_caches.add(self)
+
+    def make_key(self, key):
+        '''
+        Args:
+            key: json serializable key
+        Return:
+            hash of the key, used as the name of the entry file
+        '''
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key, default=None):
+        '''
+        Args:
+            key: json serializable key
+            default: value returned if key is not cached
+        Return:
+            cached value of key or default
+        '''
+        return self.get_hashed(self.make_key(key), default)
+
+    def get_hashed(self, hashed_key, default=None):
+        '''
+        same as get, with the hashed key
+        '''
+        value = self.peek_hashed(hashed_key)
+        if value is None:
+            return default
+        with self.lock:
+            if hashed_key in self.index:
+                self.index[hashed_key]["last_access"] = time.time()
+                self.dirty = True
+            if time.time() - self.saved_at >= self.flush_interval:
+                self._save_index()
+        return value
+
+    def peek_hashed(self, hashed_key, default=None):
+        '''
+        same as get_hashed without updating the access time of the entry, so the read does not change the eviction order
+        '''
+        if hashed_key not in self.index:
+            return default
+        #entry files are replaced atomically, so they are read without the lock
+        try:
+            with open(os.path.join(self.cache_path, hashed_key + ".json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError): #entry file is missing (e.g. evicted meanwhile) or broken
+            with self.lock:
+                if self.index.pop(hashed_key, None) is not None:
+                    self.dirty = True
+            return default
+
+    def put(self, key, value):
+        '''
+        save value of key and evict least recently used entries if the cache exceeds max_bytes
+        Args:
+            key: json serializable key
+            value: json serializable value
+        '''
+        hashed_key = self.make_key(key)
+        data = json.dumps(value)
+        with self.lock:
+            entry_file = os.path.join(self.cache_path, hashed_key + ".json")
+            with open(entry_file + ".tmp", "w") as f:
+                f.write(data)
+            os.replace(entry_file + ".tmp", entry_file)
+            self.index[hashed_key] = {"key": key, "size": len(data), "last_access": time.time()}
+            self._evict()
+            self._save_index()
+
+    def flush(self):
+        '''
+        save the index if it has changes that are not saved (access times of cache hits)
+        '''
+        with self.lock:
+            if self.dirty:
+                self._save_index()
+
+    def close(self):
+        '''
+        save the index, the cache can still be used afterwards
+        '''
+        self.flush()
+
+    def entries(self):
+        '''
+        Return:
+            list of (hashed key, key) of all cached entries
+        '''
+        with self.lock:
+            return [(hashed_key, entry["key"]) for hashed_key, entry in self.index.items()]
+
+    def size(self):
+        '''
+        Return:
+            total size in bytes of the cached entries
+        '''
+        return sum(entry["size"] for entry in self.index.values())
+
+    def _evict(self):
+        '''
+        remove least recently used entries until the cache fits in max_bytes
+        '''
+        total = self.size()
+        for hashed_key in sorted(self.index, key=lambda k: self.index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            total -= self.index[hashed_key]["size"]
+            del self.index[hashed_key]
+            try:
+                os.remove(os.path.join(self.cache_path, hashed_key + ".json"))
+            except OSError:
+                pass
+
+    def _save_index(self):
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_file + ".tmp", self.index_file)
+        self.dirty = False
+        self.saved_at = time.time()
+
+
+#caches whose unsaved access times are written at exit
+_open_caches = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_caches():
+    for cache in list(_open_caches):
+        cache.flush()
+
+
+class BGP_Cache(Disk_Cache):
+    '''
+    cache of BGP data retrieved from BGPStream for one collector, keyed by (collector, bgpstream filter, time window).
+    A request with filter "prefix any X" can also be served by a cached entry of the same collector and time window whose
+    filter is "prefix any Y" with Y covering X, since every prefix more or less specific than X is then in that entry.
+    The time window must be the same: the deltas are stored as the last path of each peer, without the time of the
+    updates, so the data of a window contained in a cached one (or the history rib at another time) cannot be rebuilt.
+    '''
+    def get_ribs(self, collector, bgp_filter, window):
+        '''
+        Args:
+            collector: collector name
+            bgp_filter: bgpstream filter string
+            window: list of str, times that define the retrieval window (e.g. event start time and end time)
+        Return:
+            cached BGP data of this collector ([history_rib, delta_before, delta_after]) or None, only from entries of
+            exactly the same window
+        '''
+        key = [collector, bgp_filter, window]
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        #look for an entry with a covering prefix filter in the same window
+        prefixes = filter_prefixes(bgp_filter)
+        if not prefixes:
+            return None
+        for hashed_key, cached_key in self.entries():
+            if cached_key[0] != collector or cached_key[2] != window:
+                continue
+            cached_prefixes = filter_prefixes(cached_key[1])
+            if cached_prefixes and all(any(_covers(c, p) for c in cached_prefixes) for p in prefixes):
+                value = self.get_hashed(hashed_key)
+                if value is not None:
+                    trie = Prefix_Trie(str(p) for p in prefixes)
+                    return [{IP: peers for IP, peers in rib.items() if trie.overlaps(IP)} for rib in value]
+        return None
+
+    def put_ribs(self, collector, bgp_filter, window, ribs):
+        '''
+        Args:
+            collector: collector name
+            bgp_filter: bgpstream filter string
+            window: list of str, times that define the retrieval window
+            ribs: BGP data of this collector, list of {IP prefix: {peer: [AS path]}}
+        '''
+        self.put([collector, bgp_filter, window], [{IP: dict(peers) for IP, peers in rib.items()} for rib in ribs])
+
+
+def filter_prefixes(bgp_filter):
+    '''
+    Args:
+        bgp_filter: bgpstream filter string
+    Return:
+        list of ip_network in a "prefix any ..." filter, empty if the filter is of another form
+    '''
+    terms = bgp_filter.split()
+    if len(terms) < 3 or terms[:2] != ["prefix", "any"]:
+        return []
+    try:
+        return [ipaddress.ip_network(p, strict=False) for p in terms[2:]]
+    except ValueError:
+        return []
+
+
+def _covers(cover, prefix):
+    return cover.version == prefix.version and prefix.subnet_of(cover)
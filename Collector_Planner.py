@@ -0,0 +1,154 @@
+import os
+import json
+import threading
+from Prefix_Trie import Prefix_Trie
+from RIB_Store import RIB_Store
+
+
+class Collector_Planner():
+    '''
+    choose the collectors to retrieve for an event from historical routing tables that are already on disk (the BGP
+    cache and the routing tables of events saved in read paths). Every collector is scored by the evidence it sees
+    toward the target prefix: its peers, the AS links of their paths and the origin ASes. Collectors are picked greedily
+    by the evidence they add to the ones already picked (set cover) until a fraction coverage of the evidence of all
+    collectors is seen, so collectors that peer with the same ASes as others are not streamed.
+    '''
+    def __init__(self, collector_list, bgp_cache = None, read_paths = (), include_unscored = True):
+        '''
+        Args:
+            collector_list: list of collector names, repeated collectors are only planned once
+            bgp_cache: optional BGP_Cache, the history routing tables of its entries are used
+            read_paths: directories with routing tables of events ({i}_history_rib.json or {i}_ribs/ columnar stores)
+            include_unscored: if True, collectors without any historical routing table are always retrieved, since their
+                              evidence is unknown
+        '''
+        self.collector_list = list(dict.fromkeys(collector_list))
+        self.bgp_cache = bgp_cache
+        self.read_paths = [path for path in read_paths if path]
+        self.include_unscored = include_unscored
+        self.units = {c: {} for c in self.collector_list} #collector -> {IP prefix: set of evidence units of its paths}
+        self.seen = set() #collectors with any historical routing table, even an empty one
+        self.sources = set() #cache entries and files already read
+        self.trie = Prefix_Trie()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        '''
+        read the historical routing tables added to the BGP cache and read paths since the last call. Cache entries are
+        read without updating their access time, so planning does not change the eviction order of the cache, and only
+        the evidence of the paths is kept
+        '''
+        with self.lock:
+            if self.bgp_cache is not None:
+                for hashed_key, key in self.bgp_cache.entries():
+                    if hashed_key in self.sources or key[0] not in self.units:
+                        continue
+                    value = self.bgp_cache.peek_hashed(hashed_key)
+                    self.sources.add(hashed_key)
+                    if value is not None:
+                        self._add({key[0]: value[0]})
+            for path in self.read_paths:
+                for name in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+                    source = os.path.join(path, name)
+                    if source in self.sources:
+                        continue
+                    if name.endswith("history_rib.json"):
+                        self.sources.add(source)
+                        try:
+                            with open(source, "r") as f:
+                                self._add(json.load(f))
+                        except (OSError, ValueError):
+                            pass
+                    elif name.endswith("ribs") and RIB_Store.exists(source):
+                        self.sources.add(source)
+                        self._add(RIB_Store(source).path_tables(collectors=self.collector_list)[0].to_dict())
+        return None
+
+    def _add(self, history_rib):
+        for collector, rib in history_rib.items():
+            if collector not in self.units:
+                continue
+            self.seen.add(collector)
+            for IP, peers in rib.items():
+                units = self.units[collector].setdefault(IP, set())
+                for peer, path in peers.items():
+                    if not path:
+                        continue
+                    units.add(("peer", peer))
+                    units.add(("origin", path[-1]))
+                    units.update(("link", a, b) for a, b in zip(path, path[1:]) if a != b)
+                self.trie.insert(IP)
+
+    def evidence(self, IP = None):
+        '''
+        Args:
+            IP: optional, target IP prefix. Only prefixes that overlap it are used, all prefixes if None or if no
+                historical routing table has one
+        Return:
+            evidence: {collector: set of ("peer", peer), ("link", AS, AS) and ("origin", AS)} of the scored collectors.
+                      With scope "prefix", a collector is scored only if its historical routing tables have a prefix
+                      that overlaps IP, otherwise its evidence toward IP is unknown
+            scope: "prefix" if the evidence is toward IP, "all" otherwise
+        '''
+        prefixes = set(self.trie.overlapping(IP)) if IP else set()
+        scope = "prefix" if prefixes else "all"
+        evidence = {}
+        for collector in self.collector_list:
+            if collector not in self.seen:
+                continue
+            if scope == "prefix":
+                collector_units = [self.units[collector][prefix] for prefix in prefixes if prefix in self.units[collector]]
+                if not collector_units: #only seen for other prefixes
+                    continue
+            else:
+                collector_units = self.units[collector].values()
+            evidence[collector] = set().union(*collector_units)
+        return evidence, scope
+
+    def plan(self, IP = None, coverage = 0.95, max_collectors = None):
+        '''
+        Args:
+            IP: optional, target IP prefix
+            coverage: float, fraction of the evidence of all scored collectors that the chosen collectors must see
+            max_collectors: optional, maximum number of collectors chosen. With include_unscored, slots are kept for the
+                            unscored collectors, but at least one scored collector is chosen, so if there are more
+                            unscored collectors than free slots only the first ones (in collector_list order) are chosen
+        Return:
+            plan: dict with
+                collectors: chosen collectors, the most useful first (then the unscored ones if included)
+                coverage: fraction of the evidence seen by the chosen scored collectors
+                gain: {collector: evidence it adds to the collectors chosen before it}
+                unscored: collectors without historical routing table toward IP (see evidence)
+                scope: "prefix", "all", or None if no scored collector has a path (then every collector is chosen)
+        '''
+        self.refresh()
+        with self.lock:
+            evidence, scope = self.evidence(IP)
+        unscored = [c for c in self.collector_list if c not in evidence]
+        if not any(evidence.values()): #no path known, retrieve everything
+            collectors = self.collector_list[:max_collectors] if max_collectors else list(self.collector_list)
+            return {"collectors": collectors, "coverage": None, "gain": {}, "unscored": unscored, "scope": None}
+        total = set().union(*evidence.values())
+        covered = set()
+        chosen = []
+        gain = {}
+        limit = min(len(evidence), max_collectors or len(evidence))
+        if max_collectors and self.include_unscored: #keep slots for the unscored collectors
+            limit = min(limit, max(1, max_collectors - len(unscored)))
+        while len(chosen) < limit and len(covered) < coverage * len(total):
+            #most new evidence first, ties in the order of collector_list
+            best = max((c for c in evidence if c not in gain), key=lambda c: len(evidence[c] - covered))
+            new = len(evidence[best] - covered)
+            if new == 0:
+                break
+            chosen.append(best)
+            gain[best] = new
+            covered |= evidence[best]
+        collectors = chosen + (unscored if self.include_unscored else [])
+        if max_collectors:
+            collectors = collectors[:max_collectors]
+        return {"collectors": collectors,
+                "coverage": round(len(covered) / len(total), 4),
+                "gain": gain,
+                "unscored": unscored,
+                "scope": scope}
@@ -0,0 +1,173 @@
+import re
+from collections import Counter
+
+
+#event types decided by classify_event
+HIJACK = "hijack"
+LEAK = "route leak"
+UNKNOWN = "unknown"
+
+#mentions of an event type in an llm answer, and the words that rule out the types after them up to the end of the
+#clause ("not a hijack", "rather than a hijack or a leak")
+_TYPE_PATTERN = re.compile(r"\b(hijack|leak)")
+_NEGATION_PATTERN = re.compile(r"\b(?:not|no|neither|nor|rather than|instead of|isn't|unlikely|rule out|ruled out)\b"
+                               r"([^,.;:!?]*?)(?=\bbut\b|[,.;:!?]|$)")
+
+
+def classify_event(path_diff, min_peers = 3):
+    '''
+    rule-based event type decision from the AS path changes before and after the event:
+    a change of the destination (origin) AS, also in a new sub-prefix, means hijack, and transit ASes only inserted into
+    the path with the same destination AS mean route leak. Peers are counted as votes for each type. Peers rerouted
+    through other ASes (ASes replaced, not only inserted) are ambiguous and counted as reroutes without voting.
+    Args:
+        path_diff: output of Path_Diff.diff_ribs
+        min_peers: int, number of peers that must show a change to be fully confident
+    Return:
+        decision: dict with
+            event_type: "hijack", "route leak" or "unknown"
+            confidence: float in [0, 1], share of the votes for event_type, lowered if fewer than min_peers voted
+            votes: {"hijack": number of peers, "route leak": number of peers}
+            reroutes: number of peers rerouted through new ASes that do not vote
+            evidence: list of the changes that voted for event_type with their number of peers, most peers first
+    '''
+    votes = {HIJACK: 0, LEAK: 0}
+    evidence = {HIJACK: {}, LEAK: {}} #change -> number of peers
+    for change in path_diff["origin_changes"]:
+        votes[HIJACK] += len(change["peers"])
+        _add_evidence(evidence[HIJACK], f"{change['prefix']}: origin AS{'/'.join(change['before_origin'])} -> "
+                                        f"AS{change['after_origin']}", len(change["peers"]))
+    for change in path_diff["new_more_specifics"]:
+        new_origins = [AS for AS in change["origins"] if AS not in change["covering_origin"]]
+        if change["covering_prefix"] is None or not new_origins:
+            continue #new prefix without a covering prefix, or announced by the same origin (e.g. traffic engineering)
+        n_peers = sum(len(route["peers"]) for route in change["routes"] if route["path"][-1] in new_origins)
+        votes[HIJACK] += n_peers
+        _add_evidence(evidence[HIJACK], f"{change['prefix']} (sub-prefix of {change['covering_prefix']} of "
+                                        f"AS{'/'.join(change['covering_origin'])}): origin AS{'/'.join(new_origins)}", n_peers)
+    for change in path_diff["new_transit"]:
+        votes[LEAK] += len(change["peers"])
+        _add_evidence(evidence[LEAK], f"{change['prefix']}: transit AS{', AS'.join(change['inserted'])} inserted before "
+                                      f"origin AS{change['origin']}", len(change["peers"]))
+
+    reroutes = sum(len(change["peers"]) for change in path_diff["path_changes"] if _rerouted(change))
+
+    total = votes[HIJACK] + votes[LEAK]
+    if total == 0:
+        return {"event_type": UNKNOWN, "confidence": 0.0, "votes": votes, "reroutes": reroutes, "evidence": []}
+    event_type = HIJACK if votes[HIJACK] >= votes[LEAK] else LEAK
+    confidence = votes[event_type] / total * min(1.0, votes[event_type] / max(1, min_peers))
+    evidence = [f"{change} ({n_peers} peers)" for change, n_peers in
+                sorted(evidence[event_type].items(), key=lambda item: -item[1])]
+    return {"event_type": event_type, "confidence": round(confidence, 3), "votes": votes, "reroutes": reroutes,
+            "evidence": evidence}
+
+
+def _rerouted(change):
+    #other path changes through ASes that were not in the path before, e.g. A B C -> A D C (not new announcements)
+    return bool(change["before_path"]) and any(AS not in change["before_path"] for AS in change["after_path"][:-1])
+
+
+def _add_evidence(evidence, change, n_peers):
+    evidence[change] = evidence.get(change, 0) + n_peers
+
+
+def describe_decision(decision, max_evidence = 5):
+    '''
+    Return:
+        one sentence explaining the rule-based decision, in place of the llm event type decision
+    '''
+    evidence = "; ".join(decision["evidence"][:max_evidence])
+    if len(decision["evidence"]) > max_evidence:
+        evidence += f"; and {len(decision['evidence']) - max_evidence} more"
+    if decision["event_type"] == HIJACK:
+        reason = "the destination (origin) AS of the paths changed"
+    elif decision["event_type"] == LEAK:
+        reason = "unexpected transit ASes were inserted into the paths without changing the destination AS"
+    else:
+        return "The event type could not be decided from the AS path changes."
+    return f"The event is a BGP {decision['event_type']} (confidence {decision['confidence']}): {reason} for " \
+           f"{decision['votes'][decision['event_type']]} peers ({evidence})."
+
+
+def describe_diff(path_diff, max_items = 10):
+    '''
+    Return:
+        text description of the AS path changes, in place of the llm descriptions when the event type is clear
+    '''
+    counts = path_diff["counts"]
+    lines = [f"{counts.get('changed', 0)} of {counts['peers']} peer paths to {path_diff['target_prefix']} and its sub-prefixes "
+             f"changed after the time stamp."]
+    for change in path_diff["origin_changes"][:max_items]:
+        lines.append(f"The destination AS of {change['prefix']} changed from AS{'/'.join(change['before_origin'])} to "
+                     f"AS{change['after_origin']} for {len(change['peers'])} peers: {change['before_path']} -> "
+                     f"{change['after_path']}.")
+    for change in path_diff["new_more_specifics"][:max_items]:
+        covering = f"sub-prefix of {change['covering_prefix']} (destination AS{'/'.join(change['covering_origin'])})" \
+                   if change["covering_prefix"] else "prefix without a covering prefix"
+        lines.append(f"New {covering} {change['prefix']} with destination AS{'/'.join(change['origins'])}, seen by "
+                     f"{sum(len(route['peers']) for route in change['routes'])} peers, e.g. {change['routes'][0]['path']}.")
+    for change in path_diff["new_transit"][:max_items]:
+        lines.append(f"The path to {change['prefix']} keeps destination AS{change['origin']} but goes through new transit "
+                     f"AS{', AS'.join(change['inserted'])} for {len(change['peers'])} peers: {change['before_path']} -> "
+                     f"{change['after_path']}.")
+    for change in path_diff["withdrawals"][:max_items]:
+        lines.append(f"The path {change['before_path']} to {change['prefix']} was withdrawn for {len(change['peers'])} peers.")
+    n_more = sum(max(0, len(path_diff[kind]) - max_items)
+                 for kind in ("origin_changes", "new_more_specifics", "new_transit", "withdrawals"))
+    if n_more:
+        lines.append(f"{n_more} more changes of the same kinds are not listed.")
+    n_rerouted = sum(len(change["peers"]) for change in path_diff["path_changes"] if _rerouted(change))
+    n_other = sum(len(change["peers"]) for change in path_diff["path_changes"]) - n_rerouted
+    if n_rerouted:
+        lines.append(f"{n_rerouted} other peers were rerouted through other ASes without changing the destination AS.")
+    if n_other:
+        lines.append(f"{n_other} other peers changed their path without changing the destination AS or adding new ASes.")
+    return "\n".join(lines)
+
+
+def parse_event_type(text):
+    '''
+    read the event type from an llm event type decision
+    Args:
+        text: str, answer of the event type decision (e.g. "The event is a BGP route leak, not a hijack, because ...")
+    Return:
+        "hijack", "route leak" or "unknown" (no type, or both types without a negation telling them apart)
+    '''
+    text = text.lower()
+    negated = {_event_type(word) for clause in _NEGATION_PATTERN.finditer(text)
+               for word in _TYPE_PATTERN.findall(clause.group(1))}
+    mentioned = [_event_type(word) for word in _TYPE_PATTERN.findall(text)]
+    candidates = list(dict.fromkeys(event_type for event_type in mentioned if event_type not in negated))
+    return candidates[0] if len(candidates) == 1 else UNKNOWN
+
+
+def _event_type(word):
+    return HIJACK if word.startswith("hijack") else LEAK
+
+
+def majority_vote(labels, n_sample, max_sample = None):
+    '''
+    early-stopping self-consistency vote: the vote is decided once a type has a majority of n_sample samples
+    (n_sample // 2 + 1), so the remaining samples of the n_sample could not change it. When votes split, more samples
+    are drawn until a type has this majority or max_sample samples are drawn, then the type with most votes wins.
+    Args:
+        labels: event types of the samples drawn so far (parse_event_type), in order of drawing
+        n_sample: number of samples of a full vote
+        max_sample: maximum number of samples drawn when votes split, default n_sample
+    Return:
+        winner: type of the decided vote ("unknown" if no sample has a type), None if more samples are needed
+        n_more: number of samples to draw next, 0 once the vote is decided
+        votes: {event type: number of samples}
+    '''
+    need = n_sample // 2 + 1
+    max_sample = max(max_sample or n_sample, n_sample)
+    votes = Counter(label for label in labels if label != UNKNOWN)
+    #most votes first, ties in the order the types were first drawn
+    leader = max(votes, key=lambda label: (votes[label], -labels.index(label))) if votes else UNKNOWN
+    lead = votes[leader] if votes else 0
+    remaining = max_sample - len(labels)
+    if lead >= need or remaining <= 0 or lead + remaining < need:
+        return leader, 0, dict(votes)
+    #draw only as many samples as the leader still misses, they are all needed if it gets every one
+    return None, min(remaining, need - lead), dict(votes)
@@ -0,0 +1,174 @@
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+#metrics of the event processed in the current thread (or coroutine), None if metrics are not recorded
+current_metrics = contextvars.ContextVar("current_metrics", default=None)
+
+BGP_FIELDS = ["seconds", "records", "elems", "bytes"]
+LLM_FIELDS = ["seconds", "prompt_tokens", "cached_prompt_tokens", "completion_tokens", "retries"]
+
+
+class Event_Metrics():
+    '''
+    timing and volume of the work done for one event: wall time of each stage, BGP data read from BGPStream per
+    collector (time, records, elements and approximate bytes) and every llm request (latency, tokens and retries).
+    LLM_Module and BEAR record into the metrics of the current event (current_metrics), so the same code runs with or
+    without metrics. Recording is thread-safe, llm requests of one event run in several threads.
+    '''
+    def __init__(self, event):
+        '''
+        Args:
+            event: name of the event, e.g. its file_save_prefix
+        '''
+        self.event = event
+        self.begin = time.time()
+        self.end = None
+        self.stages = {}
+        self.collectors = {}
+        self.llm_calls = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        '''
+        make these metrics the metrics of the current event while the block runs
+        '''
+        token = current_metrics.set(self)
+        try:
+            yield self
+        finally:
+            current_metrics.reset(token)
+            self.end = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        add the wall time of the block to stage name
+        '''
+        begin = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + time.time() - begin
+
+    def add_collector(self, collector, stats = None, cached = False):
+        '''
+        Args:
+            collector: collector name
+            stats: optional, {"seconds", "records", "elems", "bytes"} of the BGP data read for this collector
+            cached: True if the data of the collector came from the BGP cache
+        '''
+        with self.lock:
+            record = self.collectors.setdefault(collector, {field: 0 for field in BGP_FIELDS})
+            for field in BGP_FIELDS:
+                record[field] += (stats or {}).get(field, 0)
+            record["cached"] = record.get("cached", True) and cached
+
+    def add_llm_call(self, label, seconds, prompt_tokens = 0, completion_tokens = 0, retries = 0, cached = False,
+                     cached_prompt_tokens = 0):
+        '''
+        Args:
+            label: name of the prompt (e.g. "describe_changes"), None if not given
+            seconds: float, latency of the request including retries
+            prompt_tokens, completion_tokens: int, token usage reported by the api (0 for cached responses)
+            retries: int, number of retries of the request
+            cached: True if the response came from the llm response cache
+            cached_prompt_tokens: int, prompt tokens read from the provider prompt cache (part of prompt_tokens)
+        '''
+        with self.lock:
+            self.llm_calls.append({"label": label, "seconds": round(seconds, 3), "prompt_tokens": prompt_tokens,
+                                   "cached_prompt_tokens": cached_prompt_tokens, "completion_tokens": completion_tokens,
+                                   "retries": retries, "cached": cached})
+
+    def to_dict(self):
+        '''
+        Return:
+            metrics record of the event: totals of BGP data and llm requests, llm requests grouped by label, every
+            collector and every llm request
+        '''
+        with self.lock:
+            collectors = {collector: dict(record) for collector, record in self.collectors.items()}
+            llm_calls = [dict(call) for call in self.llm_calls]
+            stages = {name: round(seconds, 3) for name, seconds in self.stages.items()}
+        labels = {}
+        for call in llm_calls:
+            _add(labels.setdefault(str(call["label"]), {"calls": 0, "cached": 0}), call)
+        llm = {"calls": len(llm_calls), "cached": sum(call["cached"] for call in llm_calls)}
+        for field in LLM_FIELDS:
+            llm[field] = sum(call[field] for call in llm_calls)
+        bgp = {field: sum(record[field] for record in collectors.values()) for field in BGP_FIELDS}
+        bgp["collectors"] = len(collectors)
+        bgp["cached_collectors"] = sum(record["cached"] for record in collectors.values())
+        return {"event": self.event,
+                "seconds": round((self.end or time.time()) - self.begin, 3),
+                "stages": stages,
+                "bgp": _rounded(bgp),
+                "llm": _rounded(llm),
+                "llm_by_label": {label: _rounded(record) for label, record in labels.items()},
+                "collectors": {collector: _rounded(record) for collector, record in collectors.items()},
+                "llm_calls": llm_calls}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+
+def _add(record, call):
+    record["calls"] += 1
+    record["cached"] += call["cached"]
+    for field in LLM_FIELDS:
+        record[field] = record.get(field, 0) + call[field]
+
+
+def _rounded(record):
+    return {key: round(value, 3) if isinstance(value, float) else value for key, value in record.items()}
+
+
+def bind(func):
+    '''
+    Args:
+        func: function to run in a worker thread (e.g. submitted to a ThreadPoolExecutor)
+    Return:
+        func that runs with the metrics of the current event, threads of a pool do not inherit them otherwise
+    '''
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+def summarize(records):
+    '''
+    summary of the metrics records of a batch of events
+    Args:
+        records: {event: output of Event_Metrics.to_dict}
+    Return:
+        summary: totals over events, time of each stage, and per event its time, BGP and llm time and tokens, slowest first
+    '''
+    summary = {"events": len(records), "seconds": 0.0, "stages": {},
+               "bgp": {field: 0 for field in BGP_FIELDS}, "llm": {"calls": 0, "cached": 0}, "llm_by_label": {}}
+    per_event = []
+    for event, record in records.items():
+        summary["seconds"] += record["seconds"]
+        for name, seconds in record["stages"].items():
+            summary["stages"][name] = summary["stages"].get(name, 0.0) + seconds
+        for field in BGP_FIELDS:
+            summary["bgp"][field] += record["bgp"][field]
+        for target, source in [(summary["llm"], record["llm"])] + \
+                              [(summary["llm_by_label"].setdefault(label, {"calls": 0, "cached": 0}), by_label)
+                               for label, by_label in record["llm_by_label"].items()]:
+            for field in ["calls", "cached"] + LLM_FIELDS:
+                target[field] = target.get(field, 0) + source.get(field, 0)
+        per_event.append({"event": event, "seconds": record["seconds"], "bgp_seconds": record["bgp"]["seconds"],
+                          "llm_seconds": record["llm"].get("seconds", 0),
+                          "llm_tokens": record["llm"].get("prompt_tokens", 0) + record["llm"].get("completion_tokens", 0)})
+    summary["per_event"] = sorted(per_event, key=lambda item: -item["seconds"])
+    summary["seconds"] = round(summary["seconds"], 3)
+    summary["stages"] = _rounded(summary["stages"])
+    summary["bgp"] = _rounded(summary["bgp"])
+    summary["llm"] = _rounded(summary["llm"])
+    summary["llm_by_label"] = {label: _rounded(record) for label, record in summary["llm_by_label"].items()}
+    return summary
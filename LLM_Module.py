@@ -1,40 +1,322 @@
 import os
-import openai
-openai.api_key = "YOUR OPENAI API KEY"
+import json
+import time
+import hashlib
+import random
+import asyncio
+import logging
+import threading
+from contextlib import nullcontext
+try:
+    import openai
+except ImportError: #optional for offline runs with a local client (e.g. BEAR_benchmark), required to call the api
+    openai = None
+from Cache_Module import Disk_Cache
+from Event_Metrics import current_metrics
+if openai is not None:
+    openai.api_key = "YOUR OPENAI API KEY"
 os.environ["OPENAI_API_KEY"] = "YOUR OPENAI API KEY"
 
+logger = logging.getLogger(__name__)
+
+#errors that are worth retrying: rate limit, timeout, connection error and server side error
+RETRY_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                openai.InternalServerError) if openai is not None else ()
+
+
+class LLM_Cache_Miss(KeyError):
+    '''
+    raised in replay mode when a request is not in the llm response cache
+    '''
+
+
+class Rate_Limiter():
+    '''
+    token bucket rate limiter on both the number of requests and the number of tokens per minute.
+    A request reserves its share of both buckets and waits until the buckets have refilled enough, so concurrent threads
+    or coroutines are spread out instead of all hitting the rate limit of the api.
+    '''
+    def __init__(self, requests_per_minute = None, tokens_per_minute = None):
+        '''
+        Args:
+            requests_per_minute: int, optional, maximum requests per minute, no limit if None
+            tokens_per_minute: int, optional, maximum (estimated) tokens per minute, no limit if None
+        '''
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.levels = {name: limit for name, limit in self.limits.items() if limit}
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens):
+        '''
+        take one request and tokens from the buckets
+        Args:
+            tokens: int, estimated tokens of the request
+        Return:
+            wait: float, seconds to wait before sending the request
+        '''
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.last_time
+            self.last_time = now
+            wait = 0.0
+            for name, amount in (("requests", 1), ("tokens", tokens)):
+                limit = self.limits[name]
+                if not limit:
+                    continue
+                rate = limit / 60 #refill per second
+                self.levels[name] = min(limit, self.levels[name] + elapsed * rate) - min(amount, limit)
+                if self.levels[name] < 0:
+                    wait = max(wait, -self.levels[name] / rate)
+            return wait
+
+    def adjust(self, tokens):
+        '''
+        correct the token bucket once the real token usage of a request is known
+        Args:
+            tokens: int, real tokens minus estimated tokens of the request
+        '''
+        with self.lock:
+            if self.limits["tokens"]:
+                self.levels["tokens"] = min(self.limits["tokens"], self.levels["tokens"] - tokens)
+
+    def acquire(self, tokens):
+        time.sleep(self.reserve(tokens))
+
+    async def async_acquire(self, tokens):
+        await asyncio.sleep(self.reserve(tokens))
+
+
 class LLM_Module():
     '''
     a class that wrap all functions for a specific LLM, GPT-4o
     If you want to use a different LLM, you can just adjust code in this class.
+    Requests are retried with jittered exponential backoff on transient errors and rate limited by a token bucket, all
+    instances share one sync and one async client so that http connections are reused.
+    Responses can be cached on disk, keyed by a hash of model, messages and sampling parameters, so re-running the same
+    prompt reuses the previous response instead of calling the api.
     '''
-    def __init__(self, model = "gpt-4o"):
+    _client = None
+    _async_client = None
+    _client_lock = threading.Lock()
+
+    def __init__(self, model = "gpt-4o", max_retries = 5, timeout = 120, requests_per_minute = None, tokens_per_minute = None,
+                 backoff_base = 1, backoff_max = 60, cache_path = None, cache_size = 512*1024**2, replay = False,
+                 max_concurrent_requests = None):
         '''
         initialize llm
         Args:
             model: backbone llm, default is gpt-4o
+            max_retries: int, number of retries of a request on transient errors
+            timeout: float, seconds before a request times out
+            requests_per_minute: int, optional, rate limit on requests
+            tokens_per_minute: int, optional, rate limit on (estimated) tokens
+            backoff_base: float, seconds to wait before the first retry, doubled for every retry
+            backoff_max: float, maximum seconds to wait between two retries
+            cache_path: optional, directory of the llm response cache, responses are not cached if None
+            cache_size: int, maximum size in bytes of the llm response cache, least recently used responses are removed beyond it
+            replay: if True, only answer from the llm response cache and raise LLM_Cache_Miss for uncached requests, so a
+                    re-run reproduces the previous run exactly without calling the api
+            max_concurrent_requests: int, optional, maximum number of requests in flight at the same time over all threads
+        '''
+        self.llm = self._shared_client()
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = Rate_Limiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+        self.llm_cache = Disk_Cache(cache_path, max_bytes=cache_size) if cache_path else None
+        self.replay = replay
+        self.limit_concurrent_requests(max_concurrent_requests)
+        if replay and self.llm_cache is None:
+            raise ValueError("replay needs cache_path")
+
+    def limit_concurrent_requests(self, max_concurrent_requests):
+        '''
+        Args:
+            max_concurrent_requests: int, maximum number of requests in flight at the same time, no limit if None
         '''
-        self.llm = openai.OpenAI()
+        if max_concurrent_requests:
+            self.request_semaphore = threading.BoundedSemaphore(max_concurrent_requests)
+        else:
+            self.request_semaphore = None
 
-    def chat(self, messages, model, n=1):
+    async def _async_acquire_request(self, poll_interval = 0.01):
+        '''
+        take a request slot of request_semaphore without blocking the event loop: the slot is only taken when free, so a
+        task cancelled while waiting holds no slot. The semaphore is shared with the threads calling chat
+        '''
+        while not self.request_semaphore.acquire(blocking=False):
+            await asyncio.sleep(poll_interval)
+
+    @classmethod
+    def _shared_client(cls, use_async = False):
+        '''
+        create the openai client once and share it (and its connection pool) between all instances.
+        retries are handled by LLM_Module, so the client itself does not retry
+        '''
+        with cls._client_lock:
+            if openai is None and (LLM_Module._async_client if use_async else LLM_Module._client) is None:
+                raise ImportError("openai is required to call the llm api, install it with pip install openai")
+            if use_async:
+                if LLM_Module._async_client is None:
+                    LLM_Module._async_client = openai.AsyncOpenAI(max_retries=0)
+                return LLM_Module._async_client
+            if LLM_Module._client is None:
+                LLM_Module._client = openai.OpenAI(max_retries=0)
+            return LLM_Module._client
+
+    def chat(self, messages, model, n=1, cache_tag=None, label=None):
         '''
         function to call llm api and get response from llm
         Args:
             messages: List[Dict{}], input message to the llm
             model: str, specify which llm to use
             n: int, number of responses we want from the llm
+            cache_tag: optional, added to the cache key to keep apart responses to the same messages (e.g. the index of a
+                       self-consistency sample), not sent to the llm
+            label: optional, name of the prompt in the metrics of the current event (Event_Metrics), not sent to the llm
+        Return:
+            text_response: List[str], a list contains n response from the llm
+        '''
+        begin = time.time()
+        cache_key = self._cache_key(messages, model, n, cache_tag)
+        text_response = self._cached_response(cache_key, messages)
+        if text_response is not None:
+            self._record_call(label, begin, cached=True)
+            return text_response
+        estimated_tokens = self.estimate_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            try:
+                with self.request_semaphore or nullcontext():
+                    response = self.llm.chat.completions.create(
+                                        model=model,
+                                        messages=messages,
+                                        n=n,
+                                        timeout=self.timeout
+                                        )
+                break
+            except RETRY_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logger.warning("llm request failed (%s), retry %d/%d in %.1fs", e, attempt + 1, self.max_retries, delay)
+                time.sleep(delay)
+        text_response = self._parse_response(response, n, estimated_tokens)
+        self._record_call(label, begin, response=response, retries=attempt)
+        if self.llm_cache is not None:
+            self.llm_cache.put(cache_key, text_response)
+        return text_response
+
+    async def achat(self, messages, model, n=1, cache_tag=None, label=None):
+        '''
+        async version of chat, for running many llm requests concurrently in an event loop. It shares the rate limiter,
+        the request limit (max_concurrent_requests) and the response cache with chat
+        Args:
+            messages: List[Dict{}], input message to the llm
+            model: str, specify which llm to use
+            n: int, number of responses we want from the llm
+            cache_tag: optional, added to the cache key to keep apart responses to the same messages, not sent to the llm
+            label: optional, name of the prompt in the metrics of the current event (Event_Metrics), not sent to the llm
         Return:
             text_response: List[str], a list contains n response from the llm
         '''
-        response = self.llm.chat.completions.create(
-                            model=model,
-                            messages=messages,
-                            n=n
-                            )
+        begin = time.time()
+        cache_key = self._cache_key(messages, model, n, cache_tag)
+        text_response = self._cached_response(cache_key, messages)
+        if text_response is not None:
+            self._record_call(label, begin, cached=True)
+            return text_response
+        llm = self._shared_client(use_async=True)
+        estimated_tokens = self.estimate_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.async_acquire(estimated_tokens)
+            if self.request_semaphore:
+                await self._async_acquire_request()
+            try:
+                try:
+                    response = await llm.chat.completions.create(
+                                        model=model,
+                                        messages=messages,
+                                        n=n,
+                                        timeout=self.timeout
+                                        )
+                finally: #also on cancellation, so the slot is never leaked
+                    if self.request_semaphore:
+                        self.request_semaphore.release()
+                break
+            except RETRY_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logger.warning("llm request failed (%s), retry %d/%d in %.1fs", e, attempt + 1, self.max_retries, delay)
+                await asyncio.sleep(delay)
+        text_response = self._parse_response(response, n, estimated_tokens)
+        self._record_call(label, begin, response=response, retries=attempt)
+        if self.llm_cache is not None:
+            self.llm_cache.put(cache_key, text_response)
+        return text_response
+
+    def _cache_key(self, messages, model, n, cache_tag):
+        '''
+        key of a request in the llm response cache: model, sampling parameters and the sha256 of the messages. The
+        messages (with the routing tables of the event) are not part of the key, since the key is kept in the cache index
+        '''
+        messages_hash = hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+        return {"model": model, "n": n, "cache_tag": cache_tag, "messages_hash": messages_hash}
+
+    def _cached_response(self, cache_key, messages):
+        '''
+        Return:
+            cached text responses of the request, None if not cached (or there is no cache)
+        '''
+        if self.llm_cache is None:
+            return None
+        text_response = self.llm_cache.get(cache_key)
+        if text_response is None and self.replay:
+            raise LLM_Cache_Miss(f"no cached response in replay mode for: {str(messages)[:200]}")
+        return text_response
+
+    def _parse_response(self, response, n, estimated_tokens):
+        '''
+        get the n text responses and correct the token bucket with the real token usage
+        '''
+        if getattr(response, "usage", None):
+            self.rate_limiter.adjust(response.usage.total_tokens - estimated_tokens)
         text_response = [response.choices[i].message.content for i in range(n)]
-        
+
         return text_response
 
+    def _record_call(self, label, begin, response = None, retries = 0, cached = False):
+        '''
+        add the latency, token usage and retries of a request to the metrics of the current event, if they are recorded
+        '''
+        metrics = current_metrics.get()
+        if metrics is None:
+            return None
+        usage = getattr(response, "usage", None)
+        details = getattr(usage, "prompt_tokens_details", None) #prompt tokens served by the provider prompt cache
+        metrics.add_llm_call(label, time.time() - begin, prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+                             completion_tokens=getattr(usage, "completion_tokens", 0) or 0, retries=retries, cached=cached,
+                             cached_prompt_tokens=getattr(details, "cached_tokens", 0) or 0)
+        return None
+
+    def backoff_delay(self, attempt):
+        '''
+        Args:
+            attempt: int, number of failed attempts so far minus one
+        Return:
+            seconds to wait before the next attempt, exponential in attempt with full jitter
+        '''
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def estimate_tokens(self, messages):
+        '''
+        rough token count of the messages (about 4 characters per token), used for rate limiting
+        '''
+        return sum(len(message["content"]) for message in messages) // 4 + 1
+
     def make_message(self, user_prompt, system_prompt=None):
         '''
         Function that make the input for the llm
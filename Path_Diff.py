@@ -0,0 +1,266 @@
+import json
+import numpy as np
+from Path_Table import Path_Table
+from Prefix_Trie import Prefix_Trie
+from RIB_Compactor import count_tokens
+
+
+#description of the path difference format, included in prompts next to the path difference
+DIFF_FORMAT = "The path difference is computed from the routing tables of all collectors and given in json. Peers are named \
+'collector:peer AS', and peers with the same change are grouped. 'counts' gives the number of peers compared and changed. \
+'origin_changes' lists paths whose last AS (destination) changed. 'new_more_specifics' lists prefixes that appear only after \
+the time stamp, whether they were in the history routing table, their covering prefix and its origin before. 'withdrawals' \
+lists withdrawn paths. 'new_transit' lists paths that keep the same destination and only have ASes inserted into the path \
+before. 'path_changes' lists other path changes (e.g. reroutes through other ASes). 'omitted' counts entries left out \
+because the data is too large."
+
+#kinds of path changes, in the order they are listed in the path difference
+KINDS = ["origin_changes", "new_more_specifics", "withdrawals", "new_transit", "path_changes"]
+
+
+def diff_ribs(history_rib, rib_before_incident, rib_after_incident, target_prefix = None):
+    '''
+    compute the changes of AS paths before and after the event for every peer of every collector
+    Args:
+        history_rib, rib_before_incident, rib_after_incident: {collector name: {IP prefix: {peer: [AS path]}}}, or
+            Path_Table built with one Vocabulary, then unchanged paths are skipped with vectorized comparison
+        target_prefix: optional, IP prefix of the event
+    Return:
+        path_diff: dict with
+            counts: number of peers compared and of each kind of change
+            origin_changes: paths whose origin AS (last AS) changed
+            new_more_specifics: prefixes that only appear after the event, with their covering prefix and its origins
+            withdrawals: paths withdrawn after the event
+            new_transit: paths with the same origin AS where ASes were only inserted into the path before
+            path_changes: other changed paths (e.g. reroutes through other ASes)
+        every entry groups the peers ("collector:peer") that have the same prefix, path before and path after
+    '''
+    history_prefixes = _prefixes(history_rib)
+    before_prefixes, before_origins = _announced(rib_before_incident)
+
+    groups = {} #(kind, prefix, before path, after path) -> peers
+    n_peers, entries = _changed_entries(rib_before_incident, rib_after_incident)
+    for collector, IP, peer, before, after in entries:
+        kind = _change_kind(IP, before, after, before_prefixes, before_origins)
+        groups.setdefault((kind, IP, tuple(before), tuple(after)), []).append(f"{collector}:{peer}")
+
+    path_diff = {"target_prefix": target_prefix,
+                 "counts": {"peers": n_peers},
+                 "origin_changes": [],
+                 "new_more_specifics": [],
+                 "withdrawals": [],
+                 "new_transit": [],
+                 "path_changes": []}
+    new_prefixes = {}
+    for (kind, IP, before, after), peers in groups.items():
+        path_diff["counts"][kind] = path_diff["counts"].get(kind, 0) + len(peers)
+        if kind == "origin_changes":
+            origins = sorted(before_origins.get(IP, set())) if not before else [before[-1]]
+            path_diff[kind].append({"prefix": IP, "before_origin": origins, "after_origin": after[-1],
+                                    "before_path": list(before), "after_path": list(after), "peers": peers})
+        elif kind == "new_more_specifics":
+            new_prefixes.setdefault(IP, []).append({"path": list(after), "peers": peers})
+        elif kind == "withdrawals":
+            path_diff[kind].append({"prefix": IP, "before_path": list(before), "peers": peers})
+        elif kind == "new_transit":
+            path_diff[kind].append({"prefix": IP, "origin": after[-1], "inserted": [AS for AS in after[:-1] if AS not in before],
+                                    "before_path": list(before), "after_path": list(after), "peers": peers})
+        else:
+            path_diff[kind].append({"prefix": IP, "before_path": list(before), "after_path": list(after), "peers": peers})
+
+    before_trie = Prefix_Trie(before_prefixes) if new_prefixes else None
+    for IP, routes in new_prefixes.items():
+        covering = covering_prefix(IP, before_trie)
+        path_diff["new_more_specifics"].append({"prefix": IP,
+                                                "in_history": IP in history_prefixes,
+                                                "covering_prefix": covering,
+                                                "covering_origin": sorted(before_origins.get(covering, set())),
+                                                "origins": sorted({route["path"][-1] for route in routes}),
+                                                "routes": routes})
+    path_diff["counts"]["changed"] = sum(len(peers) for peers in groups.values())
+    return path_diff
+
+
+def _prefixes(rib):
+    if isinstance(rib, Path_Table):
+        return {rib.vocab.names["prefixes"][p] for p in np.unique(rib.prefix).tolist()}
+    return {IP for collector_rib in rib.values() for IP in collector_rib}
+
+
+def _announced(rib):
+    '''
+    Return:
+        prefixes: set of prefixes with at least one path that is not withdrawn
+        origins: {IP prefix: set of origin ASes} (for a Path_Table, looked up on demand with get)
+    '''
+    if isinstance(rib, Path_Table):
+        origins = _Table_Origins(rib)
+        return {rib.vocab.names["prefixes"][p] for p in np.unique(origins.prefix).tolist()}, origins
+    origins = {}
+    for collector_rib in rib.values():
+        for IP, peers in collector_rib.items():
+            origins.setdefault(IP, set()).update(path[-1] for path in peers.values() if path)
+    return {IP for IP, origin in origins.items() if origin}, origins
+
+
+class _Table_Origins():
+    '''
+    origin ASes of each prefix of a Path_Table over all collectors and peers, only decoded for the prefixes looked up
+    '''
+    def __init__(self, table):
+        announced = table.lengths() > 0
+        prefix = table.prefix[announced]
+        order = np.argsort(prefix, kind="stable")
+        self.prefix = prefix[order]
+        self.origins = table.origins()[announced][order]
+        self.vocab = table.vocab
+
+    def get(self, IP, default = None):
+        p = self.vocab.ids["prefixes"].get(IP)
+        if p is None:
+            return default
+        low, high = np.searchsorted(self.prefix, [p, p + 1])
+        if low == high:
+            return default
+        return {self.vocab.decode_hop(origin) for origin in np.unique(self.origins[low:high]).tolist()}
+
+
+def _changed_entries(rib_before_incident, rib_after_incident):
+    '''
+    Return:
+        n_peers: number of (collector, prefix, peer) entries in either table
+        entries: list of (collector, IP prefix, peer, path before, path after) of the entries whose path changed
+    '''
+    if isinstance(rib_before_incident, Path_Table):
+        comparison = rib_before_incident.compare(rib_after_incident)
+        return len(comparison[2]), rib_before_incident.changed_entries(rib_after_incident, comparison=comparison)
+    n_peers = 0
+    entries = []
+    collectors = list(dict.fromkeys(list(rib_before_incident) + list(rib_after_incident)))
+    for collector in collectors:
+        before_rib = rib_before_incident.get(collector, {})
+        after_rib = rib_after_incident.get(collector, {})
+        for IP in dict.fromkeys(list(before_rib) + list(after_rib)):
+            before_peers = before_rib.get(IP, {})
+            after_peers = after_rib.get(IP, {})
+            for peer in dict.fromkeys(list(before_peers) + list(after_peers)):
+                n_peers += 1
+                before = list(before_peers.get(peer) or [])
+                after = list(after_peers.get(peer) or [])
+                if before != after:
+                    entries.append((collector, IP, peer, before, after))
+    return n_peers, entries
+
+
+def _change_kind(IP, before, after, before_prefixes, before_origins):
+    '''
+    kind of change of one peer's path to IP from before to after (before != after)
+    '''
+    if not after:
+        return "withdrawals"
+    if IP not in before_prefixes:
+        return "new_more_specifics"
+    if not before: #peer newly announces an existing prefix, compare with the origins seen before
+        return "origin_changes" if after[-1] not in before_origins.get(IP, set()) else "path_changes"
+    if after[-1] != before[-1]:
+        return "origin_changes"
+    if any(AS not in before for AS in after[:-1]) and _is_subsequence(before, after):
+        return "new_transit"
+    return "path_changes" #reroutes (ASes replaced), shorter paths
+
+
+def _is_subsequence(before, after):
+    '''
+    Return:
+        True if before is after with some ASes removed, i.e. after only inserts ASes into before
+    '''
+    hops = iter(after)
+    return all(AS in hops for AS in before)
+
+
+def covering_prefix(IP, prefixes):
+    '''
+    Args:
+        IP: IP prefix
+        prefixes: IP prefixes to search in, or a Prefix_Trie of them to search many IP prefixes
+    Return:
+        the most specific prefix in prefixes that covers IP (IP excluded), None if there is none
+    '''
+    if not isinstance(prefixes, Prefix_Trie):
+        prefixes = Prefix_Trie(prefixes)
+    return prefixes.longest_match(IP)
+
+
+def merge_diffs(path_diffs, target_prefix = None):
+    '''
+    merge path differences computed separately (e.g. one per collector) into one, the same change seen in several of
+    them is one entry with the peers of all of them
+    Args:
+        path_diffs: list of outputs of diff_ribs
+        target_prefix: optional, IP prefix of the event
+    Return:
+        path_diff: same form as the output of diff_ribs
+    '''
+    path_diff = {"target_prefix": target_prefix, "counts": {}}
+    for kind in KINDS:
+        entries = {}
+        for diff in path_diffs:
+            for entry in diff[kind]:
+                if kind == "new_more_specifics":
+                    key = entry["prefix"]
+                else:
+                    key = (entry["prefix"], tuple(entry["before_path"]), tuple(entry.get("after_path", [])))
+                if key not in entries:
+                    entries[key] = json.loads(json.dumps(entry)) #copy, the inputs are not modified
+                    continue
+                merged = entries[key]
+                if kind == "new_more_specifics":
+                    routes = {tuple(route["path"]): route for route in merged["routes"]}
+                    for route in entry["routes"]:
+                        if tuple(route["path"]) in routes:
+                            routes[tuple(route["path"])]["peers"] += route["peers"]
+                        else:
+                            merged["routes"].append(json.loads(json.dumps(route)))
+                    merged["in_history"] = merged["in_history"] or entry["in_history"]
+                    merged["covering_prefix"] = merged["covering_prefix"] or entry["covering_prefix"]
+                    merged["covering_origin"] = sorted(set(merged["covering_origin"]) | set(entry["covering_origin"]))
+                    merged["origins"] = sorted(set(merged["origins"]) | set(entry["origins"]))
+                else:
+                    merged["peers"] += entry["peers"]
+                    if kind == "origin_changes":
+                        merged["before_origin"] = sorted(set(merged["before_origin"]) | set(entry["before_origin"]))
+        path_diff[kind] = list(entries.values())
+    for diff in path_diffs:
+        for kind, count in diff["counts"].items():
+            path_diff["counts"][kind] = path_diff["counts"].get(kind, 0) + count
+    return path_diff
+
+
+def render_diff(path_diff, token_budget = None, model = "gpt-4o"):
+    '''
+    compact json text of the path difference for llm prompts. If it exceeds token_budget, other path changes are left out
+    first, then the longest lists of changes are cut, and the number of left out entries is recorded in 'omitted'
+    Args:
+        path_diff: output of diff_ribs
+        token_budget: optional, maximum number of tokens of the text
+        model: llm name, used to count tokens
+    Return:
+        diff_text: str
+    '''
+    diff_text = json.dumps(path_diff, separators=(",", ":"))
+    if token_budget is None or count_tokens(diff_text, model) <= token_budget:
+        return diff_text
+    path_diff = dict(path_diff)
+    omitted = {}
+    kinds = list(reversed(KINDS))
+    while count_tokens(diff_text, model) > token_budget:
+        longest = max(kinds, key=lambda kind: len(path_diff[kind]))
+        if not path_diff[longest]:
+            break
+        kind = "path_changes" if path_diff["path_changes"] else longest
+        keep = len(path_diff[kind]) // 2
+        omitted[kind] = omitted.get(kind, 0) + len(path_diff[kind]) - keep
+        path_diff[kind] = path_diff[kind][:keep]
+        path_diff["omitted"] = omitted
+        diff_text = json.dumps(path_diff, separators=(",", ":"))
+    return diff_text
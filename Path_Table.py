@@ -0,0 +1,315 @@
+import gc
+import json
+import numpy as np
+
+
+#AS path tokens that are not plain AS numbers (e.g. AS sets "{1,2}") are interned and encoded from this value up, in the
+#private use range of 4-byte AS numbers. AS numbers at or above it are interned the same way so every token round-trips.
+TOKEN_BASE = 0xFFFF0000
+
+
+class Vocabulary():
+    '''
+    interned names of collectors, peers, prefixes and non-numeric AS path tokens, shared by the path tables that are
+    compared with each other so the same name has the same id in all of them
+    '''
+    def __init__(self, collectors = None, peers = None, prefixes = None, tokens = None):
+        '''
+        Args:
+            collectors, peers, prefixes, tokens: optional lists of names, the id of a name is its index
+        '''
+        self.names = {"collectors": list(collectors or []), "peers": list(peers or []), "prefixes": list(prefixes or []),
+                      "tokens": list(tokens or [])}
+        self.ids = {kind: {name: i for i, name in enumerate(names)} for kind, names in self.names.items()}
+
+    def intern(self, kind, name):
+        '''
+        Args:
+            kind: "collectors", "peers", "prefixes" or "tokens"
+            name: str
+        Return:
+            id of name, a new id if name was not seen before
+        '''
+        ids = self.ids[kind]
+        i = ids.get(name)
+        if i is None:
+            i = ids[name] = len(self.names[kind])
+            self.names[kind].append(name)
+        return i
+
+    def encode_hop(self, hop):
+        '''
+        Return:
+            uint32 code of one AS path token: the AS number itself, or TOKEN_BASE + id of an interned token
+        '''
+        if hop.isdigit() and int(hop) < TOKEN_BASE and str(int(hop)) == hop:
+            return int(hop)
+        return TOKEN_BASE + self.intern("tokens", hop)
+
+    def decode_hop(self, code):
+        return str(code) if code < TOKEN_BASE else self.names["tokens"][code - TOKEN_BASE]
+
+    def to_json_dict(self):
+        return dict(self.names)
+
+
+class Path_Table():
+    '''
+    routing table of many collectors, {collector name: {IP prefix: {peer: [AS path]}}}, stored as numpy arrays.
+    Every (collector, prefix, peer) entry is one row of interned ids, the AS paths of all rows are concatenated in one
+    uint32 array and row i is hops[offsets[i]:offsets[i+1]] (an empty path is a withdrawn path). Tables built with the same
+    Vocabulary can be compared row by row with vectorized numpy operations.
+    '''
+    def __init__(self, vocab, collectors, collector, prefix, peer, offsets, hops):
+        '''
+        Args:
+            vocab: Vocabulary of the ids
+            collectors: uint32 array, ids of the collectors in the table (also those without any path)
+            collector, prefix, peer: uint32 arrays, ids of the entry of each row
+            offsets: int64 array of length rows + 1, start of the path of each row in hops
+            hops: uint32 array, encoded AS paths of all rows
+        '''
+        self.vocab = vocab
+        self.collectors = collectors
+        self.collector = collector
+        self.prefix = prefix
+        self.peer = peer
+        self.offsets = offsets
+        self.hops = hops
+
+    @classmethod
+    def from_dict(cls, rib, vocab = None):
+        '''
+        Args:
+            rib: {collector name: {IP prefix: {peer: [AS path]}}}
+            vocab: optional Vocabulary to share with other tables, a new one if None
+        Return:
+            Path_Table of rib
+        '''
+        vocab = vocab if vocab is not None else Vocabulary()
+        collectors, collector, prefix, peer, lengths, hops = [], [], [], [], [], []
+        for collector_name, collector_rib in rib.items():
+            c = vocab.intern("collectors", collector_name)
+            collectors.append(c)
+            for IP, peers in collector_rib.items():
+                p = vocab.intern("prefixes", IP)
+                for peer_name, path in peers.items():
+                    collector.append(c)
+                    prefix.append(p)
+                    peer.append(vocab.intern("peers", str(peer_name)))
+                    path = path or []
+                    lengths.append(len(path))
+                    hops.extend(vocab.encode_hop(str(hop)) for hop in path)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(vocab, np.array(collectors, dtype=np.uint32), np.array(collector, dtype=np.uint32),
+                   np.array(prefix, dtype=np.uint32), np.array(peer, dtype=np.uint32), offsets, np.array(hops, dtype=np.uint32))
+
+    def to_dict(self):
+        '''
+        Return:
+            {collector name: {IP prefix: {peer: [AS path]}}}, the same form as from_dict
+        '''
+        gc_enabled = gc.isenabled()
+        gc.disable() #building many small lists triggers garbage collection passes that find nothing to collect
+        try:
+            return self._to_dict()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _to_dict(self):
+        names = self.vocab.names
+        #decode every distinct hop once
+        codes, inverse = np.unique(np.asarray(self.hops), return_inverse=True)
+        hop_names = [self.vocab.decode_hop(code) for code in codes.tolist()]
+        hops = list(map(hop_names.__getitem__, inverse.reshape(-1).tolist()))
+        offsets = self.offsets.tolist()
+        paths = [hops[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        peers = list(map(names["peers"].__getitem__, np.asarray(self.peer).tolist()))
+        rib = {names["collectors"][c]: {} for c in np.asarray(self.collectors).tolist()}
+        for c, p, start, end in self.groups().tolist():
+            rib.setdefault(names["collectors"][c], {}).setdefault(names["prefixes"][p], {}).update(
+                zip(peers[start:end], paths[start:end]))
+        return rib
+
+    def groups(self):
+        '''
+        Return:
+            int64 array of [collector id, prefix id, first row, end row] for every run of rows with the same collector and
+            prefix (rows of one collector and prefix are contiguous in tables built by from_dict)
+        '''
+        n = len(self)
+        if n == 0:
+            return np.zeros((0, 4), dtype=np.int64)
+        collector = np.asarray(self.collector)
+        prefix = np.asarray(self.prefix)
+        starts = np.flatnonzero(np.concatenate([[True], (collector[1:] != collector[:-1]) | (prefix[1:] != prefix[:-1])]))
+        ends = np.append(starts[1:], n)
+        return np.stack([collector[starts].astype(np.int64), prefix[starts].astype(np.int64), starts, ends], axis=1)
+
+    def to_json(self):
+        '''
+        Return:
+            json text of the table and its vocabulary
+        '''
+        return json.dumps({"vocab": self.vocab.to_json_dict(), "collectors": self.collectors.tolist(),
+                           "collector": self.collector.tolist(), "prefix": self.prefix.tolist(), "peer": self.peer.tolist(),
+                           "offsets": self.offsets.tolist(), "hops": self.hops.tolist()}, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, text):
+        '''
+        Args:
+            text: output of to_json
+        Return:
+            Path_Table
+        '''
+        data = json.loads(text)
+        return cls(Vocabulary(**data["vocab"]), np.array(data["collectors"], dtype=np.uint32),
+                   np.array(data["collector"], dtype=np.uint32),
+                   np.array(data["prefix"], dtype=np.uint32), np.array(data["peer"], dtype=np.uint32),
+                   np.array(data["offsets"], dtype=np.int64), np.array(data["hops"], dtype=np.uint32))
+
+    def select(self, row_ranges, collectors = None):
+        '''
+        Args:
+            row_ranges: list of (start, end), ranges of rows to keep
+            collectors: optional uint32 array, ids of the collectors of the new table, the collectors of the rows if None
+        Return:
+            Path_Table of the selected rows, with the same Vocabulary. A single range is a view of this table (no copy)
+        '''
+        row_ranges = [(start, end) for start, end in row_ranges if end > start]
+        if len(row_ranges) == 1:
+            start, end = row_ranges[0]
+            columns = [self.collector[start:end], self.prefix[start:end], self.peer[start:end]]
+            offsets = self.offsets[start:end+1] - self.offsets[start]
+            hops = self.hops[self.offsets[start]:self.offsets[end]]
+        else:
+            columns = [np.concatenate([column[start:end] for start, end in row_ranges] or [column[:0]])
+                       for column in (self.collector, self.prefix, self.peer)]
+            lengths = np.concatenate([np.diff(self.offsets[start:end+1]) for start, end in row_ranges] or [self.offsets[:0]])
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            hops = np.concatenate([self.hops[self.offsets[start]:self.offsets[end]] for start, end in row_ranges]
+                                  or [self.hops[:0]])
+        if collectors is None:
+            collectors = np.unique(columns[0]).astype(np.uint32)
+        return Path_Table(self.vocab, collectors, *columns, offsets, hops)
+
+    def __len__(self):
+        return len(self.collector)
+
+    def nbytes(self):
+        '''
+        Return:
+            bytes of the numpy arrays of the table (the vocabulary is shared and not counted)
+        '''
+        return sum(array.nbytes for array in (self.collectors, self.collector, self.prefix, self.peer, self.offsets, self.hops))
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def path(self, i):
+        '''
+        Return:
+            decoded AS path of row i
+        '''
+        return [self.vocab.decode_hop(code) for code in self.hops[self.offsets[i]:self.offsets[i+1]].tolist()]
+
+    def origins(self):
+        '''
+        Return:
+            uint32 array of the last hop (origin AS code) of every row, TOKEN_BASE - 1 for empty paths
+        '''
+        lengths = self.lengths()
+        origins = np.full(len(self), TOKEN_BASE - 1, dtype=np.uint32)
+        announced = lengths > 0
+        origins[announced] = self.hops[self.offsets[1:][announced] - 1]
+        return origins
+
+    def row_keys(self):
+        '''
+        Return:
+            int64 array, one key per row that is unique for (collector, prefix, peer) within the vocabulary
+        '''
+        n_prefixes = max(1, len(self.vocab.names["prefixes"]))
+        n_peers = max(1, len(self.vocab.names["peers"]))
+        return (self.collector.astype(np.int64) * n_prefixes + self.prefix) * n_peers + self.peer
+
+    def compare(self, other):
+        '''
+        match rows of this table and other (built with the same Vocabulary) by (collector, prefix, peer) and find the rows
+        whose path differs
+        Return:
+            self_rows: int64 array, row in this table of every entry of either table, -1 if not in this table
+            other_rows: int64 array, row in other of every entry, -1 if not in other
+            changed: bool array, True where the paths differ (an entry missing from one table counts as an empty path)
+        '''
+        if other.vocab is not self.vocab:
+            raise ValueError("path tables must share one Vocabulary to be compared")
+        keys = np.concatenate([self.row_keys(), other.row_keys()])
+        all_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        #order the entries like the nested dicts: by first appearance of the collector, then of the prefix, then of the peer
+        n_peers = max(1, len(self.vocab.names["peers"]))
+        n_prefixes = max(1, len(self.vocab.names["prefixes"]))
+        order = np.lexsort((first, _first_position(keys // n_peers)[first], _first_position(keys // n_peers // n_prefixes)[first]))
+        position = np.empty(len(all_keys), dtype=np.int64)
+        position[order] = np.arange(len(all_keys))
+        self_rows = np.full(len(all_keys), -1, dtype=np.int64)
+        other_rows = np.full(len(all_keys), -1, dtype=np.int64)
+        self_rows[position[inverse[:len(self)]]] = np.arange(len(self))
+        other_rows[position[inverse[len(self):]]] = np.arange(len(other))
+
+        #row -1 (missing entry) reads the appended length 0
+        self_lengths = np.append(self.lengths(), 0)[self_rows]
+        other_lengths = np.append(other.lengths(), 0)[other_rows]
+        changed = self_lengths != other_lengths
+
+        #same length: compare hop by hop, all pairs at once
+        same = np.flatnonzero(~changed & (self_lengths > 0))
+        if len(same):
+            lengths = self_lengths[same]
+            pair = np.repeat(np.arange(len(same)), lengths)
+            position = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            differs = self.hops[self.offsets[self_rows[same]][pair] + position] != \
+                      other.hops[other.offsets[other_rows[same]][pair] + position]
+            changed[same] = np.bincount(pair, weights=differs, minlength=len(same)) > 0
+        return self_rows, other_rows, changed
+
+    def changed_entries(self, other, comparison = None):
+        '''
+        Args:
+            other: Path_Table with the same Vocabulary
+            comparison: optional, output of compare(other) if it is already computed
+        Return:
+            list of (collector name, IP prefix, peer, path in this table, path in other) for every entry whose path differs,
+            only these paths are decoded
+        '''
+        names = self.vocab.names
+        self_rows, other_rows, changed = comparison if comparison is not None else self.compare(other)
+        entries = []
+        for i, j in zip(self_rows[changed].tolist(), other_rows[changed].tolist()):
+            table, row = (self, i) if i >= 0 else (other, j)
+            entries.append((names["collectors"][table.collector[row]], names["prefixes"][table.prefix[row]],
+                            names["peers"][table.peer[row]], self.path(i) if i >= 0 else [],
+                            other.path(j) if j >= 0 else []))
+        return entries
+
+
+def as_dict(rib):
+    '''
+    Return:
+        rib as {collector name: {IP prefix: {peer: [AS path]}}}, decoded if it is a Path_Table, rib itself otherwise
+    '''
+    return rib.to_dict() if isinstance(rib, Path_Table) else rib
+
+
+def _first_position(values):
+    '''
+    Return:
+        for every element of values, the index of the first element with the same value
+    '''
+    unique, first, inverse = np.unique(values, return_index=True, return_inverse=True)
+    return first[inverse.reshape(-1)]
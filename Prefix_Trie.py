@@ -0,0 +1,213 @@
+import ipaddress
+
+
+class _Node():
+    __slots__ = ("bits", "length", "prefix", "value", "children")
+
+    def __init__(self, bits, length, prefix = None, value = None):
+        self.bits = bits #network address as an int, host bits are 0
+        self.length = length
+        self.prefix = prefix #IP prefix string, None for nodes that only join two branches
+        self.value = value
+        self.children = [None, None]
+
+
+class Prefix_Trie():
+    '''
+    path-compressed binary (Patricia) trie of IPv4 and IPv6 prefixes. Exact, less specific (covering) and more specific
+    queries walk at most one branch of the prefix length, so the prefixes related to one prefix are found without
+    comparing it with every other prefix. Prefixes that are not valid IP prefixes are ignored.
+    '''
+    def __init__(self, prefixes = None):
+        '''
+        Args:
+            prefixes: optional iterable of IP prefixes, or dict {IP prefix: value}
+        '''
+        self.roots = {4: _Node(0, 0), 6: _Node(0, 0)}
+        self.size = 0
+        if isinstance(prefixes, dict):
+            for IP, value in prefixes.items():
+                self.insert(IP, value)
+        elif prefixes is not None:
+            for IP in prefixes:
+                self.insert(IP)
+
+    def insert(self, IP, value = None):
+        '''
+        Args:
+            IP: IP prefix
+            value: optional value stored with IP
+        Return:
+            True if IP was inserted or updated, False if it is not a valid IP prefix
+        '''
+        key = _parse(IP)
+        if key is None:
+            return False
+        version, bits, length = key
+        width = _WIDTH[version]
+        node = self.roots[version]
+        while True:
+            if node.length == length:
+                self.size += node.prefix is None
+                node.prefix, node.value = IP, value
+                return True
+            branch = _bit(bits, node.length, width)
+            child = node.children[branch]
+            if child is None:
+                node.children[branch] = _Node(bits, length, IP, value)
+                self.size += 1
+                return True
+            common = _common_length(child.bits, bits, min(child.length, length), width)
+            if common == child.length: #child covers IP
+                node = child
+                continue
+            if common == length: #IP covers child
+                new = _Node(bits, length, IP, value)
+                new.children[_bit(child.bits, length, width)] = child
+            else: #IP and child branch off below their common bits
+                new = _Node(_mask(bits, common, width), common)
+                new.children[_bit(bits, common, width)] = _Node(bits, length, IP, value)
+                new.children[_bit(child.bits, common, width)] = child
+            node.children[branch] = new
+            self.size += 1
+            return True
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, IP):
+        return self._exact_node(IP) is not None
+
+    def __iter__(self):
+        for version in (4, 6):
+            for node in _subtree(self.roots[version]):
+                yield node.prefix
+
+    def get(self, IP, default = None):
+        '''
+        Return:
+            value stored with IP (an equal network in another notation also matches), default if IP is not in the trie
+        '''
+        node = self._exact_node(IP)
+        return default if node is None else node.value
+
+    def exact(self, IP):
+        '''
+        Return:
+            the prefix of the trie that is the same network as IP (e.g. "10.0.0.0/8" for "10.0.0.1/8"), None if there is none
+        '''
+        node = self._exact_node(IP)
+        return None if node is None else node.prefix
+
+    def less_specifics(self, IP, include_self = False):
+        '''
+        Args:
+            IP: IP prefix
+            include_self: also return the prefix of the trie equal to IP
+        Return:
+            list of the prefixes of the trie that cover IP, from the least to the most specific
+        '''
+        return [node.prefix for node in self._covering_nodes(IP, include_self)]
+
+    def longest_match(self, IP, include_self = False):
+        '''
+        Return:
+            the most specific prefix of the trie that covers IP, None if there is none
+        '''
+        nodes = self._covering_nodes(IP, include_self)
+        return nodes[-1].prefix if nodes else None
+
+    def more_specifics(self, IP, include_self = False):
+        '''
+        Args:
+            IP: IP prefix
+            include_self: also return the prefix of the trie equal to IP
+        Return:
+            list of the prefixes of the trie covered by IP, in address order
+        '''
+        key = _parse(IP)
+        if key is None:
+            return []
+        version, bits, length = key
+        width = _WIDTH[version]
+        node = self.roots[version]
+        while node is not None and node.length < length:
+            if not _matches(node.bits, bits, node.length, width):
+                return []
+            node = node.children[_bit(bits, node.length, width)]
+        if node is None or not _matches(node.bits, bits, length, width):
+            return []
+        return [n.prefix for n in _subtree(node) if include_self or n.length > length]
+
+    def overlapping(self, IP):
+        '''
+        Return:
+            list of the prefixes of the trie that overlap IP: less specific ones, IP itself and more specific ones
+        '''
+        return self.less_specifics(IP) + self.more_specifics(IP, include_self=True)
+
+    def overlaps(self, IP):
+        '''
+        Return:
+            True if any prefix of the trie overlaps IP
+        '''
+        return bool(self._covering_nodes(IP, True)) or bool(self.more_specifics(IP))
+
+    def _exact_node(self, IP):
+        nodes = self._covering_nodes(IP, True)
+        if nodes and nodes[-1].length == _parse(IP)[2]:
+            return nodes[-1]
+        return None
+
+    def _covering_nodes(self, IP, include_self):
+        key = _parse(IP)
+        if key is None:
+            return []
+        version, bits, length = key
+        width = _WIDTH[version]
+        nodes = []
+        node = self.roots[version]
+        while node is not None and node.length <= length and _matches(node.bits, bits, node.length, width):
+            if node.prefix is not None and (include_self or node.length < length):
+                nodes.append(node)
+            if node.length == length:
+                break
+            node = node.children[_bit(bits, node.length, width)]
+        return nodes
+
+
+_WIDTH = {4: 32, 6: 128}
+
+
+def _parse(IP):
+    try:
+        network = ipaddress.ip_network(IP, strict=False)
+    except (ValueError, TypeError):
+        return None
+    return network.version, int(network.network_address), network.prefixlen
+
+
+def _bit(bits, i, width):
+    return (bits >> (width - 1 - i)) & 1
+
+
+def _mask(bits, length, width):
+    return bits >> (width - length) << (width - length) if length else 0
+
+
+def _matches(node_bits, bits, length, width):
+    return ((node_bits ^ bits) >> (width - length)) == 0
+
+
+def _common_length(a, b, length, width):
+    diff = (a ^ b) >> (width - length)
+    return length - diff.bit_length()
+
+
+def _subtree(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.prefix is not None:
+            yield node
+        stack.extend(child for child in reversed(node.children) if child is not None)
@@ -0,0 +1,76 @@
+'''
+llm messages that start with the BGP data of an event. The data is serialized once per event and put in the first message,
+before the task and the per-event values, so every request on the same data shares the same leading tokens and the
+provider prompt cache can reuse them (the requests of an event then only pay for their short task text).
+'''
+import json
+from collections.abc import Mapping
+
+
+#first line of the data message, the same for every task
+DATA_HEADER = "You are an expert in BGP network anomaly detection and explaination. Below is the BGP data of one anomaly \
+event, the task on this data is given after it."
+
+#description of routing tables serialized by Prompt_Builder.from_ribs
+DICT_FORMAT = "All pathes are stored in a json dictionary in a form of {collector name: {IP prefix: {peer: [AS path from \
+peer to the origin AS of IP prefix]}}}."
+
+
+def canonical_json(value):
+    '''
+    Args:
+        value: json serializable value, mappings such as RIB_Snapshot are serialized as dicts
+    Return:
+        compact json text with sorted keys, equal values always give the same text
+    '''
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=_plain)
+
+
+def _plain(value):
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"{type(value).__name__} is not json serializable")
+
+
+class Prompt_Builder():
+    '''
+    messages for the llm requests on the same BGP data: [data message, task system prompt, user prompt]. The data message
+    holds the serialized data and its format and does not change between requests, so it is a shared prompt prefix
+    '''
+    def __init__(self, data_text, data_format = "", subject = "the BGP data of the event"):
+        '''
+        Args:
+            data_text: str, serialized BGP data (e.g. RIB_Compactor text or path difference)
+            data_format: str, description of the form of data_text
+            subject: str, what the data is, used by the task prompts to refer to it (e.g. "the paths to this IP prefix")
+        '''
+        self.data_text = data_text
+        self.subject = subject
+        self.data_message = {"role": "system", "content": f"{DATA_HEADER}\n{data_text}\n{data_format}".rstrip()}
+
+    @classmethod
+    def from_ribs(cls, history_rib, rib_before_incident, rib_after_incident, data_format = DICT_FORMAT,
+                  subject = "the paths to this IP prefix and its sub-prefixes in history, before the time stamp and after the time stamp"):
+        '''
+        serialize each routing table once in canonical json
+        Args:
+            history_rib, rib_before_incident, rib_after_incident: {collector name: {IP prefix: {peer: [AS path]}}}
+        '''
+        data_text = f"Paths in history: {canonical_json(history_rib)}\n" \
+                    f"Paths before the time stamp: {canonical_json(rib_before_incident)}\n" \
+                    f"Paths after the time stamp: {canonical_json(rib_after_incident)}"
+        return cls(data_text, data_format, subject=subject)
+
+    def make_message(self, user_prompt, system_prompt = None):
+        '''
+        Args:
+            user_prompt: str, per-request text (event values, earlier answers)
+            system_prompt: str, optional, task of the request
+        Return:
+            message: input for the llm, starting with the data message
+        '''
+        message = [self.data_message]
+        if system_prompt:
+            message.append({"role": "system", "content": system_prompt})
+        message.append({"role": "user", "content": user_prompt})
+        return message
@@ -0,0 +1,166 @@
+import json
+from functools import lru_cache
+try:
+    import tiktoken
+except ImportError: #optional, token counts fall back to a character based estimate
+    tiktoken = None
+
+
+#description of the compact routing table format, included in prompts next to the compact routing tables
+RIB_FORMAT = "The AS paths are given in a compact json form. 'paths' maps a path id to an AS path (a list of AS numbers from \
+the peer to the origin AS, [] means the path is withdrawn). For every peer, [history path id, path id before the time stamp, \
+path id after the time stamp] is given, null means the peer has no path to that prefix at that time. 'changed' lists \
+{collector name: {IP prefix: {peer: [history, before, after]}}} for every peer whose path before and after the time stamp \
+is different. 'unchanged' lists the peers whose path did not change, grouped by their [history, before, after] ids: \
+{collector name: {IP prefix: [[[history, before, after], [peers]]]}}, or only as a number of peers per IP prefix and \
+[history, before, after] ids summed over collectors when the data is too large. 'omitted' counts changed paths left out \
+because the data is too large."
+
+
+def count_tokens(text, model = "gpt-4o"):
+    '''
+    count llm tokens of text, with tiktoken if it is installed and its encoding loads, otherwise estimate about 4
+    characters per token
+    Args:
+        text: str
+        model: llm name, selects the tokenizer
+    Return:
+        number of tokens
+    '''
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    '''
+    Return:
+        tiktoken encoding of model, None if tiktoken is not installed or the encoding cannot be loaded (it is downloaded
+        on first use, e.g. without network), then tokens are estimated
+    '''
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError: #unknown model name
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+class RIB_Compactor():
+    '''
+    turn history_rib, rib_before_incident and rib_after_incident into one compact text for llm prompts that fits in a token
+    budget. Identical AS paths are stored once in a path table and referenced by id across peers and collectors, peers
+    whose path changed after the event are sent in full, and the rest is grouped, summarized or left out step by step
+    until the text fits in the budget.
+    '''
+    def __init__(self, token_budget = 60000, model = "gpt-4o"):
+        '''
+        Args:
+            token_budget: int, maximum number of tokens of the compact routing tables
+            model: llm name, used to count tokens
+        '''
+        self.token_budget = token_budget
+        self.model = model
+
+    def compact(self, history_rib, rib_before_incident, rib_after_incident):
+        '''
+        Args:
+            history_rib, rib_before_incident, rib_after_incident: {collector name: {IP prefix: {peer: [AS path]}}}
+        Return:
+            rib_text: str, compact json of the three routing tables (format described in RIB_FORMAT)
+            level: str, "full", "summary", "changed_only" or "truncated", how much was left out to fit the budget
+        '''
+        paths, changed, unchanged = self.diff_tables(history_rib, rib_before_incident, rib_after_incident)
+        path_table = {f"p{i}": list(path) for path, i in paths.items()}
+
+        #full: every peer, unchanged peers grouped by their paths
+        rib_text = self._dump(path_table, changed, unchanged=unchanged)
+        if self._fits(rib_text):
+            return rib_text, "full"
+
+        #summary: unchanged peers only as a number of peers per prefix and paths, summed over collectors
+        summary = {}
+        for collector_groups in unchanged.values():
+            for IP, groups in collector_groups.items():
+                for ids, peers in groups:
+                    key = json.dumps(ids)
+                    summary.setdefault(IP, {})[key] = summary.get(IP, {}).get(key, 0) + len(peers)
+        rib_text = self._dump(path_table, changed, unchanged=summary)
+        if self._fits(rib_text):
+            return rib_text, "summary"
+
+        #changed only: unchanged peers are left out, paths not used by changed peers are dropped from the path table
+        rib_text = self._dump(self._used_paths(path_table, changed), changed)
+        if self._fits(rib_text):
+            return rib_text, "changed_only"
+
+        #truncated: keep as many changed peers as fit in the budget
+        entries = [(collector, IP, peer, ids) for collector, rib in changed.items() for IP, peers in rib.items()
+                   for peer, ids in peers.items()]
+        total = len(entries)
+        low, high = 0, total
+        while low < high: #binary search of the number of changed peers that fits
+            mid = (low + high + 1) // 2
+            if self._fits(self._dump_entries(path_table, entries[:mid], total - mid)):
+                low = mid
+            else:
+                high = mid - 1
+        return self._dump_entries(path_table, entries[:low], total - low), "truncated"
+
+    def diff_tables(self, history_rib, rib_before_incident, rib_after_incident):
+        '''
+        Return:
+            paths: {tuple(AS path): path id}, every distinct AS path
+            changed: {collector name: {IP prefix: {peer: [history id, before id, after id]}}}, peers whose path before and
+                     after the event differ
+            unchanged: {collector name: {IP prefix: [[[history id, before id, after id], [peers]]]}}, other peers grouped
+        '''
+        paths = {}
+        def path_id(table, IP, peer):
+            path = table.get(IP, {}).get(peer)
+            if path is None:
+                return None
+            return f"p{paths.setdefault(tuple(path), len(paths))}"
+
+        changed = {}
+        unchanged = {}
+        collectors = list(dict.fromkeys(list(history_rib) + list(rib_before_incident) + list(rib_after_incident)))
+        for collector in collectors:
+            tables = [rib.get(collector, {}) for rib in (history_rib, rib_before_incident, rib_after_incident)]
+            for IP in dict.fromkeys([IP for table in tables for IP in table]):
+                groups = {}
+                for peer in dict.fromkeys([peer for table in tables for peer in table.get(IP, {})]):
+                    ids = [path_id(table, IP, peer) for table in tables]
+                    if ids[1] != ids[2]:
+                        changed.setdefault(collector, {}).setdefault(IP, {})[peer] = ids
+                    else:
+                        groups.setdefault(tuple(ids), []).append(peer)
+                if groups:
+                    unchanged.setdefault(collector, {})[IP] = [[list(ids), peers] for ids, peers in groups.items()]
+        return paths, changed, unchanged
+
+    def _used_paths(self, path_table, changed):
+        used = {i for rib in changed.values() for peers in rib.values() for ids in peers.values() for i in ids}
+        return {i: path for i, path in path_table.items() if i in used}
+
+    def _dump_entries(self, path_table, entries, omitted):
+        changed = {}
+        for collector, IP, peer, ids in entries:
+            changed.setdefault(collector, {}).setdefault(IP, {})[peer] = ids
+        return self._dump(self._used_paths(path_table, changed), changed, omitted=omitted)
+
+    def _dump(self, path_table, changed, unchanged = None, omitted = 0):
+        payload = {"paths": path_table, "changed": changed}
+        if unchanged is not None:
+            payload["unchanged"] = unchanged
+        if omitted:
+            payload["omitted"] = omitted
+        return json.dumps(payload, separators=(",", ":"))
+
+    def _fits(self, rib_text):
+        return count_tokens(rib_text, self.model) <= self.token_budget
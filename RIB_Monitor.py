@@ -0,0 +1,331 @@
+'''
+long-running monitor that keeps a rolling routing table of every collector for a set of watched prefixes, so the BGP
+data of an alert on one of them is built from memory instead of a rib dump 8-16h back and 8h of updates.
+Updates come from BGPStream (follow) or are replayed from local json or MRT files.
+'''
+import bisect
+import calendar
+import json
+import threading
+from datetime import datetime, timedelta
+from BGP_Module import collector_rib_dump, collector_update_list, fetch_collectors, stream_updates, _stream
+from Prefix_Trie import Prefix_Trie
+from RIB_Snapshot import RIB_Snapshot, apply_delta
+
+
+class RIB_Monitor():
+    '''
+    rolling routing table {collector: {IP prefix: {peer: [AS path]}}} of the prefixes that overlap the watched prefixes.
+    Each collector has a base table at base time and a time ordered log of the updates after it. The log is kept for
+    retention (the history window of an event, 8h, plus the age of the oldest alert to answer); older updates are merged
+    into the base table. event_ribs gives the same history table, updates before and updates after the event as
+    BGP_Module.collector_event_ribs, with the history table taken at start - 8h. Thread-safe: updates can be applied by a
+    follow loop in one thread while alerts are answered in others.
+    '''
+    def __init__(self, collector_list, prefixes, history_lag = timedelta(hours=8), retention = timedelta(hours=9),
+                 rib_interval = timedelta(hours=8), n_workers = 1, executor = "thread"):
+        '''
+        Args:
+            collector_list: list of collector names
+            prefixes: watched IP prefixes, updates of prefixes that overlap one of them are kept
+            history_lag: timedelta, time between the history table and the start of an event (8h in BEAR)
+            retention: timedelta, age of the oldest update kept in the log, at least history_lag
+            rib_interval: timedelta, time between two rib dumps of a collector (8 hours for ris)
+            n_workers: number of collectors retrieved from bgpstream in parallel
+            executor: "thread" or "process", type of worker pool used when n_workers > 1
+        '''
+        self.collector_list = list(dict.fromkeys(collector_list))
+        self.prefixes = list(dict.fromkeys(prefixes))
+        self.watched = Prefix_Trie(self.prefixes)
+        self.history_lag = history_lag
+        self.retention = max(retention, history_lag)
+        self.rib_interval = rib_interval
+        self.n_workers = n_workers
+        self.executor = executor
+        self.base = {c: {} for c in self.collector_list}
+        self.base_time = {c: None for c in self.collector_list} #None until a rib of the collector is loaded
+        self.log = {c: [] for c in self.collector_list} #(time, sequence number, IP prefix, peer, [AS path])
+        self.clock = 0 #time of the latest update applied
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def bgp_filter(self):
+        return "prefix any " + " ".join(self.prefixes)
+
+    def load_rib(self, collector, rib, rib_time):
+        '''
+        set the base table of a collector, updates of the log up to rib_time are dropped
+        Args:
+            collector: collector name
+            rib: {IP prefix: {peer: [AS path]}}, routing table of the collector at rib_time
+            rib_time: datetime or unix time of the table
+        '''
+        rib_time = _timestamp(rib_time)
+        with self.lock:
+            self.base[collector] = {IP: dict(peers) for IP, peers in rib.items() if self.watched.overlaps(IP)}
+            self.base_time[collector] = rib_time
+            self.log[collector] = [entry for entry in self.log[collector] if entry[0] > rib_time]
+            self.clock = max(self.clock, rib_time)
+        return None
+
+    def apply(self, collector, update_time, IP, peer, path):
+        '''
+        apply one announcement (path) or withdrawal (path = []) of a collector
+        Return:
+            True if the update is kept, False if its prefix is not watched or it is older than the base table
+        '''
+        if collector not in self.log or not self.watched.overlaps(IP):
+            return False
+        update_time = _timestamp(update_time)
+        with self.lock:
+            base_time = self.base_time[collector]
+            if base_time is not None and update_time <= base_time:
+                return False
+            self.sequence += 1
+            entry = (update_time, self.sequence, IP, str(peer), list(path))
+            if self.log[collector] and update_time < self.log[collector][-1][0]: #out of order, e.g. merged files
+                bisect.insort(self.log[collector], entry)
+            else:
+                self.log[collector].append(entry)
+            self.clock = max(self.clock, update_time)
+        return True
+
+    def compact(self, now = None):
+        '''
+        merge the updates older than retention into the base table of each collector with a base table. The log of a
+        collector without one is kept, its older paths are unknown
+        Args:
+            now: optional datetime or unix time, time of the latest update applied if None
+        '''
+        with self.lock:
+            cutoff = (_timestamp(now) if now is not None else self.clock) - self.retention.total_seconds()
+            for collector, log in self.log.items():
+                if self.base_time[collector] is None:
+                    continue
+                n = bisect.bisect_right(log, (cutoff, float("inf")))
+                if n == 0:
+                    continue
+                self.base[collector] = apply_delta(self.base[collector], _delta(log[:n]))
+                self.base_time[collector] = max(self.base_time[collector], cutoff)
+                del log[:n]
+        return None
+
+    def ready(self, start_time):
+        '''
+        Return:
+            True if every collector has a base table from before the history table of an event at start_time
+        '''
+        history_time = _timestamp(start_time) - self.history_lag.total_seconds()
+        with self.lock:
+            return all(t is not None and t <= history_time for t in self.base_time.values())
+
+    def covers(self, IP, start_time):
+        '''
+        Return:
+            True if IP is one of the watched prefixes or more specific than one, and the monitor is ready for start_time
+        '''
+        return self.watched.longest_match(IP, include_self=True) is not None and self.ready(start_time)
+
+    def event_ribs(self, start_time, IP_prefix, end_time = None, collectors = None):
+        '''
+        BGP data of an event from memory, with the windows of BGP_Module.collector_event_ribs
+        Args:
+            start_time: time when the anomaly event starts ('%Y-%m-%d %H:%M:%S', UTC)
+            IP_prefix: IP prefix of the event, only prefixes that overlap it are returned
+            end_time: optional, time when the anomaly event ends, default 1 day after start
+            collectors: optional list of collectors, all monitored collectors if None
+        Return:
+            {collector: (history_rib, delta_before, delta_after)} of this collector, each {IP prefix: {peer: [AS path]}}.
+            Updates after the event start are the ones received so far
+        '''
+        start = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
+        end = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S') if end_time else start + timedelta(days=1)
+        history_time = _timestamp(start - self.history_lag)
+        boundary = _timestamp(start - timedelta(minutes=10))
+        until = _timestamp(min(end - timedelta(minutes=1), start + timedelta(minutes=10)))
+        target = Prefix_Trie([IP_prefix])
+        collector_ribs = {}
+        with self.lock:
+            for collector in collectors or self.collector_list:
+                if collector not in self.log:
+                    continue
+                log = [entry for entry in self.log[collector] if target.overlaps(entry[2])]
+                times = [entry[0] for entry in log]
+                history_end = bisect.bisect_left(times, history_time)
+                before_end = bisect.bisect_left(times, boundary)
+                after_end = bisect.bisect_right(times, until)
+                base = {IP: peers for IP, peers in self.base[collector].items() if target.overlaps(IP)}
+                history_rib = apply_delta(base, _delta(log[:history_end]))
+                #like a rib dump, the history table has no withdrawn paths
+                history_rib = {IP: {peer: path for peer, path in peers.items() if path} for IP, peers in history_rib.items()}
+                collector_ribs[collector] = ({IP: peers for IP, peers in history_rib.items() if peers},
+                                             _delta(log[history_end:before_end]),
+                                             _delta(log[before_end:after_end]) if until >= boundary else {})
+        return collector_ribs
+
+    def ribs(self, start_time, IP_prefix, end_time = None, collectors = None):
+        '''
+        Return:
+            history_rib, rib_before_incident, rib_after_incident of an event as RIB_Snapshot, like BEAR.AS_Path_IP
+        '''
+        collector_ribs = self.event_ribs(start_time, IP_prefix, end_time=end_time, collectors=collectors)
+        history_rib = RIB_Snapshot({collector: ribs[0] for collector, ribs in collector_ribs.items()})
+        rib_before_incident = history_rib.snapshot({collector: ribs[1] for collector, ribs in collector_ribs.items()})
+        rib_after_incident = rib_before_incident.snapshot({collector: ribs[2] for collector, ribs in collector_ribs.items()})
+        return history_rib, rib_before_incident, rib_after_incident
+
+    def bootstrap(self, from_time = None):
+        '''
+        load the base table of every collector from its last rib dump before from_time (BGPStream), then catch up on the
+        updates from the dump to now with follow(until=now) or poll
+        Args:
+            from_time: optional datetime (UTC), default now - retention
+        Return:
+            time of the rib dump (datetime)
+        '''
+        from_time = from_time or datetime.utcnow() - self.retention
+        interval = int(self.rib_interval.total_seconds())
+        dump_time = datetime(1970, 1, 1) + timedelta(seconds=calendar.timegm(from_time.timetuple()) // interval * interval)
+        dumps = fetch_collectors(collector_rib_dump, self.collector_list, n_workers=self.n_workers,
+                                 executor=self.executor, from_time=dump_time,
+                                 until_time=dump_time + timedelta(minutes=1), bgp_filter=self.bgp_filter())
+        for collector, rib in dumps.items():
+            self.load_rib(collector, rib, dump_time)
+        return dump_time
+
+    def poll(self, from_time, until_time):
+        '''
+        read the updates of every collector between from_time and until_time (datetime, UTC) from BGPStream and apply them
+        Return:
+            number of updates kept
+        '''
+        updates = fetch_collectors(collector_update_list, self.collector_list, n_workers=self.n_workers,
+                                   executor=self.executor, from_time=from_time, until_time=until_time,
+                                   bgp_filter=self.bgp_filter())
+        kept = 0
+        for collector, collector_updates in updates.items():
+            for update_time, IP, peer, path in collector_updates:
+                kept += self.apply(collector, update_time, IP, peer, path)
+        self.compact()
+        return kept
+
+    def follow(self, from_time, poll_interval = 60, publish_delay = timedelta(minutes=10), until = None):
+        '''
+        apply the updates of every collector from from_time on, one window every poll_interval seconds, until stop() is
+        called (or until the given time). Run it in its own thread to answer alerts meanwhile
+        Args:
+            from_time: datetime (UTC), e.g. the time returned by bootstrap
+            poll_interval: seconds between two windows
+            publish_delay: timedelta, updates younger than this are read in the next window, since the archive publishes
+                           them with a delay
+            until: optional datetime (UTC), stop after the updates up to this time are applied
+        '''
+        cursor = from_time
+        while not self.stop_event.is_set():
+            window_end = datetime.utcnow() - publish_delay
+            if until is not None:
+                window_end = min(window_end, until)
+            if window_end > cursor:
+                self.poll(cursor, window_end)
+                cursor = window_end
+            if until is not None and cursor >= until:
+                break
+            self.stop_event.wait(poll_interval)
+        return None
+
+    def stop(self):
+        self.stop_event.set()
+
+    def replay_json(self, path):
+        '''
+        apply the updates of a json file: a list or one object per line, each either
+        {"time", "collector", "peer", "type" ("A" or "W"), "prefix", "as_path" (list or str)} or a RIS Live message
+        {"type": "ris_message", "data": {"timestamp", "host", "peer_asn", "path", "announcements", "withdrawals"}}
+        Return:
+            number of updates kept
+        '''
+        with open(path, "r") as f:
+            text = f.read()
+        try:
+            messages = json.loads(text)
+        except ValueError: #one object per line
+            messages = [json.loads(line) for line in text.splitlines() if line.strip()]
+        if isinstance(messages, dict):
+            messages = [messages]
+        updates = sorted((update for message in messages for update in _json_updates(message)), key=lambda u: u[0])
+        kept = sum(self.apply(collector, update_time, IP, peer, path) for update_time, collector, IP, peer, path in updates)
+        self.compact()
+        return kept
+
+    def replay_mrt(self, path, collector, rib = False, rib_time = None):
+        '''
+        apply a local MRT file of one collector with BGPStream
+        Args:
+            path: MRT file of updates, or of a rib dump if rib is True
+            collector: collector name of the file
+            rib: True if the file is a rib dump, it then becomes the base table of the collector
+            rib_time: optional datetime or unix time of the rib dump, time of its entries if None
+        Return:
+            number of updates kept (entries for a rib dump)
+        '''
+        stream = _stream(data_interface="singlefile")
+        stream.set_data_interface_option("singlefile", "rib-file" if rib else "upd-file", path)
+        if rib:
+            table = {}
+            latest = 0
+            for update_time, _, IP, peer, hops in stream_updates(stream):
+                table.setdefault(IP, {})[peer] = hops
+                latest = max(latest, update_time)
+            self.load_rib(collector, table, rib_time if rib_time is not None else latest)
+            return sum(len(peers) for peers in self.base[collector].values())
+        kept = sum(self.apply(collector, update_time, IP, peer, hops) for update_time, _, IP, peer, hops in stream_updates(stream))
+        self.compact()
+        return kept
+
+
+def _timestamp(value):
+    '''
+    unix time of a datetime (UTC), a '%Y-%m-%d %H:%M:%S' string or a number
+    '''
+    if isinstance(value, str):
+        value = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime):
+        return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+    return float(value)
+
+
+def _delta(entries):
+    '''
+    Return:
+        {IP prefix: {peer: [AS path]}}, last path of each peer in the log entries
+    '''
+    delta = {}
+    for _, _, IP, peer, path in entries:
+        delta.setdefault(IP, {})[peer] = path
+    return delta
+
+
+def _json_updates(message):
+    '''
+    Return:
+        list of (time, collector, IP prefix, peer, [AS path]) of one json message
+    '''
+    if message.get("type") == "ris_message": #RIS Live
+        data = message["data"]
+        collector = data.get("host", "").split(".")[0]
+        peer = str(data["peer_asn"])
+        path = [str(AS) for AS in data.get("path", [])]
+        hops = [AS for i, AS in enumerate(path) if i == 0 or AS != path[i-1]]
+        updates = [(data["timestamp"], collector, IP, peer, [])
+                   for IP in data.get("withdrawals", [])]
+        updates += [(data["timestamp"], collector, IP, peer, hops)
+                    for announcement in data.get("announcements", []) for IP in announcement.get("prefixes", [])]
+        return updates
+    path = message.get("as_path") or []
+    if isinstance(path, str):
+        path = path.split()
+    path = [str(AS) for AS in path]
+    hops = [AS for i, AS in enumerate(path) if i == 0 or AS != path[i-1]]
+    return [(_timestamp(message["time"]), message["collector"], message["prefix"], str(message["peer"]),
+             [] if message.get("type") == "W" else hops)]
@@ -0,0 +1,109 @@
+from collections.abc import Mapping
+
+
+def apply_delta(rib, delta):
+    '''
+    overlay delta on top of rib without copying the whole routing table
+    Args:
+        rib: {IP prefix: {peer: [AS path]}}, routing table, not modified
+        delta: {IP prefix: {peer: [AS path]}}, updated paths
+    Return:
+        new_rib: {IP prefix: {peer: [AS path]}}, prefixes not in delta share their peer dict with rib
+    '''
+    new_rib = dict(rib)
+    for IP, peers in delta.items():
+        new_rib[IP] = {**rib.get(IP, {}), **peers}
+    return new_rib
+
+
+class RIB_Snapshot(Mapping):
+    '''
+    routing table of many collectors in the form {collector name: {IP prefix: {peer: [AS path]}}}, stored as a base table
+    plus a delta of the paths changed in one time window (copy-on-write). Snapshots can be chained: the routing table after
+    the event is the table before the event plus the updates after the event, which is the history table plus the updates
+    before the event. Only the delta is stored for each snapshot, the merged table of a collector is built when it is read.
+    It behaves like a read-only dict, str()/repr() gives the same text as the equivalent dict and to_dict() gives a plain
+    dict for json.dump.
+    '''
+    def __init__(self, base=None, delta=None):
+        '''
+        Args:
+            base: {collector name: {IP prefix: {peer: [AS path]}}} or RIB_Snapshot, table the delta is applied to
+            delta: {collector name: {IP prefix: {peer: [AS path]}}}, paths updated in this window, withdrawn paths are []
+        '''
+        self.base = base if base is not None else {}
+        self.delta = delta if delta is not None else {}
+
+    def __getitem__(self, collector):
+        if collector in self.delta:
+            return apply_delta(self.base.get(collector, {}), self.delta[collector])
+        return self.base[collector]
+
+    def __iter__(self):
+        yield from self.base
+        for collector in self.delta:
+            if collector not in self.base:
+                yield collector
+
+    def __len__(self):
+        return len(self.base) + sum(1 for collector in self.delta if collector not in self.base)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        '''
+        Return:
+            plain {collector name: {IP prefix: {peer: [AS path]}}} dict of the merged routing table
+        '''
+        return {collector: {IP: dict(peers) for IP, peers in rib.items()} for collector, rib in self.items()}
+
+    def snapshot(self, delta):
+        '''
+        Args:
+            delta: {collector name: {IP prefix: {peer: [AS path]}}}, paths updated after this snapshot
+        Return:
+            new RIB_Snapshot of this table with delta applied, this snapshot is not modified
+        '''
+        return RIB_Snapshot(base=self, delta=delta)
+
+    def changed(self):
+        '''
+        Return:
+            {collector name: {IP prefix: {peer: [AS path]}}}, existing paths of the base table replaced by a different path
+        '''
+        return self._select_delta(lambda old, path: old is not None and path and path != old)
+
+    def withdrawn(self):
+        '''
+        Return:
+            {collector name: {IP prefix: {peer: []}}}, paths withdrawn in this window
+        '''
+        return self._select_delta(lambda old, path: not path)
+
+    def new_prefixes(self):
+        '''
+        Return:
+            {collector name: {IP prefix: {peer: [AS path]}}}, paths to prefixes that are not in the base table of the collector
+        '''
+        new = {}
+        for collector, rib in self.delta.items():
+            base_rib = self.base.get(collector, {})
+            prefixes = {IP: dict(peers) for IP, peers in rib.items() if IP not in base_rib}
+            if prefixes:
+                new[collector] = prefixes
+        return new
+
+    def _select_delta(self, keep):
+        '''
+        select entries of the delta by keep(old path in base or None, new path)
+        '''
+        selected = {}
+        for collector, rib in self.delta.items():
+            base_rib = self.base.get(collector, {})
+            for IP, peers in rib.items():
+                old_peers = base_rib.get(IP, {})
+                for peer, path in peers.items():
+                    if keep(old_peers.get(peer), path):
+                        selected.setdefault(collector, {}).setdefault(IP, {})[peer] = path
+        return selected
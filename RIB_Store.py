@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import shutil
+import argparse
+import numpy as np
+from Path_Table import Path_Table, Vocabulary
+
+
+#routing tables of an event, in the order they are saved and loaded
+TABLES = ["history", "before", "after"]
+#json files of the same routing tables (read_path / save_path of BEAR)
+JSON_FILES = {"history": "history_rib.json", "before": "before_event_rib.json", "after": "after_event_rib.json"}
+COLUMNS = ["collector", "prefix", "peer", "offsets", "hops"]
+STORE_VERSION = 1
+
+
+def store_path(path, file_save_prefix = ""):
+    '''
+    Return:
+        directory of the columnar store of an event, e.g. "e_1/0_ribs/" for path "e_1/" and file_save_prefix "0_"
+    '''
+    return os.path.join(path, file_save_prefix + "ribs")
+
+
+def save_event(path, history_rib, rib_before_incident, rib_after_incident):
+    '''
+    save the routing tables of an event in a columnar store: a directory with one .npy file per column of each Path_Table
+    and meta.json with the vocabulary and, for every table, the range of rows of each collector. Rows of one (collector,
+    prefix) are contiguous and listed in {table}_groups.npy, so one collector or one prefix is read without the rest.
+    Args:
+        path: directory of the store, replaced if it exists
+        history_rib, rib_before_incident, rib_after_incident: {collector name: {IP prefix: {peer: [AS path]}}}
+    '''
+    vocab = Vocabulary()
+    tables = [Path_Table.from_dict(rib, vocab) for rib in (history_rib, rib_before_incident, rib_after_incident)]
+    tmp_path = path.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    meta = {"version": STORE_VERSION, "vocab": vocab.to_json_dict(), "tables": {}}
+    for name, table in zip(TABLES, tables):
+        for column in COLUMNS:
+            np.save(os.path.join(tmp_path, f"{name}_{column}.npy"), getattr(table, column))
+        groups = table.groups()
+        np.save(os.path.join(tmp_path, f"{name}_groups.npy"), groups)
+        index = {vocab.names["collectors"][c]: [0, 0] for c in table.collectors.tolist()}
+        for c in np.unique(groups[:, 0]).tolist():
+            rows = groups[groups[:, 0] == c]
+            index[vocab.names["collectors"][c]] = [int(rows[0, 2]), int(rows[-1, 3])]
+        meta["tables"][name] = {"rows": len(table), "collectors": index}
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+class RIB_Store():
+    '''
+    read the columnar store of an event written by save_event. Columns are memory-mapped, so only the rows of the
+    requested collectors or prefixes are read from disk.
+    '''
+    def __init__(self, path):
+        '''
+        Args:
+            path: directory of the store
+        '''
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != STORE_VERSION:
+            raise ValueError(f"unsupported rib store version {self.meta.get('version')} in {path}")
+        self.vocab = Vocabulary(**self.meta["vocab"])
+        self.tables = {}
+        for name in TABLES:
+            columns = [np.load(os.path.join(path, f"{name}_{column}.npy"), mmap_mode="r") for column in COLUMNS]
+            collectors = np.array([self.vocab.ids["collectors"][c] for c in self.meta["tables"][name]["collectors"]],
+                                  dtype=np.uint32)
+            self.tables[name] = Path_Table(self.vocab, collectors, *columns)
+        self.groups = {name: np.load(os.path.join(path, f"{name}_groups.npy"), mmap_mode="r") for name in TABLES}
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, "meta.json"))
+
+    def collectors(self):
+        '''
+        Return:
+            names of the collectors in any table of the event
+        '''
+        return list(dict.fromkeys([c for name in TABLES for c in self.meta["tables"][name]["collectors"]]))
+
+    def prefixes(self):
+        return list(self.vocab.names["prefixes"])
+
+    def path_tables(self, collectors = None, prefixes = None):
+        '''
+        Args:
+            collectors: optional list of collector names, all collectors if None
+            prefixes: optional list of IP prefixes, all prefixes if None
+        Return:
+            history, before and after Path_Table of the event (sharing one Vocabulary) restricted to collectors and prefixes
+        '''
+        if collectors is None and prefixes is None:
+            return [self.tables[name] for name in TABLES]
+        tables = []
+        for name in TABLES:
+            index = self.meta["tables"][name]["collectors"]
+            selected = [c for c in (collectors if collectors is not None else index) if c in index]
+            collector_ids = np.array([self.vocab.ids["collectors"][c] for c in selected], dtype=np.uint32)
+            if prefixes is None: #one contiguous range of rows per collector
+                row_ranges = [index[c] for c in selected]
+            else:
+                prefix_ids = [self.vocab.ids["prefixes"][IP] for IP in prefixes if IP in self.vocab.ids["prefixes"]]
+                groups = np.asarray(self.groups[name])
+                groups = groups[np.isin(groups[:, 0], collector_ids) & np.isin(groups[:, 1], prefix_ids)]
+                position = {c: i for i, c in enumerate(collector_ids.tolist())}
+                groups = groups[np.argsort([position[c] for c in groups[:, 0].tolist()], kind="stable")]
+                row_ranges = groups[:, 2:].tolist()
+            tables.append(self.tables[name].select(row_ranges, collectors=collector_ids))
+        return tables
+
+    def load(self, collectors = None, prefixes = None):
+        '''
+        Args:
+            collectors: optional list of collector names, all collectors if None
+            prefixes: optional list of IP prefixes, all prefixes if None
+        Return:
+            history_rib, rib_before_incident, rib_after_incident: {collector name: {IP prefix: {peer: [AS path]}}}
+        '''
+        return [table.to_dict() for table in self.path_tables(collectors=collectors, prefixes=prefixes)]
+
+
+def convert_tree(read_path, save_path = None):
+    '''
+    convert the json routing tables of every event in read_path ({i}_history_rib.json, {i}_before_event_rib.json and
+    {i}_after_event_rib.json) to columnar stores {i}_ribs/ in save_path
+    Args:
+        read_path: directory of the json files, e.g. "Experiment/e_1/"
+        save_path: directory of the stores, read_path if None
+    Return:
+        list of the converted file prefixes
+    '''
+    save_path = save_path or read_path
+    os.makedirs(save_path, exist_ok=True)
+    pattern = re.compile("^(.*)" + re.escape(JSON_FILES["history"]) + "$")
+    converted = []
+    for file_name in sorted(os.listdir(read_path)):
+        match = pattern.match(file_name)
+        if not match:
+            continue
+        file_save_prefix = match.group(1)
+        try:
+            ribs = []
+            for name in TABLES:
+                with open(os.path.join(read_path, file_save_prefix + JSON_FILES[name]), "r") as f:
+                    ribs.append(json.load(f))
+        except (OSError, ValueError): #incomplete event
+            continue
+        save_event(store_path(save_path, file_save_prefix), *ribs)
+        converted.append(file_save_prefix)
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert json routing tables of events to columnar stores")
+    parser.add_argument("read_path", help="directory of {i}_history_rib.json, {i}_before_event_rib.json and "
+                                          "{i}_after_event_rib.json, e.g. Experiment/e_1/")
+    parser.add_argument("save_path", nargs="?", default=None, help="directory of the stores, read_path if not given")
+    args = parser.parse_args()
+    converted = convert_tree(args.read_path, args.save_path)
+    print(f"converted {len(converted)} events")
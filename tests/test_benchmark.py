@@ -0,0 +1,60 @@
+import os
+import csv
+import json
+import random
+import zipfile
+from types import SimpleNamespace
+import RIB_Compactor
+from BEAR_benchmark import prepare_events, synthetic_ribs
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Data")
+
+
+def synthetic_events(event_type):
+    with open(os.path.join(DATA_PATH, "synthetic_history_rib.json"), "r") as f:
+        all_history_rib = json.load(f)
+    with zipfile.ZipFile(os.path.join(DATA_PATH, "Synthetic_events.zip")) as archive:
+        texts = {name: json.loads(archive.read(name)) for name in archive.namelist()}
+    with open(os.path.join(DATA_PATH, "BGP_explain_data.csv"), "r", newline="") as f:
+        records = list(csv.DictReader(f))
+    for i, record in enumerate(records):
+        name = os.path.basename(record["More info"])
+        if name in texts and record["IP"] and record["Event Type"] == event_type:
+            yield i, record, synthetic_ribs(all_history_rib, record["IP"], record["Event Type"], record["AS2"], texts[name],
+                                            random.Random(i))
+
+
+def test_synthetic_leaks_keep_origin():
+    n_events = 0
+    for i, record, (history_rib, rib_before_incident, rib_after_incident) in synthetic_events("Route Leak"):
+        if not history_rib:
+            continue
+        n_events += 1
+        n_changed = 0
+        for collector, rib in rib_after_incident.items():
+            history = history_rib[collector][record["IP"]]
+            for IP, peers in rib.items():
+                for peer, path in peers.items():
+                    assert path[-1] == history[peer][-1], (i, collector, IP, peer, path)
+                    n_changed += path != history[peer]
+        assert n_changed, i #the leak changes some paths
+    assert n_events
+
+
+def test_prepare_events_from_another_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    read_path, events_path = prepare_events("bench", sources=("e_1",), n_events=2)
+    with open(events_path, "r", newline="") as f:
+        assert len(list(csv.DictReader(f))) == 2
+    assert os.path.isfile(os.path.join(read_path, "0_history_rib.json"))
+
+
+def test_count_tokens_without_encoding(monkeypatch):
+    def encoding_for_model(model):
+        raise OSError("no network")
+    monkeypatch.setattr(RIB_Compactor, "tiktoken", SimpleNamespace(encoding_for_model=encoding_for_model))
+    RIB_Compactor._encoding.cache_clear()
+    try:
+        assert RIB_Compactor.count_tokens("x" * 40) == 11
+    finally:
+        RIB_Compactor._encoding.cache_clear()
@@ -0,0 +1,55 @@
+from Path_Diff import diff_ribs
+from Path_Table import Path_Table, Vocabulary
+from Event_Classifier import classify_event, HIJACK, LEAK, UNKNOWN
+
+
+PREFIX = "10.0.0.0/8"
+
+
+def changed_ribs(after_paths):
+    '''
+    Return:
+        history, before and after routing tables of one collector where every peer's path to PREFIX changes from
+        ["1", "2", "3"] to after_paths[peer]
+    '''
+    before = {"rrc00": {PREFIX: {peer: ["1", "2", "3"] for peer in after_paths}}}
+    after = {"rrc00": {PREFIX: dict(after_paths)}}
+    return before, before, after
+
+
+def test_inserted_transit_votes_leak():
+    path_diff = diff_ribs(*changed_ribs({f"10{i}": ["1", "2", "9", "3"] for i in range(3)}), PREFIX)
+    assert [change["inserted"] for change in path_diff["new_transit"]] == [["9"]]
+    decision = classify_event(path_diff)
+    assert decision["event_type"] == LEAK
+    assert decision["confidence"] == 1.0
+    assert decision["reroutes"] == 0
+
+
+def test_reroute_does_not_vote_leak():
+    #the transit AS 2 is replaced by AS 9: a reroute, not a leak
+    path_diff = diff_ribs(*changed_ribs({f"10{i}": ["1", "9", "3"] for i in range(3)}), PREFIX)
+    assert not path_diff["new_transit"]
+    assert len(path_diff["path_changes"]) == 1
+    decision = classify_event(path_diff)
+    assert decision["event_type"] == UNKNOWN
+    assert decision["votes"] == {HIJACK: 0, LEAK: 0}
+    assert decision["reroutes"] == 3
+
+
+def test_reroutes_do_not_outvote_hijack():
+    after_paths = {"100": ["1", "2", "4"], "101": ["1", "2", "4"], "102": ["1", "2", "4"],
+                   "103": ["1", "9", "3"], "104": ["1", "9", "3"]}
+    decision = classify_event(diff_ribs(*changed_ribs(after_paths), PREFIX))
+    assert decision["event_type"] == HIJACK
+    assert decision["votes"][LEAK] == 0
+    assert decision["reroutes"] == 2
+
+
+def test_path_tables_diff_like_dicts():
+    after_paths = {"100": ["1", "2", "4"], "101": ["1", "2", "9", "3"], "102": ["1", "9", "3"], "103": []}
+    ribs = changed_ribs(after_paths)
+    vocab = Vocabulary()
+    tables = [Path_Table.from_dict(rib, vocab) for rib in ribs]
+    assert diff_ribs(*tables, PREFIX) == diff_ribs(*ribs, PREFIX)
+    assert classify_event(diff_ribs(*tables, PREFIX)) == classify_event(diff_ribs(*ribs, PREFIX))
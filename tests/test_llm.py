@@ -0,0 +1,49 @@
+import asyncio
+from BEAR_benchmark import Mock_Client, mock_llm
+from LLM_Module import LLM_Module
+
+
+def free_slots(llm):
+    #number of request slots of llm that can be taken now, released again
+    n = 0
+    while llm.request_semaphore.acquire(blocking=False):
+        n += 1
+    for _ in range(n):
+        llm.request_semaphore.release()
+    return n
+
+
+def test_achat_limits_concurrent_requests():
+    client = Mock_Client(latency=0.05)
+    with mock_llm(client):
+        llm = LLM_Module(max_concurrent_requests=2)
+
+        async def run():
+            messages = [llm.make_message(f"prompt {i}") for i in range(6)]
+            return await asyncio.gather(*[llm.achat(message, "gpt-4o", n=2) for message in messages])
+
+        responses = asyncio.run(run())
+    assert [len(response) for response in responses] == [2] * 6
+    assert responses[0][0] == client.answer
+    assert len(client.prompt_tokens) == 6
+    assert client.peak_in_flight == 2
+    assert free_slots(llm) == 2
+
+
+def test_cancelled_achat_releases_its_slot():
+    client = Mock_Client(latency=10)
+    with mock_llm(client):
+        llm = LLM_Module(max_concurrent_requests=1)
+
+        async def run():
+            #the first task holds the slot in the request, the second waits for it
+            tasks = [asyncio.create_task(llm.achat(llm.make_message(f"prompt {i}"), "gpt-4o")) for i in range(2)]
+            await asyncio.sleep(0.1)
+            for task in tasks:
+                task.cancel()
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = asyncio.run(run())
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert len(client.prompt_tokens) == 1
+    assert free_slots(llm) == 1